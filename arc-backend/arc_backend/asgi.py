@@ -1,7 +1,9 @@
 """
-ASGI config for arc_backend project.
+ASGI config for arc_backend project: the market stream process.
 
-It exposes the ASGI callable as a module-level variable named ``application``.
+Serves only /api/stream/ (SSE + WebSocket, see core.streaming); the REST
+API runs in the threaded WSGI process (arc_backend.wsgi). Run one worker:
+``gunicorn -k uvicorn.workers.UvicornWorker arc_backend.asgi:application``.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
@@ -9,8 +11,15 @@ https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 
 import os
 
-from django.core.asgi import get_asgi_application
+import django
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'arc_backend.settings')
 
-application = get_asgi_application()
+django.setup()
+
+from core.streaming import StreamRouter, start_stream_feed
+
+application = StreamRouter()
+
+# Follow ticks and balance changes written by the API process (see core.streaming)
+start_stream_feed()
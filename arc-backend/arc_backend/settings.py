@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import importlib.util
 from pathlib import Path
 import os
 from dotenv import load_dotenv
@@ -50,6 +51,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'corsheaders.middleware.CorsMiddleware',  # Add CORS middleware at the top
+    'django.middleware.gzip.GZipMiddleware',  # compress responses (bodies under 200 bytes are left alone)
     'whitenoise.middleware.WhiteNoiseMiddleware',  # Add WhiteNoise for static files
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -58,6 +60,8 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'core.middleware.RequestLogMiddleware',  # sampled access log: view, user id, latency
+    'core.middleware.DbStatsMiddleware',  # X-Db-Queries / X-Db-Time-Ms per request
 ]
 
 ROOT_URLCONF = 'arc_backend.urls'
@@ -85,6 +89,7 @@ WSGI_APPLICATION = 'arc_backend.wsgi.application'
 
 # MongoDB (MongoEngine) settings
 import mongoengine
+from core.dbstats import command_listener
 
 # Connect to MongoDB
 mongoengine.connect(
@@ -98,9 +103,31 @@ mongoengine.connect(
     maxPoolSize=50,  # Maximum number of connections in the pool
     minPoolSize=10,  # Minimum number of connections in the pool
     retryWrites=True,
-    retryReads=True
+    retryReads=True,
+    event_listeners=[command_listener],  # per-request command counting (core.dbstats)
 )
 
+# Mongo command budgets enforced by core.middleware.DbStatsMiddleware.
+# Requests above budget are logged; core.testing.QueryBudgetMixin fails on them.
+# The per-path numbers were measured under mongomock and are unverified against
+# a real mongod: confirm them with MONGODB_TEST_URI set (core.tests.QueryBudgetTests),
+# on a replica set so place-order's transaction commands are counted too.
+DB_QUERY_BUDGET = int(os.environ.get('DB_QUERY_BUDGET', '10'))
+DB_QUERY_BUDGETS = {
+    '/api/portfolio/': 2,
+    '/api/market-data/': 1,
+    '/api/order-history/': 3,
+    '/api/order-book/': 1,
+    '/api/price-history/': 3,
+    '/api/transactions/': 3,
+    '/api/merchant/info/': 3,
+    '/api/place-order/': 6,  # market or resting limit order: balances, records, ledger, commitTransaction
+}
+# Same command shape repeated this many times in one request is logged as a likely N+1
+DB_N_PLUS_ONE_THRESHOLD = int(os.environ.get('DB_N_PLUS_ONE_THRESHOLD', '5'))
+# Measure Mongo reply sizes (X-Db-Bytes); re-encodes every reply, so off by default
+DB_STATS_BYTES = os.environ.get('DB_STATS_BYTES', 'false').lower() == 'true'
+
 # Django still needs a default database for built-in apps
 DATABASES = {
     'default': {
@@ -122,12 +149,21 @@ CORS_ALLOW_HEADERS = [
     'authorization',
     'content-type',
     'dnt',
+    'if-none-match',
     'origin',
     'user-agent',
     'x-csrftoken',
     'x-requested-with',
 ]
 
+CORS_EXPOSE_HEADERS = [
+    'etag',
+    'server-timing',
+    'x-db-queries',
+    'x-db-bytes',
+    'x-db-time-ms',
+]
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -178,11 +214,134 @@ REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.AllowAny',
     ],
+    # orjson by default; MessagePack for clients sending Accept: application/msgpack
     'DEFAULT_RENDERER_CLASSES': [
-        'rest_framework.renderers.JSONRenderer',
-    ],
+        'core.renderers.ORJSONRenderer',
+    ] + (['core.renderers.MsgPackRenderer'] if importlib.util.find_spec('msgpack') else []),
+}
+
+# Logging: app loggers go through a sampled, queue-backed handler (core.log)
+# so formatting and stdout writes stay off the request threads.
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+# Fraction of sub-WARNING records kept, by logger-name prefix
+LOG_SAMPLE_RATES = {
+    'core.request': float(os.environ.get('LOG_SAMPLE_REQUESTS', '0.1')),
+    'core.auth': 0.01,
+}
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'filters': {
+        'sampling': {
+            '()': 'core.log.SamplingFilter',
+            'rates': LOG_SAMPLE_RATES,
+        },
+    },
+    'formatters': {
+        'structured': {
+            '()': 'core.log.StructuredFormatter',
+        },
+    },
+    'handlers': {
+        'queue': {
+            'class': 'core.log.QueueLogHandler',
+            'formatter': 'structured',
+            'filters': ['sampling'],
+        },
+    },
+    'loggers': {
+        'core': {
+            'handlers': ['queue'],
+            'level': LOG_LEVEL,
+            'propagate': False,
+        },
+    },
 }
 
+# Token -> user cache used by core.auth (seconds / max entries)
+TOKEN_CACHE_TTL = int(os.environ.get('TOKEN_CACHE_TTL', '60'))
+TOKEN_CACHE_MAX_SIZE = int(os.environ.get('TOKEN_CACHE_MAX_SIZE', '10000'))
+
+# In-process price ticker (core.ticker). Disable it when running
+# `manage.py init_crypto_system --simulate` as a sidecar: the web process then
+# follows the sidecar's ticks from Mongo to match orders and revalue portfolios.
+PRICE_TICKER_ENABLED = os.environ.get('PRICE_TICKER_ENABLED', 'true').lower() == 'true'
+PRICE_TICK_INTERVAL = float(os.environ.get('PRICE_TICK_INTERVAL', '5'))
+
+# Vectorized price simulation (core.simulation)
+PRICE_SIM_MODEL = os.environ.get('PRICE_SIM_MODEL', 'bounded_walk')  # or 'gbm'
+PRICE_SIM_CORRELATION = float(os.environ.get('PRICE_SIM_CORRELATION', '0'))
+PRICE_SIM_MEAN_REVERSION = float(os.environ.get('PRICE_SIM_MEAN_REVERSION', '0.05'))
+PRICE_SIM_SEED = int(os.environ['PRICE_SIM_SEED']) if os.environ.get('PRICE_SIM_SEED') else None
+# The engine keeps pair state between ticks; reload the pairs from Mongo this often
+# (seconds) to pick up pairs added or edited by another process
+PRICE_PAIRS_RELOAD = float(os.environ.get('PRICE_PAIRS_RELOAD', '300'))
+
+# Seconds between keep-alive frames on idle /api/stream/ connections (core.streaming)
+STREAM_HEARTBEAT = float(os.environ.get('STREAM_HEARTBEAT', '15'))
+# Seconds a /api/stream/ticket/ ticket can be redeemed (once) to open a stream
+STREAM_TICKET_TTL = float(os.environ.get('STREAM_TICKET_TTL', '30'))
+# Seconds between the stream process's reads of new ticks and balances
+STREAM_POLL_INTERVAL = float(os.environ.get('STREAM_POLL_INTERVAL', '2'))
+
+# Seconds a PriceSnapshot (all active pairs, one query) is served from memory
+PRICE_SNAPSHOT_TTL = float(os.environ.get('PRICE_SNAPSHOT_TTL', '5'))
+
+# /api/price-history/ downsampling (core.downsample): cap on returned points,
+# rows read per downsampled request, and cache TTLs for open / closed ranges
+PRICE_HISTORY_MAX_POINTS = int(os.environ.get('PRICE_HISTORY_MAX_POINTS', '2000'))
+PRICE_HISTORY_MAX_SOURCE = int(os.environ.get('PRICE_HISTORY_MAX_SOURCE', '20000'))
+PRICE_HISTORY_CACHE_TTL = float(os.environ.get('PRICE_HISTORY_CACHE_TTL', '5'))
+PRICE_HISTORY_CLOSED_TTL = float(os.environ.get('PRICE_HISTORY_CLOSED_TTL', '300'))
+
+# Transaction history pages (core.pagination): default and maximum ?limit=
+TRANSACTION_PAGE_SIZE = int(os.environ.get('TRANSACTION_PAGE_SIZE', '100'))
+TRANSACTION_PAGE_MAX = int(os.environ.get('TRANSACTION_PAGE_MAX', '500'))
+
+# Bulk merchant payouts (core.payouts): rows accepted per request
+PAYOUT_MAX_ROWS = int(os.environ.get('PAYOUT_MAX_ROWS', '5000'))
+
+# Ledger (core.ledger): a wallet's balance is checkpointed every N entries;
+# only entries older than LEDGER_SETTLE_SECONDS (> the 60s transaction limit)
+# are folded into a checkpoint
+LEDGER_SNAPSHOT_EVERY = int(os.environ.get('LEDGER_SNAPSHOT_EVERY', '100'))
+LEDGER_SETTLE_SECONDS = float(os.environ.get('LEDGER_SETTLE_SECONDS', '120'))
+
+# Portfolio valuations (core.valuation), maintained by the price ticker:
+# seconds between bulk writes of Portfolio.total_value_usd and between full rebuilds
+VALUATION_PERSIST_SECONDS = float(os.environ.get('VALUATION_PERSIST_SECONDS', '30'))
+VALUATION_REBUILD_SECONDS = float(os.environ.get('VALUATION_REBUILD_SECONDS', '3600'))
+
+# External price-history fallback (core.external_history) used when a pair
+# has no local history. Timeouts are seconds; TTLs bound how long fetched
+# history is served fresh / stale-while-revalidating. The API key is only
+# read from the environment.
+COINCAP_BASE_URL = os.environ.get('COINCAP_BASE_URL', 'https://rest.coincap.io/v3')
+COINCAP_API_KEY = os.environ.get('COINCAP_API_KEY', '')
+COINCAP_CONNECT_TIMEOUT = float(os.environ.get('COINCAP_CONNECT_TIMEOUT', '2'))
+COINCAP_READ_TIMEOUT = float(os.environ.get('COINCAP_READ_TIMEOUT', '3'))
+COINCAP_POOL_SIZE = int(os.environ.get('COINCAP_POOL_SIZE', '4'))
+COINCAP_FRESH_TTL = float(os.environ.get('COINCAP_FRESH_TTL', '300'))
+COINCAP_STALE_TTL = float(os.environ.get('COINCAP_STALE_TTL', '3600'))
+COINCAP_BREAKER_THRESHOLD = int(os.environ.get('COINCAP_BREAKER_THRESHOLD', '3'))
+COINCAP_BREAKER_RESET = float(os.environ.get('COINCAP_BREAKER_RESET', '30'))
+
+# Face encoding process pool (core.face_jobs); kept small so dlib work can't
+# starve the gunicorn threads serving trading and portfolio requests
+FACE_POOL_WORKERS = int(os.environ.get('FACE_POOL_WORKERS', '2'))
+FACE_POOL_MAX_PENDING = int(os.environ.get('FACE_POOL_MAX_PENDING', '16'))
+FACE_AUTH_TIMEOUT = float(os.environ.get('FACE_AUTH_TIMEOUT', '15'))
+# Image pre-processing before dlib detection (core.face_encoding)
+FACE_MAX_UPLOAD_BYTES = int(os.environ.get('FACE_MAX_UPLOAD_BYTES', str(8 * 1024 * 1024)))
+FACE_MAX_PIXELS = int(os.environ.get('FACE_MAX_PIXELS', '40000000'))
+FACE_MAX_DIMENSION = int(os.environ.get('FACE_MAX_DIMENSION', '640'))
+FACE_DETECTOR_MODEL = os.environ.get('FACE_DETECTOR_MODEL', 'hog')  # 'hog' or 'cnn'
+FACE_DETECTOR_UPSAMPLE = int(os.environ.get('FACE_DETECTOR_UPSAMPLE', '1'))
+# Storage dtype of the in-memory identification matrix (core.face_index);
+# float32 halves memory and keeps queries under 10 ms at 100k users
+FACE_INDEX_DTYPE = os.environ.get('FACE_INDEX_DTYPE', 'float32')
+
 # CSRF Settings
 CSRF_TRUSTED_ORIGINS = os.environ.get('CSRF_TRUSTED_ORIGINS', 
     "http://localhost:3000,http://127.0.0.1:3000,http://localhost:5173,http://127.0.0.1:5173").split(',')
@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'arc_backend.settings')
 
 application = get_wsgi_application()
+
+# Advance simulated prices in the background (see core.ticker)
+from core.ticker import start_price_ticker
+
+start_price_ticker()
@@ -0,0 +1,74 @@
+from django.conf import settings
+from mongoengine import signals
+from .cache import TTLCache
+from .models import User, Token
+
+# token string -> User document, shared by every authenticated view
+_token_cache = TTLCache(
+    maxsize=getattr(settings, 'TOKEN_CACHE_MAX_SIZE', 10000),
+    ttl=getattr(settings, 'TOKEN_CACHE_TTL', 60),
+)
+
+
+def parse_auth_header(auth_header):
+    """Extract the token from a 'Token <key>' / 'Bearer <key>' header.
+
+    A bare key without a scheme is accepted as well, matching what the
+    dashboard and extension have always sent.
+    """
+    if not auth_header:
+        return None
+    parts = auth_header.split(' ', 1)
+    if len(parts) == 1:
+        return parts[0] or None
+    token_type, token = parts
+    if token_type.lower() not in ['token', 'bearer']:
+        return None
+    return token.strip() or None
+
+
+def resolve_token(token):
+    """Return the User owning ``token`` or None, served from cache when possible."""
+    if not token:
+        return None
+    user = _token_cache.get(token)
+    if user is not None:
+        return user
+    token_obj = Token.objects(token=token).first()
+    if not token_obj or not token_obj.user:
+        return None
+    user = token_obj.user
+    _token_cache.set(token, user)
+    return user
+
+
+def get_request_user(request):
+    """Resolve the authenticated user from the request's Authorization header."""
+    user = resolve_token(parse_auth_header(request.META.get('HTTP_AUTHORIZATION')))
+    if user is not None:
+        request.user = user
+    return user
+
+
+def invalidate_token(token):
+    _token_cache.pop(token)
+
+
+def invalidate_user(user):
+    """Drop every cached token for ``user`` (call after the user document changes)."""
+    user_id = str(getattr(user, 'id', user))
+    _token_cache.pop_where(lambda cached: str(cached.id) == user_id)
+
+
+def _on_user_changed(sender, document, **kwargs):
+    invalidate_user(document)
+
+
+def _on_token_deleted(sender, document, **kwargs):
+    invalidate_token(document.token)
+
+
+# Keep cached users in step with saves/deletes made through mongoengine
+signals.post_save.connect(_on_user_changed, sender=User)
+signals.post_delete.connect(_on_user_changed, sender=User)
+signals.post_delete.connect(_on_token_deleted, sender=Token)
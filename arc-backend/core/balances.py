@@ -0,0 +1,341 @@
+"""
+Atomic wallet balance updates.
+
+Balances are changed in place with one guarded ``find_one_and_update`` per
+portfolio (or merchant wallet) instead of loading the document, editing
+``CryptoWallet.balance`` in Python and saving every wallet back. Each
+debited wallet is matched with ``$elemMatch: {symbol, balance >= amount}``
+and all legs are ``$inc``-ed through array filters, so concurrent requests
+can never overdraw a wallet or overwrite each other's changes, and neither
+direction carries private keys: only symbols, balances and addresses come back.
+
+Changes spanning several documents (a transfer, a trade plus its records)
+go through ``atomic``: on a replica set they run in one multi-document
+transaction; on a standalone mongod, which has no transactions, already
+applied legs are reversed if a later one fails. Each unit also posts its
+legs as one journal to the append-only ledger (core.ledger), booking any
+imbalance against ``contra``.
+
+    def move(batch):
+        batch.debit(sender, 'BTC', 0.5)
+        batch.credit(receiver, 'BTC', 0.5)
+        batch.insert(Transaction, [...])
+    atomic(move, kind='transfer')
+
+Updates bypass ``Document.save()``, so they bump ``updated_at`` (the ETag
+marker) themselves. The stream process (core.streaming) picks new balances
+up from the portfolios.
+"""
+import json
+import logging
+from collections import defaultdict
+from datetime import datetime
+
+from pymongo import ReturnDocument, UpdateOne
+
+from . import ledger
+from .models import CryptoWallet, MerchantWallet, Portfolio
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 3  # retries when a wallet had to be created or a concurrent update won
+WALLET_PROJECTION = {'_id': 0, 'wallets.symbol': 1, 'wallets.balance': 1, 'wallets.public_key': 1}
+
+
+class BalanceError(Exception):
+    pass
+
+
+class InsufficientBalance(BalanceError):
+    def __init__(self, symbol):
+        super().__init__(f'Insufficient {symbol} balance')
+        self.symbol = symbol
+
+
+class WalletNotFound(BalanceError):
+    def __init__(self, symbol):
+        super().__init__(f'No {symbol} wallet found')
+        self.symbol = symbol
+
+
+class WalletOwnerNotFound(BalanceError):
+    pass
+
+
+def _owner_id(owner):
+    return getattr(owner, 'id', owner)
+
+
+def new_wallet(symbol, name=None):
+    """Embedded wallet document for ``symbol`` with a fresh (simulated) key pair."""
+    from .utils import generate_wallet, get_crypto_name
+    public_key, private_key = generate_wallet()
+    return CryptoWallet(
+        symbol=symbol,
+        name=name or get_crypto_name(symbol),
+        public_key=public_key,
+        private_key=json.dumps(private_key),
+        balance=0.0,
+    ).to_mongo().to_dict()
+
+
+def _add_wallets(collection, match, symbols, session=None, **fields):
+    """Push a new wallet (plus ``fields``) for each of ``symbols``; returns ``{symbol: wallet}`` of those added."""
+    added = {}
+    for symbol in symbols:
+        wallet = dict(new_wallet(symbol), **fields)
+        # $ne guard: a concurrent request may have created it already
+        result = collection.update_one(
+            {**match, 'wallets.symbol': {'$ne': symbol}},
+            {'$push': {'wallets': wallet}, '$set': {'updated_at': datetime.utcnow()}},
+            session=session,
+        )
+        if result.modified_count:
+            added[symbol] = wallet
+    return added
+
+
+def add_wallet(model, owner_id, symbol, **fields):
+    """Create the ``symbol`` wallet of one Portfolio/MerchantWallet; returns it, or None if it already had one."""
+    match = {'user': owner_id} if model is Portfolio else {'_id': owner_id}
+    return _add_wallets(model._get_collection(), match, [symbol], **fields).get(symbol)
+
+
+def _wallets(doc):
+    return {wallet['symbol']: wallet for wallet in doc.get('wallets', [])}
+
+
+def update_balances(model, owner_id, deltas, session=None, guard=True, create=True):
+    """Apply ``{symbol: amount}`` to the wallets of one Portfolio/MerchantWallet atomically.
+
+    With ``guard`` every negative amount must be covered by the current
+    balance, otherwise nothing changes and InsufficientBalance is raised.
+    Wallets missing for a symbol are created, or WalletNotFound is raised
+    when ``create`` is false. Returns the owner's wallets after the update
+    as ``{symbol: {'symbol', 'balance', 'public_key'}}``.
+    """
+    deltas = {symbol: amount for symbol, amount in deltas.items() if amount}
+    if not deltas:
+        return None
+    collection = model._get_collection()
+    match = {'user': owner_id} if model is Portfolio else {'_id': owner_id}
+
+    conditions = []
+    increments = {}
+    array_filters = []
+    for i, (symbol, amount) in enumerate(deltas.items()):
+        if amount < 0 and guard:
+            conditions.append({'wallets': {'$elemMatch': {'symbol': symbol, 'balance': {'$gte': -amount}}}})
+        else:
+            conditions.append({'wallets.symbol': symbol})
+        increments[f'wallets.$[w{i}].balance'] = amount
+        array_filters.append({f'w{i}.symbol': symbol})
+    if model is MerchantWallet:
+        increments['version'] = 1
+
+    for _ in range(MAX_ATTEMPTS):
+        doc = collection.find_one_and_update(
+            {**match, '$and': conditions},
+            {'$inc': increments, '$set': {'updated_at': datetime.utcnow()}},
+            projection=WALLET_PROJECTION,
+            array_filters=array_filters,
+            return_document=ReturnDocument.AFTER,
+            session=session,
+        )
+        if doc is not None:
+            return _wallets(doc)
+
+        # Nothing matched: find out whether a wallet is short, missing or the owner is
+        current = collection.find_one(match, WALLET_PROJECTION, session=session)
+        if current is None:
+            raise WalletOwnerNotFound(f'{model.__name__} not found')
+        wallets = _wallets(current)
+        missing = [symbol for symbol in deltas if symbol not in wallets]
+        if missing and not create:
+            raise WalletNotFound(missing[0])
+        for symbol, amount in deltas.items():
+            if amount < 0 and guard and wallets.get(symbol, {}).get('balance', 0.0) < -amount:
+                raise InsufficientBalance(symbol)
+        _add_wallets(collection, match, missing, session)
+    raise BalanceError('Balance update conflicted repeatedly, try again')
+
+
+def _increment_many(credits, session=None):
+    """One unordered bulk_write of positional ``$inc`` for ``{(user_id, symbol): amount}``."""
+    now = datetime.utcnow()
+    return Portfolio._get_collection().bulk_write([
+        UpdateOne(
+            {'user': user_id, 'wallets.symbol': symbol},
+            {'$inc': {'wallets.$.balance': amount}, '$set': {'updated_at': now}}
+        )
+        for (user_id, symbol), amount in credits.items()
+    ], ordered=False, session=session)
+
+
+class BalanceBatch:
+    """Balance legs and inserts of one ``atomic`` unit; records what to undo without a transaction."""
+
+    def __init__(self, session=None):
+        self.session = session
+        self.wallets = {}  # portfolio user id -> wallets after its last leg
+        self.legs = defaultdict(float)  # (ledger account, symbol) -> amount, journaled by post()
+        self._undo = []
+
+    def apply(self, owner, deltas, model=Portfolio, guard=True, create=True):
+        """Returns the owner's wallets after the update (see ``update_balances``)."""
+        owner_id = _owner_id(owner)
+        wallets = update_balances(model, owner_id, deltas, session=self.session, guard=guard, create=create)
+        self._undo.append(('balances', model, owner_id, deltas))
+        for symbol, amount in deltas.items():
+            self.legs[(ledger.account_key(model, owner_id), symbol)] += amount
+        if model is Portfolio:
+            self.wallets[owner_id] = wallets
+        return wallets
+
+    def debit(self, owner, symbol, amount, model=Portfolio, create=True):
+        """Returns the debited wallet after the update."""
+        if amount <= 0:
+            raise BalanceError('Amount must be positive')
+        return self.apply(owner, {symbol: -amount}, model, create=create)[symbol]
+
+    def credit(self, owner, symbol, amount, model=Portfolio, create=True):
+        """Returns the credited wallet after the update."""
+        if amount <= 0:
+            raise BalanceError('Amount must be positive')
+        return self.apply(owner, {symbol: amount}, model, create=create)[symbol]
+
+    def credit_many(self, credits):
+        """Credit ``{(user_id, symbol): amount}`` across many portfolios in one unordered bulk_write.
+
+        Missing wallets are created first (one more bulk_write). Raises
+        WalletOwnerNotFound if any user has no portfolio. Returns the
+        credited wallets' addresses as ``{(user_id, symbol): public_key}``.
+        """
+        credits = {key: amount for key, amount in credits.items() if amount > 0}
+        if not credits:
+            return {}
+        collection = Portfolio._get_collection()
+        addresses = {}
+        owners = set()
+        for doc in collection.find(
+            {'user': {'$in': list({user_id for user_id, _ in credits})}},
+            {'user': 1, 'wallets.symbol': 1, 'wallets.public_key': 1}, session=self.session
+        ):
+            owners.add(doc['user'])
+            for wallet in doc.get('wallets', []):
+                addresses[(doc['user'], wallet['symbol'])] = wallet.get('public_key')
+        missing_owners = {user_id for user_id, _ in credits} - owners
+        if missing_owners:
+            raise WalletOwnerNotFound(f'{len(missing_owners)} recipient(s) have no portfolio')
+
+        created = {}
+        for user_id, symbol in credits:
+            if (user_id, symbol) not in addresses:
+                wallet = new_wallet(symbol)
+                addresses[(user_id, symbol)] = wallet['public_key']
+                created[(user_id, symbol)] = UpdateOne(
+                    {'user': user_id, 'wallets.symbol': {'$ne': symbol}}, {'$push': {'wallets': wallet}}
+                )
+        if created:
+            result = collection.bulk_write(list(created.values()), ordered=False, session=self.session)
+            if result.modified_count < len(created):
+                # A concurrent request created some of them first: use its addresses
+                for doc in collection.find(
+                    {'user': {'$in': list({user_id for user_id, _ in created})}},
+                    {'user': 1, 'wallets.symbol': 1, 'wallets.public_key': 1}, session=self.session
+                ):
+                    for wallet in doc.get('wallets', []):
+                        addresses[(doc['user'], wallet['symbol'])] = wallet.get('public_key')
+
+        _increment_many(credits, session=self.session)
+        self._undo.append(('credit_many', Portfolio, credits, None))
+        for (user_id, symbol), amount in credits.items():
+            self.legs[(ledger.account_key(Portfolio, user_id), symbol)] += amount
+        return {key: addresses.get(key) for key in credits}
+
+    def insert(self, model, documents):
+        """Insert documents (model instances or raw dicts) in one ``insert_many``."""
+        for doc in documents:
+            if hasattr(doc, 'validate'):
+                doc.validate()  # save() would have
+        documents = [doc.to_mongo().to_dict() if hasattr(doc, 'to_mongo') else doc for doc in documents]
+        if not documents:
+            return []
+        result = model._get_collection().insert_many(documents, ordered=True, session=self.session)
+        self._undo.append(('insert', model, result.inserted_ids, None))
+        return result.inserted_ids
+
+    def post(self, kind, contra=None, memo=''):
+        """Journal the legs applied so far to the ledger (see ``ledger.journal``)."""
+        entries = ledger.post_journal(self.legs, kind, contra, memo, session=self.session)
+        self._undo.append(('ledger', None, entries, None))
+        self.legs = defaultdict(float)
+        return entries
+
+    def update(self, model, operations, undo):
+        """Run ``operations`` (pymongo write models) in one unordered bulk_write.
+
+        ``undo`` holds the operations that restore the previous state, run
+        by ``rollback`` when there is no transaction to abort.
+        """
+        if operations:
+            model._get_collection().bulk_write(operations, ordered=False, session=self.session)
+        self._undo.append(('update', model, undo, None))
+
+    def rollback(self):
+        """Reverse applied legs (standalone mongod only; a transaction aborts instead)."""
+        for kind, model, target, deltas in reversed(self._undo):
+            try:
+                if kind == 'insert':
+                    model._get_collection().delete_many({'_id': {'$in': target}})
+                elif kind == 'update':
+                    if target:
+                        model._get_collection().bulk_write(target, ordered=False)
+                elif kind == 'ledger':
+                    ledger.reverse(target)
+                elif kind == 'credit_many':
+                    _increment_many({key: -amount for key, amount in target.items()})
+                else:
+                    update_balances(model, target, {symbol: -amount for symbol, amount in deltas.items()}, guard=False)
+            except Exception:
+                logger.exception('Failed to roll back balance change', extra={'fields': {
+                    'model': getattr(model, '__name__', None), 'kind': kind,
+                }})
+        self._undo = []
+
+
+def supports_transactions(client):
+    """Multi-document transactions need a replica set or sharded cluster."""
+    description = getattr(client, 'topology_description', None)
+    return description is not None and description.topology_type_name in (
+        'ReplicaSetWithPrimary', 'Sharded', 'LoadBalanced'
+    )
+
+
+def atomic(callback, kind='adjustment', contra=None, memo=''):
+    """Run ``callback(batch)`` so that all of its balance legs and inserts commit together.
+
+    The legs are journaled as one ``kind`` journal; value that doesn't move
+    between the wallets involved is booked against the ``contra`` system
+    account (``ledger.MARKET`` etc.), and without one it must net to zero.
+    Raises whatever ``callback`` raised after undoing its changes; returns
+    the committed ``BalanceBatch``.
+    """
+    client = Portfolio._get_db().client
+    if supports_transactions(client):
+        def run(session):
+            batch = BalanceBatch(session)  # fresh per attempt: with_transaction may retry
+            callback(batch)
+            batch.post(kind, contra, memo)
+            return batch
+        with client.start_session() as session:
+            batch = session.with_transaction(run)
+    else:
+        batch = BalanceBatch()
+        try:
+            callback(batch)
+            batch.post(kind, contra, memo)
+        except Exception:
+            batch.rollback()
+            raise
+    return batch
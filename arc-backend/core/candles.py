@@ -0,0 +1,110 @@
+"""
+Incrementally maintained OHLCV candles.
+
+Every committed price tick is folded into the current 1m/5m/1h/1d bucket of
+its pair with one upsert per (pair, interval): ``$setOnInsert`` sets the
+open, ``$max``/``$min`` track high/low and ``$set`` moves the close and
+the volume. Ticks carry the pair's rolling 24h volume, not a per-tick
+traded amount, so a candle's volume is that snapshot as of its close
+rather than a sum. All upserts for a tick go out in a single
+unordered bulk_write, so charts read a few hundred pre-aggregated rows
+instead of scanning raw PriceHistory.
+"""
+import logging
+from datetime import datetime, timedelta
+
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError
+
+from .models import Candle
+
+logger = logging.getLogger(__name__)
+
+# interval -> bucket length in seconds
+INTERVALS = {
+    '1m': 60,
+    '5m': 300,
+    '1h': 3600,
+    '1d': 86400,
+}
+
+# How long each interval is kept (None = forever)
+RETENTION = {
+    '1m': timedelta(days=2),
+    '5m': timedelta(days=14),
+    '1h': timedelta(days=180),
+    '1d': None,
+}
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def bucket_start(timestamp, interval):
+    """Start of the ``interval`` bucket containing naive-UTC ``timestamp``."""
+    seconds = INTERVALS[interval]
+    offset = int((timestamp - EPOCH).total_seconds()) // seconds * seconds
+    return EPOCH + timedelta(seconds=offset)
+
+
+def candle_updates(pair_id, price, volume, timestamp):
+    """One upsert per interval folding a single tick into its candles."""
+    updates = []
+    for interval in INTERVALS:
+        start = bucket_start(timestamp, interval)
+        on_insert = {'open': price}
+        if RETENTION[interval] is not None:
+            on_insert['expires_at'] = start + RETENTION[interval]
+        updates.append(UpdateOne(
+            {'pair': pair_id, 'interval': interval, 'start': start},
+            {
+                '$setOnInsert': on_insert,
+                '$max': {'high': price},
+                '$min': {'low': price},
+                '$set': {'close': price, 'volume': volume},
+                '$inc': {'ticks': 1},
+            },
+            upsert=True,
+        ))
+    return updates
+
+
+def record_ticks(pairs):
+    """Fold the latest tick of each TradingPair in ``pairs`` into its candles."""
+    updates = []
+    for pair in pairs:
+        updates.extend(candle_updates(pair.id, pair.current_price, pair.volume_24h, pair.last_updated))
+    if not updates:
+        return
+    try:
+        Candle._get_collection().bulk_write(updates, ordered=False)
+    except PyMongoError as e:
+        # Candles are derived data; a missed tick only loses one sample
+        logger.error('Failed to update candles', extra={'fields': {'pairs': len(pairs), 'error': e}})
+
+
+def current_candles(snapshot, interval='1m'):
+    """The current ``interval`` candle of every pair in a PriceSnapshot (one query)."""
+    names = {pair_id: name for name, pair_id in snapshot.ids.items() if pair_id is not None}
+    starts = list({bucket_start(row['last_updated'], interval) for row in snapshot if row.get('last_updated')})
+    if not names or not starts:
+        return []
+    projection = {'_id': 0, 'pair': 1, 'start': 1, 'open': 1, 'high': 1, 'low': 1, 'close': 1, 'volume': 1}
+    rows = Candle._get_collection().find(
+        {'interval': interval, 'start': {'$in': starts}, 'pair': {'$in': list(names)}}, projection
+    )
+    return [dict(row, pair=names[row['pair']], interval=interval) for row in rows]
+
+
+def get_candles(pair, interval, start=None, end=None, limit=500):
+    """Candles for ``pair`` in [start, end), oldest first, at most ``limit`` (most recent kept)."""
+    query = {'pair': pair.id, 'interval': interval}
+    if start or end:
+        query['start'] = {}
+        if start:
+            query['start']['$gte'] = start
+        if end:
+            query['start']['$lt'] = end
+    projection = {'_id': 0, 'start': 1, 'open': 1, 'high': 1, 'low': 1, 'close': 1, 'volume': 1}
+    rows = list(Candle._get_collection().find(query, projection).sort('start', -1).limit(limit))
+    rows.reverse()
+    return rows
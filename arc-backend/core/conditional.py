@@ -0,0 +1,128 @@
+"""
+Conditional GET support for read endpoints.
+
+Each ``*_etag`` function derives an ETag from a cheap version marker (the
+in-memory price snapshot version, a projected ``updated_at`` / ``version``
+lookup) so ``django.views.decorators.http.condition`` can answer 304 before
+the view loads or serializes anything. They return None when no marker can
+be computed (e.g. missing credentials), which lets the view run as usual.
+
+The same URL can be rendered as JSON or MessagePack, so the decorator folds
+the media type content negotiation will pick into every ETag and adds
+``Vary: Accept``; a validator for one representation never revalidates
+another.
+
+The decorators here wrap the view returned by ``@api_view`` so they see the
+plain Django request and a 304 skips DRF entirely::
+
+    @conditional_get(portfolio_etag, private=True)
+    @api_view(['GET'])
+    def get_portfolio(request): ...
+"""
+import hashlib
+from functools import wraps
+
+from django.conf import settings
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.views.decorators.http import condition
+from rest_framework.exceptions import NotAcceptable
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+
+from .auth import get_request_user
+from .models import MerchantWallet, Portfolio, Transaction
+from .pricing import price_snapshots
+
+
+def make_etag(*parts):
+    return hashlib.md5(':'.join(str(part) for part in parts).encode()).hexdigest()
+
+
+def accepted_media_type(view, request):
+    """The media type DRF's content negotiation will render ``request`` as, or None for a 406."""
+    cls = getattr(view, 'cls', None)
+    renderers = [renderer() for renderer in getattr(cls, 'renderer_classes', api_settings.DEFAULT_RENDERER_CLASSES)]
+    negotiator = getattr(cls, 'content_negotiation_class', api_settings.DEFAULT_CONTENT_NEGOTIATION_CLASS)()
+    try:
+        return negotiator.select_renderer(Request(request), renderers)[1]
+    except NotAcceptable:
+        return None
+
+
+def conditional_get(etag_func, max_age=0, private=False):
+    """ETag/If-None-Match handling plus Cache-Control for a GET endpoint.
+
+    Public responses may be cached by shared caches for ``max_age`` seconds;
+    private ones only by the client, which must revalidate (cheap via 304).
+    Either way the response varies with Accept.
+    """
+    def decorator(view):
+        def negotiated_etag(request, *args, **kwargs):
+            etag = etag_func(request, *args, **kwargs)
+            if etag is None:
+                return None
+            media_type = accepted_media_type(view, request)
+            return None if media_type is None else make_etag(etag, media_type)
+
+        conditional_view = condition(etag_func=negotiated_etag)(view)
+
+        @wraps(view)
+        def wrapped(request, *args, **kwargs):
+            response = conditional_view(request, *args, **kwargs)
+            if request.method in ('GET', 'HEAD') and response.status_code in (200, 304):
+                patch_vary_headers(response, ['Accept'])
+                if private:
+                    patch_cache_control(response, private=True, no_cache=True)
+                    patch_vary_headers(response, ['Authorization'])
+                else:
+                    patch_cache_control(response, public=True, max_age=max_age)
+            return response
+        return wrapped
+    return decorator
+
+
+# Public price data can be cached for one tick
+TICK_MAX_AGE = int(getattr(settings, 'PRICE_TICK_INTERVAL', 5))
+
+
+def market_data_etag(request):
+    return make_etag('market', price_snapshots.get().version)
+
+
+def price_history_etag(request):
+    # Candles and raw ticks only change when a tick lands
+    return make_etag('history', request.GET.urlencode(), price_snapshots.get().version)
+
+
+def portfolio_etag(request):
+    user = get_request_user(request)
+    if user is None:
+        return None
+    doc = Portfolio._get_collection().find_one({'user': user.id}, {'_id': 0, 'updated_at': 1})
+    if not doc:
+        return None
+    # Values depend on prices as well as on the holdings
+    return make_etag('portfolio', user.id, doc.get('updated_at'), price_snapshots.get().version)
+
+
+def merchant_info_etag(request):
+    merchant_name = request.GET.get('merchant_name', 'curve-merchant')
+    doc = MerchantWallet._get_collection().find_one(
+        {'merchant_name': merchant_name}, {'_id': 1, 'version': 1}
+    )
+    if not doc:
+        return None  # legacy lookup through User.merchant_name; let the view resolve it
+    return make_etag('merchant', doc['_id'], doc.get('version', 0))
+
+
+def transactions_etag(request):
+    if request.method != 'GET':
+        return None
+    user = get_request_user(request)
+    if user is None:
+        return None
+    latest = list(Transaction._get_collection().find(
+        {'user': user.id}, {'_id': 1, 'updated_at': 1}
+    ).sort('updated_at', -1).limit(1))
+    marker = (latest[0]['_id'], latest[0].get('updated_at')) if latest else ('empty',)
+    return make_etag('transactions', user.id, request.GET.urlencode(), *marker)
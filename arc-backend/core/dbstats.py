@@ -0,0 +1,89 @@
+"""
+Per-request MongoDB command accounting built on pymongo command monitoring.
+
+The listener is registered on the MongoClient in settings.py. Commands are
+only recorded while a ``track_db_stats()`` block is active on the current
+thread/context, so background work (tickers, management commands) costs
+nothing beyond a context-variable lookup. Reply sizes are only measured
+with ``count_bytes``: that re-encodes every reply to BSON, which is too
+expensive to leave on for every request.
+"""
+import contextvars
+from collections import Counter
+from contextlib import contextmanager
+
+import bson
+from pymongo import monitoring
+
+_current_stats = contextvars.ContextVar('db_stats', default=None)
+
+# Commands issued by the driver itself that say nothing about view behaviour
+IGNORED_COMMANDS = {'hello', 'ismaster', 'isMaster', 'ping', 'endSessions', 'saslStart', 'saslContinue'}
+
+
+class DbStats:
+    """Counters collected for one tracked block (normally one HTTP request)."""
+
+    def __init__(self, count_bytes=False):
+        self.count_bytes = count_bytes
+        self.commands = 0
+        self.failures = 0
+        self.bytes = 0
+        self.time_ms = 0.0
+        self.shapes = Counter()
+
+    def record_start(self, event):
+        self.commands += 1
+        self.shapes[_command_shape(event)] += 1
+
+    def record_end(self, event, reply=None):
+        self.time_ms += event.duration_micros / 1000.0
+        if reply is not None and self.count_bytes:
+            self.bytes += len(bson.encode(reply))
+
+    def repeated_shapes(self, threshold):
+        """Command shapes issued at least ``threshold`` times (likely N+1 loops)."""
+        return [(shape, count) for shape, count in self.shapes.most_common() if count >= threshold]
+
+
+def _command_shape(event):
+    """Group commands by name, collection and filter keys (values ignored)."""
+    command = event.command
+    query = command.get('filter')
+    if query is None:
+        statements = command.get('updates') or command.get('deletes') or ()
+        query = statements[0].get('q', {}) if statements else {}
+    keys = ','.join(sorted(query)) if isinstance(query, dict) else ''
+    return f'{event.command_name} {command.get(event.command_name)} {{{keys}}}'
+
+
+class CommandCounter(monitoring.CommandListener):
+    def started(self, event):
+        stats = _current_stats.get()
+        if stats is not None and event.command_name not in IGNORED_COMMANDS:
+            stats.record_start(event)
+
+    def succeeded(self, event):
+        stats = _current_stats.get()
+        if stats is not None and event.command_name not in IGNORED_COMMANDS:
+            stats.record_end(event, event.reply)
+
+    def failed(self, event):
+        stats = _current_stats.get()
+        if stats is not None and event.command_name not in IGNORED_COMMANDS:
+            stats.failures += 1
+            stats.record_end(event)
+
+
+command_listener = CommandCounter()
+
+
+@contextmanager
+def track_db_stats(count_bytes=False):
+    """Collect Mongo command stats for everything run inside the block."""
+    stats = DbStats(count_bytes)
+    token = _current_stats.set(stats)
+    try:
+        yield stats
+    finally:
+        _current_stats.reset(token)
@@ -0,0 +1,59 @@
+"""
+Chart downsampling for long price-history windows.
+
+Largest-Triangle-Three-Buckets keeps the first and last points and, for each
+of ``threshold - 2`` equal buckets in between, the point forming the largest
+triangle with the previously kept point and the next bucket's average. Peaks
+and troughs survive, so a few hundred points draw the same shape as the full
+series. Downsampled responses are cached per pair/range/resolution in
+``history_cache``.
+"""
+import numpy as np
+from django.conf import settings
+
+from .cache import TTLCache
+
+MAX_POINTS = getattr(settings, 'PRICE_HISTORY_MAX_POINTS', 2000)  # cap on returned points
+MAX_SOURCE = getattr(settings, 'PRICE_HISTORY_MAX_SOURCE', 20000)  # rows read per downsampled request
+CLOSED_RANGE_TTL = getattr(settings, 'PRICE_HISTORY_CLOSED_TTL', 300.0)  # ranges that can no longer change
+
+history_cache = TTLCache(maxsize=512, ttl=getattr(settings, 'PRICE_HISTORY_CACHE_TTL', 5.0))
+
+
+def lttb(x, y, threshold):
+    """Indices of the ``threshold`` points LTTB keeps from the series (x, y)."""
+    n = len(y)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+
+    # threshold - 2 buckets over the interior points 1 .. n-2
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.intp)
+    starts, ends = edges[:-1], edges[1:]
+    counts = ends - starts
+    avg_x = np.add.reduceat(x[1:n - 1], starts - 1) / counts
+    avg_y = np.add.reduceat(y[1:n - 1], starts - 1) / counts
+    # The last bucket looks ahead to the final point
+    next_x = np.append(avg_x[1:], x[-1])
+    next_y = np.append(avg_y[1:], y[-1])
+
+    selected = np.empty(threshold, dtype=np.intp)
+    selected[0], selected[-1] = 0, n - 1
+    a = 0
+    for i in range(threshold - 2):
+        bx = x[starts[i]:ends[i]]
+        by = y[starts[i]:ends[i]]
+        area = np.abs((x[a] - next_x[i]) * (by - y[a]) - (x[a] - bx) * (next_y[i] - y[a]))
+        a = starts[i] + int(np.argmax(area))
+        selected[i + 1] = a
+    return selected
+
+
+def downsample_rows(rows, max_points, time_key, value_key):
+    """Subset of ``rows`` (dicts, oldest first) chosen by LTTB on ``time_key``/``value_key``."""
+    if len(rows) <= max_points:
+        return rows
+    x = np.array([row[time_key] for row in rows], dtype='datetime64[ms]').astype(np.float64)
+    y = np.fromiter((row[value_key] for row in rows), dtype=np.float64, count=len(rows))
+    return [rows[i] for i in lttb(x, y, max_points).tolist()]
@@ -0,0 +1,281 @@
+"""
+External price-history fallback (CoinCap) for pairs without local history.
+
+Upstream calls are kept off the request path wherever possible:
+
+* results are cached per pair in two levels - an in-process TTLCache in
+  front of a store shared by every worker (a Mongo collection by default);
+* entries younger than ``fresh_ttl`` are served as-is, entries up to
+  ``stale_ttl`` old are served immediately while a single background refresh
+  per key runs (stale-while-revalidate);
+* a circuit breaker skips upstream after ``failure_threshold`` consecutive
+  failures and lets one probe through every ``reset_timeout`` seconds;
+* requests go through one pooled ``requests.Session`` with separate
+  connect/read timeouts and no retries, so a miss costs at most
+  ``connect_timeout + read_timeout``.
+"""
+import logging
+import threading
+import time
+from datetime import datetime
+
+import requests
+from django.conf import settings
+from pymongo.errors import PyMongoError
+from requests.adapters import HTTPAdapter
+
+from .cache import TTLCache
+from .models import ExternalPriceHistory
+
+logger = logging.getLogger(__name__)
+
+# Trading pair -> CoinCap asset id
+COINCAP_ASSETS = {
+    'BTCUSDT': 'bitcoin',
+    'ETHUSDT': 'ethereum',
+    'LTCUSDT': 'litecoin',
+    'BCHUSDT': 'bitcoin-cash',
+    'DOGEUSDT': 'dogecoin',
+    'BNBUSDT': 'binance-coin',
+    'ADAUSDT': 'cardano',
+    'DOTUSDT': 'polkadot',
+    'LINKUSDT': 'chainlink',
+    'ARCUSDT': 'arc'  # If listed on CoinCap
+}
+
+
+class UpstreamError(Exception):
+    """The external provider could not be reached or returned an unusable response."""
+
+
+class CircuitBreaker:
+    """Consecutive-failure breaker: closed -> open -> half-open (one probe) -> closed."""
+
+    def __init__(self, failure_threshold=3, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at < self.reset_timeout:
+            return 'open'
+        return 'half_open'
+
+    def allow(self):
+        """Whether a call may go upstream now."""
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at < self.reset_timeout or self._probing:
+                return False
+            self._probing = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._probing or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self._probing = False
+
+
+class CoinCapClient:
+    def __init__(self, base_url, api_key='', connect_timeout=2.0, read_timeout=3.0, pool_size=4):
+        self.base_url = base_url.rstrip('/')
+        self.api_key = api_key
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def fetch_history(self, asset, interval='h1', limit=100):
+        """Last ``limit`` points of ``asset`` as ``[{timestamp, price, volume}, ...]``."""
+        params = {'interval': interval}
+        if self.api_key:
+            params['apiKey'] = self.api_key
+        try:
+            resp = self.session.get(f'{self.base_url}/assets/{asset}/history', params=params, timeout=self.timeout)
+            resp.raise_for_status()
+            rows = resp.json()['data']
+            # rows: [{priceUsd, time, ...}, ...]; a malformed row fails the fetch like a bad response
+            return [
+                {
+                    'timestamp': datetime.utcfromtimestamp(int(row['time']) // 1000).strftime('%Y-%m-%d %H:%M'),
+                    'price': float(row['priceUsd']),
+                    'volume': None
+                }
+                for row in rows[-limit:]
+            ]
+        except requests.RequestException as e:
+            raise UpstreamError(str(e)) from e
+        except (ValueError, TypeError, KeyError, OverflowError, OSError) as e:
+            raise UpstreamError(f'Malformed history payload: {e!r}') from e
+
+
+class MemoryHistoryStore:
+    """Process-local store; mainly for tests and single-process deployments."""
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            return self._data.get(key)
+
+    def set(self, key, history, fetched_at, expires_at):
+        with self._lock:
+            self._data[key] = (history, fetched_at)
+
+
+class MongoHistoryStore:
+    """Store shared by every worker, backed by the ExternalPriceHistory collection."""
+
+    def get(self, key):
+        try:
+            doc = ExternalPriceHistory._get_collection().find_one(
+                {'key': key}, {'_id': 0, 'history': 1, 'fetched_at': 1}
+            )
+        except PyMongoError as e:
+            logger.warning('External history store read failed', extra={'fields': {'key': key, 'error': e}})
+            return None
+        if not doc:
+            return None
+        return doc['history'], (doc['fetched_at'] - datetime(1970, 1, 1)).total_seconds()
+
+    def set(self, key, history, fetched_at, expires_at):
+        try:
+            ExternalPriceHistory._get_collection().update_one(
+                {'key': key},
+                {'$set': {
+                    'history': history,
+                    'fetched_at': datetime.utcfromtimestamp(fetched_at),
+                    'expires_at': datetime.utcfromtimestamp(expires_at),
+                }},
+                upsert=True,
+            )
+        except PyMongoError as e:
+            logger.warning('External history store write failed', extra={'fields': {'key': key, 'error': e}})
+
+
+class HistoryFallback:
+    def __init__(self, client, store, fresh_ttl=300.0, stale_ttl=3600.0, breaker=None, assets=COINCAP_ASSETS):
+        self.client = client
+        self.store = store
+        self.fresh_ttl = fresh_ttl
+        self.stale_ttl = stale_ttl
+        self.breaker = breaker or CircuitBreaker()
+        self.assets = assets
+        self.local = TTLCache(maxsize=256, ttl=stale_ttl)  # key -> (history, fetched_at)
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def get(self, pair_name):
+        """Cached history for ``pair_name``; None when unknown or unavailable."""
+        asset = self.assets.get(pair_name)
+        if not asset:
+            return None
+        key = f'coincap:{pair_name}'
+
+        entry = self.local.get(key)
+        if entry is None:
+            entry = self.store.get(key)
+            if entry is not None:
+                self.local.set(key, entry)
+        if entry is not None:
+            history, fetched_at = entry
+            age = time.time() - fetched_at
+            if age < self.fresh_ttl:
+                return history
+            if age < self.stale_ttl:
+                self._refresh_async(key, asset)
+                return history
+        return self._refresh_now(key, asset)
+
+    def _begin(self, key):
+        """Register a refresh of ``key``; returns ``(event, is_leader)``."""
+        with self._lock:
+            event = self._inflight.get(key)
+            if event is not None:
+                return event, False
+            event = self._inflight[key] = threading.Event()
+            return event, True
+
+    def _run_refresh(self, key, asset, event):
+        try:
+            return self._fetch(key, asset)
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            event.set()
+
+    def _refresh_async(self, key, asset):
+        event, leader = self._begin(key)
+        if leader:
+            threading.Thread(target=self._run_refresh, args=(key, asset, event), daemon=True).start()
+
+    def _refresh_now(self, key, asset):
+        event, leader = self._begin(key)
+        if leader:
+            return self._run_refresh(key, asset, event)
+        # Another request is already fetching this key; share its result
+        event.wait(sum(self.client.timeout))
+        entry = self.local.get(key)
+        return entry[0] if entry else None
+
+    def _fetch(self, key, asset):
+        # Another worker may have refreshed the shared entry in the meantime
+        entry = self.store.get(key)
+        if entry is not None and time.time() - entry[1] < self.fresh_ttl:
+            self.local.set(key, entry)
+            return entry[0]
+
+        if not self.breaker.allow():
+            logger.debug('External history skipped, circuit open', extra={'fields': {'key': key}})
+            return None
+        try:
+            history = self.client.fetch_history(asset)
+        except UpstreamError as e:
+            self.breaker.record_failure()
+            logger.warning('External history fetch failed', extra={'fields': {
+                'key': key, 'error': e, 'breaker': self.breaker.state,
+            }})
+            return None
+        self.breaker.record_success()
+
+        fetched_at = time.time()
+        self.local.set(key, (history, fetched_at))
+        self.store.set(key, history, fetched_at, fetched_at + self.stale_ttl)
+        logger.info('External history refreshed', extra={'fields': {'key': key, 'count': len(history)}})
+        return history
+
+
+coincap_history = HistoryFallback(
+    CoinCapClient(
+        getattr(settings, 'COINCAP_BASE_URL', 'https://rest.coincap.io/v3'),
+        api_key=getattr(settings, 'COINCAP_API_KEY', ''),
+        connect_timeout=getattr(settings, 'COINCAP_CONNECT_TIMEOUT', 2.0),
+        read_timeout=getattr(settings, 'COINCAP_READ_TIMEOUT', 3.0),
+        pool_size=getattr(settings, 'COINCAP_POOL_SIZE', 4),
+    ),
+    MongoHistoryStore(),
+    fresh_ttl=getattr(settings, 'COINCAP_FRESH_TTL', 300.0),
+    stale_ttl=getattr(settings, 'COINCAP_STALE_TTL', 3600.0),
+    breaker=CircuitBreaker(
+        failure_threshold=getattr(settings, 'COINCAP_BREAKER_THRESHOLD', 3),
+        reset_timeout=getattr(settings, 'COINCAP_BREAKER_RESET', 30.0),
+    ),
+)
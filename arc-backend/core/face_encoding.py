@@ -0,0 +1,77 @@
+"""
+Face encoding work executed inside the face pool processes.
+
+Kept free of Django imports so spawned pool workers can import it without
+configuring settings or opening database connections.
+
+Uploads are pre-processed before dlib sees them: the header is checked
+before any pixel data is decoded, JPEGs are decoded straight at a reduced
+scale (``Image.draft``), and detection runs on a thumbnail no larger than
+``max_dimension``. Only the crop around the detected face is passed to the
+encoder, with its location supplied so detection doesn't run twice.
+"""
+import io
+
+import numpy as np
+from PIL import Image, ImageOps
+
+DEFAULT_MAX_DIMENSION = 640
+DEFAULT_MAX_PIXELS = 40_000_000
+CROP_MARGIN = 0.25  # context kept around the face box for landmark fitting
+
+
+class ImageRejected(ValueError):
+    """The upload can't be used for face encoding (too large, unreadable, ...)."""
+
+
+def load_thumbnail(image_bytes, max_dimension=DEFAULT_MAX_DIMENSION, max_pixels=DEFAULT_MAX_PIXELS):
+    """Decode ``image_bytes`` into an RGB array no larger than ``max_dimension`` on either side."""
+    try:
+        image = Image.open(io.BytesIO(image_bytes))  # reads the header only
+    except Exception:
+        raise ImageRejected('Unsupported or corrupt image.')
+
+    width, height = image.size
+    if width * height > max_pixels:
+        raise ImageRejected(f'Image is too large ({width}x{height}).')
+
+    # JPEG: let the decoder downscale by 1/2, 1/4 or 1/8 while decoding
+    image.draft('RGB', (max_dimension, max_dimension))
+    image = ImageOps.exif_transpose(image).convert('RGB')
+    image.thumbnail((max_dimension, max_dimension))
+    return np.asarray(image)
+
+
+def crop_face(image, location, margin=CROP_MARGIN):
+    """Crop ``image`` around a (top, right, bottom, left) box; returns the crop and the box within it."""
+    top, right, bottom, left = location
+    pad_y = int((bottom - top) * margin)
+    pad_x = int((right - left) * margin)
+    y0, x0 = max(0, top - pad_y), max(0, left - pad_x)
+    y1, x1 = min(image.shape[0], bottom + pad_y), min(image.shape[1], right + pad_x)
+    crop = np.ascontiguousarray(image[y0:y1, x0:x1])
+    return crop, (top - y0, right - x0, bottom - y0, left - x0)
+
+
+def encode_face(image_bytes, max_dimension=DEFAULT_MAX_DIMENSION, max_pixels=DEFAULT_MAX_PIXELS, model='hog', upsample=1):
+    """First (largest) face encoding found in ``image_bytes`` as raw float64 bytes, or None."""
+    import face_recognition
+
+    image = load_thumbnail(image_bytes, max_dimension, max_pixels)
+    locations = face_recognition.face_locations(image, number_of_times_to_upsample=upsample, model=model)
+    if not locations:
+        return None
+
+    largest = max(locations, key=lambda box: (box[2] - box[0]) * (box[1] - box[3]))
+    crop, box = crop_face(image, largest)
+    encodings = face_recognition.face_encodings(crop, known_face_locations=[box])
+    return encodings[0].tobytes() if encodings else None
+
+
+def encode_face_full_resolution(image_bytes):
+    """The original pipeline (full-size decode, detection inside face_encodings); used for benchmarks."""
+    import face_recognition
+
+    image = face_recognition.load_image_file(io.BytesIO(image_bytes))
+    encodings = face_recognition.face_encodings(image)
+    return encodings[0].tobytes() if encodings else None
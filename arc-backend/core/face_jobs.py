@@ -0,0 +1,156 @@
+"""
+Face encoding off the request threads.
+
+dlib HOG detection and the 128-d encoding take hundreds of milliseconds of
+CPU per image, so they run in a small, separate process pool with its own
+concurrency limit. Callers submit the raw upload bytes and either return a
+job id straight away (registration) or wait on the job with a timeout
+(face authentication). When the pending-job limit is reached submissions
+are rejected with FacePoolBusy instead of queueing behind trading traffic.
+"""
+import logging
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+
+from django.conf import settings
+
+from .cache import TTLCache
+from .face_encoding import encode_face, ImageRejected
+
+logger = logging.getLogger(__name__)
+
+
+class FacePoolBusy(Exception):
+    """Raised when the face pool already has its maximum number of pending jobs."""
+
+
+class FaceJobPool:
+    def __init__(self, max_workers=2, max_pending=16, job_ttl=3600, encode_options=None):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.encode_options = encode_options or {}
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._jobs = TTLCache(maxsize=10000, ttl=job_ttl)
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._counters = {'submitted': 0, 'completed': 0, 'no_face': 0, 'invalid': 0, 'failed': 0, 'rejected': 0}
+        self._pending = 0
+        self._encode_ms_total = 0.0
+
+    def _get_executor(self):
+        # Created lazily (and per process) so gunicorn workers don't share a pool
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._executor = ProcessPoolExecutor(
+                        max_workers=self.max_workers,
+                        mp_context=multiprocessing.get_context('spawn'),
+                    )
+                    self._pid = os.getpid()
+        return self._executor
+
+    def submit(self, image_bytes, on_success=None):
+        """
+        Queue ``image_bytes`` for encoding and return the job id.
+
+        ``on_success(encoding_bytes)`` runs once a face has been encoded,
+        e.g. to persist FaceData. Raises FacePoolBusy when the pool is full.
+        """
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._counters['rejected'] += 1
+            raise FacePoolBusy('Face processing queue is full')
+
+        job_id = uuid.uuid4().hex
+        job = {'id': job_id, 'status': 'pending', 'error': None, 'submitted_at': time.time(), 'finished_at': None}
+        self._jobs.set(job_id, job)
+        with self._lock:
+            self._counters['submitted'] += 1
+            self._pending += 1
+
+        try:
+            future = self._get_executor().submit(encode_face, image_bytes, **self.encode_options)
+        except Exception:
+            self._finish(job, 'failed', 'Face pool unavailable')
+            raise
+        job['future'] = future
+        future.add_done_callback(lambda f: self._on_done(job, f, on_success))
+        return job_id
+
+    def _on_done(self, job, future, on_success):
+        try:
+            encoding = future.result()
+            if encoding is None:
+                self._finish(job, 'no_face', 'No face found in image.')
+                return
+            if on_success is not None:
+                on_success(encoding)
+            self._finish(job, 'ready')
+        except ImageRejected as e:
+            self._finish(job, 'invalid', str(e))
+        except Exception as e:
+            logger.exception('Face encoding job failed', extra={'fields': {'job_id': job['id']}})
+            self._finish(job, 'failed', str(e))
+
+    def _finish(self, job, status, error=None):
+        job['status'] = status
+        job['error'] = error
+        job['finished_at'] = time.time()
+        with self._lock:
+            self._counters['completed' if status == 'ready' else status] += 1
+            self._pending -= 1
+            self._encode_ms_total += (job['finished_at'] - job['submitted_at']) * 1000
+        self._slots.release()
+
+    def wait(self, job_id, timeout):
+        """Block until the job finishes; return its encoding bytes or None (no face)."""
+        job = self._jobs.get(job_id)
+        if job is None:
+            raise KeyError(job_id)
+        try:
+            return job['future'].result(timeout=timeout)
+        except FutureTimeout:
+            raise TimeoutError(f'Face job {job_id} did not finish within {timeout}s')
+
+    def status(self, job_id):
+        job = self._jobs.get(job_id)
+        if job is None:
+            return None
+        return {key: job[key] for key in ('id', 'status', 'error', 'submitted_at', 'finished_at')}
+
+    def stats(self):
+        with self._lock:
+            finished = sum(self._counters[key] for key in ('completed', 'no_face', 'invalid', 'failed'))
+            return {
+                'workers': self.max_workers,
+                'max_pending': self.max_pending,
+                'pending': self._pending,
+                'queued': max(0, self._pending - self.max_workers),
+                'avg_job_ms': round(self._encode_ms_total / finished, 1) if finished else None,
+                **self._counters,
+            }
+
+
+face_pool = FaceJobPool(
+    max_workers=getattr(settings, 'FACE_POOL_WORKERS', 2),
+    max_pending=getattr(settings, 'FACE_POOL_MAX_PENDING', 16),
+    encode_options={
+        'max_dimension': getattr(settings, 'FACE_MAX_DIMENSION', 640),
+        'max_pixels': getattr(settings, 'FACE_MAX_PIXELS', 40_000_000),
+        'model': getattr(settings, 'FACE_DETECTOR_MODEL', 'hog'),
+        'upsample': getattr(settings, 'FACE_DETECTOR_UPSAMPLE', 1),
+    },
+)
+
+
+def check_upload(image_file):
+    """Reject uploads over FACE_MAX_UPLOAD_BYTES before reading them; returns an error or None."""
+    limit = getattr(settings, 'FACE_MAX_UPLOAD_BYTES', 8 * 1024 * 1024)
+    if image_file.size > limit:
+        return f'Image exceeds the {limit // (1024 * 1024)} MB upload limit.'
+    return None
@@ -0,0 +1,215 @@
+"""
+Append-only double-entry ledger of every balance change.
+
+The ledger is the record of truth for balances. ``CryptoWallet.balance`` is
+a materialized copy of it, changed in the same ``atomic`` unit as the
+journal (core.balances): a debit has to be guarded by one conditional update
+on the wallet rather than by summing entries, so requests read that copy.
+``manage.py ledger_audit`` reports where the copy has drifted and
+``--repair`` resets it to the ledger.
+
+Every ``atomic`` unit posts one journal: an entry per (account, symbol) it
+changed, plus a contra entry against a system account for value entering
+or leaving user wallets, so the entries of a journal always sum to zero per
+symbol. Entries are only ever inserted; undoing a posted journal posts a
+reversing one.
+
+Accounts are strings: ``portfolio:<user id>``, ``merchant:<merchant wallet id>``
+and the system accounts below.
+
+Reading a balance never replays history. Every ``SNAPSHOT_EVERY`` entries a
+wallet's running balance is checkpointed into a BalanceSnapshot, and the
+balance is that snapshot plus the entries after it, read from the
+``(account, symbol, seq)`` index. Entries are numbered from one global
+counter, so an entry can become visible after a later-numbered one (its
+transaction committed later). Only entries older than ``SETTLE_SECONDS`` are
+folded into a snapshot, which is longer than MongoDB lets a transaction
+run (60s), so no entry can land behind a snapshot.
+"""
+import logging
+import math
+import uuid
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from mongoengine import signals
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from .models import BalanceSnapshot, LedgerCounter, LedgerEntry, MerchantWallet, Portfolio
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_EVERY = getattr(settings, 'LEDGER_SNAPSHOT_EVERY', 100)
+SETTLE_SECONDS = getattr(settings, 'LEDGER_SETTLE_SECONDS', 120)
+
+# System accounts: the other side of value entering or leaving user wallets
+GENESIS = 'system:genesis'  # opening balances of new wallets
+MARKET = 'system:market'  # the house: market orders, buy/sell
+EXTERNAL = 'system:external'  # sends to (and refunds from) addresses outside the platform
+ORDER_ESCROW = 'system:orders'  # funds held by resting limit orders
+SYSTEM_ACCOUNTS = (GENESIS, MARKET, EXTERNAL, ORDER_ESCROW)
+
+TAIL_PROJECTION = {'_id': 0, 'symbol': 1, 'amount': 1, 'seq': 1, 'created_at': 1}
+
+
+class LedgerImbalance(ValueError):
+    pass
+
+
+def account_key(model, owner_id):
+    return f'{"merchant" if model is MerchantWallet else "portfolio"}:{owner_id}'
+
+
+def _negligible(total, legs):
+    # Float sums of legs that should cancel (e.g. many payout credits vs one debit)
+    return math.isclose(total, 0.0, abs_tol=1e-9 * max([1.0] + [abs(amount) for amount in legs]))
+
+
+def journal(legs, kind, contra=None, memo=''):
+    """Unnumbered entries for ``{(account, symbol): amount}``.
+
+    Whatever doesn't net to zero per symbol is booked against ``contra``;
+    without one an imbalance raises LedgerImbalance.
+    """
+    legs = {key: amount for key, amount in legs.items() if amount}
+    by_symbol = defaultdict(list)
+    for (account, symbol), amount in legs.items():
+        by_symbol[symbol].append(amount)
+    for symbol, amounts in by_symbol.items():
+        total = sum(amounts)
+        if _negligible(total, amounts):
+            continue
+        if contra is None:
+            raise LedgerImbalance(f'{kind} journal does not balance: {symbol} {total:+}')
+        legs[(contra, symbol)] = legs.get((contra, symbol), 0.0) - total
+
+    journal_id = uuid.uuid4().hex
+    now = datetime.utcnow()
+    return [
+        {'journal': journal_id, 'kind': kind, 'account': account, 'symbol': symbol,
+         'amount': amount, 'memo': memo[:500], 'created_at': now}
+        for (account, symbol), amount in legs.items() if amount
+    ]
+
+
+def _reserve(count):
+    # Outside any session: a transaction holding the counter would serialize every
+    # writer behind it. An aborted transaction only leaves a gap in the numbering.
+    doc = LedgerCounter._get_collection().find_one_and_update(
+        {'_id': 'entries'}, {'$inc': {'seq': count}}, upsert=True, return_document=ReturnDocument.AFTER
+    )
+    return doc['seq'] - count + 1
+
+
+def post(entries, session=None):
+    """Number and insert ``entries`` (from ``journal``) with one ``insert_many``."""
+    if not entries:
+        return entries
+    first = _reserve(len(entries))
+    for offset, entry in enumerate(entries):
+        entry['seq'] = first + offset
+    LedgerEntry._get_collection().insert_many(entries, ordered=True, session=session)
+    return entries
+
+
+def post_journal(legs, kind, contra=None, memo='', session=None):
+    return post(journal(legs, kind, contra, memo), session=session)
+
+
+def reverse(entries, session=None):
+    """Post the journal that cancels already posted ``entries``."""
+    legs = defaultdict(float)
+    for entry in entries:
+        legs[(entry['account'], entry['symbol'])] -= entry['amount']
+    journals = sorted({entry['journal'] for entry in entries})
+    return post_journal(legs, 'reversal', memo=f'Reversal of {", ".join(journals)}', session=session)
+
+
+def _latest_snapshots(account, symbols=None):
+    match = {'account': account}
+    if symbols:
+        match['symbol'] = {'$in': list(symbols)}
+    return {
+        row['_id']: row for row in BalanceSnapshot._get_collection().aggregate([
+            {'$match': match},
+            {'$sort': {'account': 1, 'symbol': 1, 'seq': -1}},
+            {'$group': {'_id': '$symbol', 'seq': {'$first': '$seq'}, 'balance': {'$first': '$balance'},
+                        'entries': {'$first': '$entries'}}},
+        ])
+    }
+
+
+def _checkpoint(account, symbol, snapshot, tail, cutoff):
+    """Fold the settled prefix of ``tail`` into a new snapshot once it is SNAPSHOT_EVERY long."""
+    settled = []
+    for entry in tail:
+        if entry['created_at'] > cutoff:
+            break
+        settled.append(entry)
+    if len(settled) < SNAPSHOT_EVERY:
+        return
+    try:
+        BalanceSnapshot._get_collection().insert_one({
+            'account': account,
+            'symbol': symbol,
+            'seq': settled[-1]['seq'],
+            'balance': (snapshot['balance'] if snapshot else 0.0) + sum(entry['amount'] for entry in settled),
+            'entries': (snapshot['entries'] if snapshot else 0) + len(settled),
+            'created_at': datetime.utcnow(),
+        })
+    except DuplicateKeyError:
+        pass  # a concurrent reader wrote the same snapshot
+
+
+def balances(account, symbols=None):
+    """``{symbol: balance}`` of a ledger account: latest snapshot + tail per symbol.
+
+    Tails that have grown past SNAPSHOT_EVERY settled entries are
+    checkpointed on the way, so the next read is short again.
+    """
+    snapshots = _latest_snapshots(account, symbols)
+    branches = [{'symbol': symbol, 'seq': {'$gt': snapshot['seq']}} for symbol, snapshot in snapshots.items()]
+    unsnapshotted = {'$in': [s for s in symbols if s not in snapshots]} if symbols else {'$nin': list(snapshots)}
+    branches.append({'symbol': unsnapshotted})
+
+    tails = defaultdict(list)
+    for entry in LedgerEntry._get_collection().find(
+        {'account': account, '$or': branches}, TAIL_PROJECTION
+    ).sort('seq', 1):
+        tails[entry['symbol']].append(entry)
+
+    cutoff = datetime.utcnow() - timedelta(seconds=SETTLE_SECONDS)
+    result = {symbol: snapshot['balance'] for symbol, snapshot in snapshots.items()}
+    for symbol, tail in tails.items():
+        result[symbol] = result.get(symbol, 0.0) + sum(entry['amount'] for entry in tail)
+        if len(tail) >= SNAPSHOT_EVERY:
+            _checkpoint(account, symbol, snapshots.get(symbol), tail, cutoff)
+    return result
+
+
+def balance(account, symbol):
+    return balances(account, [symbol]).get(symbol, 0.0)
+
+
+def _on_wallets_created(sender, document, created=False, **kwargs):
+    """Book the balances a Portfolio/MerchantWallet is created with as opening entries."""
+    if not created:
+        return
+    owner_id = document.to_mongo().get('user') if sender is Portfolio else document.id
+    legs = {
+        (account_key(sender, owner_id), wallet.symbol): wallet.balance
+        for wallet in document.wallets if wallet.balance
+    }
+    try:
+        post_journal(legs, 'opening', contra=GENESIS)
+    except Exception:
+        # The wallet exists either way; ledger_audit --open-missing books it later
+        logger.exception('Failed to post opening balances', extra={'fields': {
+            'model': sender.__name__, 'owner_id': owner_id,
+        }})
+
+
+signals.post_save.connect(_on_wallets_created, sender=Portfolio)
+signals.post_save.connect(_on_wallets_created, sender=MerchantWallet)
@@ -0,0 +1,115 @@
+"""
+Non-blocking, sampled logging for request-path code.
+
+Request threads only run the sampling filter and enqueue the record; message
+formatting and the stdout write happen on a single background listener
+thread. Wired up through ``LOGGING`` in settings.py::
+
+    logger = logging.getLogger(__name__)
+    logger.info('Order placed', extra={'fields': {'user_id': uid, 'pair': 'BTCUSDT'}})
+"""
+import logging
+import os
+import queue
+import random
+import sys
+import threading
+from logging.handlers import QueueListener
+
+from django.conf import settings
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keep a fraction of records per logger, as configured in settings.LOG_SAMPLE_RATES.
+
+    Rates are looked up by the longest matching logger-name prefix
+    (``{'core.request': 0.1}`` also covers ``core.request.slow``). Records at
+    WARNING and above are never dropped.
+    """
+
+    def __init__(self, rates=None):
+        super().__init__()
+        self.rates = rates if rates is not None else getattr(settings, 'LOG_SAMPLE_RATES', {})
+        self._resolved = {}
+
+    def rate_for(self, name):
+        rate = self._resolved.get(name)
+        if rate is None:
+            rate = 1.0
+            prefix = name
+            while prefix:
+                if prefix in self.rates:
+                    rate = self.rates[prefix]
+                    break
+                prefix = prefix.rpartition('.')[0]
+            self._resolved[name] = rate
+        return rate
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rate_for(record.name)
+        return rate >= 1.0 or random.random() < rate
+
+
+class StructuredFormatter(logging.Formatter):
+    """Append ``extra={'fields': {...}}`` to the message as key=value pairs."""
+
+    def __init__(self, fmt='%(asctime)s %(levelname)s %(name)s %(message)s', datefmt=None):
+        super().__init__(fmt, datefmt)
+
+    def format(self, record):
+        line = super().format(record)
+        fields = getattr(record, 'fields', None)
+        if fields:
+            line += ' ' + ' '.join(f'{key}={value}' for key, value in fields.items())
+        return line
+
+
+class QueueLogHandler(logging.Handler):
+    """
+    Hand records to a bounded queue drained by a background QueueListener.
+
+    Unlike logging.handlers.QueueHandler the record is not formatted on the
+    calling thread. When the queue is full the record is dropped and counted
+    rather than blocking the request.
+    """
+
+    def __init__(self, maxsize=10000, stream=None):
+        super().__init__()
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.target = logging.StreamHandler(stream or sys.stdout)
+        self.dropped = 0
+        self._listener = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def setFormatter(self, fmt):
+        super().setFormatter(fmt)
+        self.target.setFormatter(fmt)
+
+    def _ensure_listener(self):
+        # Started lazily so each gunicorn worker gets its own thread after fork
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._listener = QueueListener(self.queue, self.target, respect_handler_level=False)
+            self._listener.start()
+            self._pid = os.getpid()
+
+    def emit(self, record):
+        self._ensure_listener()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        # Called by logging.shutdown() at exit; flushes whatever is still queued
+        if self._listener is not None and self._pid == os.getpid():
+            self._listener.stop()
+            self._pid = None
+        super().close()
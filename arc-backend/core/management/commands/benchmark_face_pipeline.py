@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand
+from core.face_encoding import encode_face, encode_face_full_resolution
+from core.face_jobs import face_pool
+import time
+
+class Command(BaseCommand):
+    help = 'Compare face encoding throughput of the full-resolution and pre-processed pipelines'
+
+    def add_arguments(self, parser):
+        parser.add_argument('images', nargs='+', help='Image files to encode (e.g. phone photos)')
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            default=3,
+            help='Passes over the image set per pipeline (default: 3)',
+        )
+
+    def handle(self, *args, **options):
+        images = []
+        for path in options['images']:
+            with open(path, 'rb') as f:
+                images.append(f.read())
+
+        encode_options = face_pool.encode_options
+        self.stdout.write(f'{len(images)} images x {options["repeat"]} passes, options: {encode_options}\n')
+
+        pipelines = [
+            ('full resolution (before)', encode_face_full_resolution, {}),
+            ('pre-processed (after)', encode_face, encode_options),
+        ]
+        for label, func, kwargs in pipelines:
+            found = 0
+            started = time.perf_counter()
+            for _ in range(options['repeat']):
+                for image_bytes in images:
+                    if func(image_bytes, **kwargs) is not None:
+                        found += 1
+            elapsed = time.perf_counter() - started
+            total = len(images) * options['repeat']
+            self.stdout.write(
+                f'  {label:<26} {total / elapsed:8.2f} images/s  '
+                f'({elapsed / total * 1000:.1f} ms/image, faces found {found}/{total})'
+            )
@@ -0,0 +1,62 @@
+from django.core.management.base import BaseCommand, CommandError
+from core.models import User, Portfolio, CryptoWallet, Trade, Transaction
+from core.ledger import GENESIS, account_key, balances, post_journal
+from core.pricing import price_snapshots
+from core.utils import execute_market_order
+import numpy as np
+import uuid
+
+STAGES = ('price', 'balances', 'records', 'commit', 'total')
+
+class Command(BaseCommand):
+    help = 'Measure market order latency per pipeline stage against the configured MongoDB (creates and removes a throwaway user)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--orders', type=int, default=1000, help='Market orders to execute (default: 1000)')
+        parser.add_argument('--pair', default='BTCUSDT', help='Trading pair (default: BTCUSDT)')
+        parser.add_argument('--quantity', type=float, default=0.0001, help='Base quantity per order (default: 0.0001)')
+
+    def handle(self, *args, **options):
+        pair = options['pair']
+        row = price_snapshots.get().get(pair)
+        if not row or row['current_price'] <= 0:
+            raise CommandError(f'{pair} has no price; run init_crypto_system first')
+
+        name = f'bench_{uuid.uuid4().hex[:8]}'
+        user = User(username=name, email=f'{name}@bench.local', password='-').save()
+        Portfolio(user=user, wallets=[
+            CryptoWallet(symbol=row['quote_symbol'], name=row['quote_symbol'], public_key='-', private_key='[]', balance=1e12),
+            CryptoWallet(symbol=row['base_symbol'], name=row['base_symbol'], public_key='-', private_key='[]', balance=1e6),
+        ]).save()
+
+        samples = {stage: [] for stage in STAGES}
+        failures = 0
+        try:
+            for i in range(options['orders']):
+                timings = {}
+                success, message = execute_market_order(user, pair, 'buy' if i % 2 else 'sell', options['quantity'], timings=timings)
+                if not success:
+                    failures += 1
+                    continue
+                for stage in STAGES:
+                    samples[stage].append(timings.get(stage, 0.0))
+        finally:
+            Trade.objects(buyer=user).delete()
+            Transaction.objects(user=user).delete()
+            # Close the wallets in the ledger so the audit still sums to zero without them
+            account = account_key(Portfolio, user.id)
+            post_journal({(account, symbol): -amount for symbol, amount in balances(account).items()},
+                         'closing', contra=GENESIS, memo=f'Benchmark user {name} removed')
+            Portfolio.objects(user=user).delete()
+            user.delete()
+
+        executed = len(samples['total'])
+        self.stdout.write(f'{executed} market orders on {pair} ({failures} failed)')
+        if not executed:
+            return
+        for stage in STAGES:
+            values = np.array(samples[stage])
+            self.stdout.write(
+                f'  {stage:<9} p50 {np.percentile(values, 50):7.3f} ms  p95 {np.percentile(values, 95):7.3f} ms  '
+                f'p99 {np.percentile(values, 99):7.3f} ms'
+            )
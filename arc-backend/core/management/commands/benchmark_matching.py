@@ -0,0 +1,60 @@
+from django.core.management.base import BaseCommand, CommandError
+from core.matching import OrderBook, RestingOrder
+import random
+import time
+
+class Command(BaseCommand):
+    help = 'Measure in-memory order book throughput (place/match/cancel, no database access)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--operations', type=int, default=200000, help='Order operations per run (default: 200000)')
+        parser.add_argument('--cancel-ratio', type=float, default=0.3, help='Share of operations that cancel a resting order (default: 0.3)')
+        parser.add_argument('--spread', type=int, default=50, help='Price levels on each side of the mid (default: 50)')
+        parser.add_argument('--users', type=int, default=100, help='Distinct users placing orders (default: 100)')
+        parser.add_argument('--seed', type=int, default=42, help='Random seed (default: 42)')
+
+    def handle(self, *args, **options):
+        operations = options['operations']
+        rng = random.Random(options['seed'])
+        mid = 1000.0
+        spread = options['spread']
+        # Distinct users, or self-trade prevention would cancel every marketable order
+        users = max(options['users'], 2)
+
+        # Pre-generate the workload so only the book is timed
+        workload = []
+        for i in range(operations):
+            if rng.random() < options['cancel_ratio']:
+                workload.append(None)
+                continue
+            side = 'buy' if rng.random() < 0.5 else 'sell'
+            # Mostly passive orders, some marketable ones crossing the mid
+            offset = rng.randint(-5, spread)
+            price = mid - offset if side == 'buy' else mid + offset
+            workload.append(RestingOrder(f'O{i}', f'bench{rng.randrange(users)}', side, price, rng.choice((0.1, 0.5, 1.0, 2.0))))
+
+        book = OrderBook()
+        fills = placed = cancelled = 0
+        resting = []
+        started = time.perf_counter()
+        for entry in workload:
+            if entry is None:
+                if resting:
+                    index = rng.randrange(len(resting))
+                    resting[index], resting[-1] = resting[-1], resting[index]
+                    if book.cancel(resting.pop()) is not None:
+                        cancelled += 1
+                continue
+            fills += len(book.add(entry))
+            placed += 1
+            if entry.order_id in book.orders:
+                resting.append(entry.order_id)
+        elapsed = time.perf_counter() - started
+        if not fills:
+            raise CommandError('No fills: the workload never matched, so the timing would not measure matching')
+
+        self.stdout.write(
+            f'{operations} operations in {elapsed * 1000:.1f} ms: {operations / elapsed:,.0f} ops/s\n'
+            f'  placed {placed}, cancelled {cancelled}, fills {fills}, resting {len(book)} '
+            f'({len(book.bids.levels)} bid / {len(book.asks.levels)} ask levels)'
+        )
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+from core.simulation import PriceEngine, MODELS
+import numpy as np
+import time
+
+class Command(BaseCommand):
+    help = 'Measure vectorized price simulation throughput (no database access)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--pairs', type=int, default=10000, help='Number of simulated pairs (default: 10000)')
+        parser.add_argument('--ticks', type=int, default=200, help='Ticks per model (default: 200)')
+        parser.add_argument('--correlation', type=float, default=0.3, help='Market factor correlation (default: 0.3)')
+        parser.add_argument('--seed', type=int, default=42, help='Generator seed (default: 42)')
+
+    def handle(self, *args, **options):
+        pairs = options['pairs']
+        ticks = options['ticks']
+        rng = np.random.default_rng(options['seed'])
+        names = [f'P{i}USDT' for i in range(pairs)]
+        base_prices = rng.uniform(0.1, 50000, pairs)
+        volatilities = rng.uniform(0.01, 0.05, pairs)
+
+        self.stdout.write(f'{pairs} pairs, {ticks} ticks per run\n')
+        for model in MODELS:
+            for correlation in (0.0, options['correlation']):
+                engine = PriceEngine(model=model, correlation=correlation, seed=options['seed'])
+                engine.add_pairs(names, base_prices, volatilities)
+                engine.step()  # warm-up
+
+                started = time.perf_counter()
+                for _ in range(ticks):
+                    engine.step()
+                per_tick_ms = (time.perf_counter() - started) / ticks * 1000
+                self.stdout.write(
+                    f'  {model:<13} correlation={correlation:<4} {per_tick_ms:7.3f} ms/tick  '
+                    f'({pairs / per_tick_ms * 1000:,.0f} pair-updates/s)'
+                )
@@ -0,0 +1,80 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from bson import ObjectId
+from core.renderers import ORJSONRenderer, MsgPackRenderer, msgpack
+import datetime
+import gzip
+import random
+import time
+
+class Command(BaseCommand):
+    help = 'Compare response renderers (DRF JSON, orjson, msgpack) on transaction-history and market-data payloads'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--transactions', type=int, default=500, help='Rows in the transaction history payload (default: 500)')
+        parser.add_argument('--pairs', type=int, default=50, help='Rows in the market data payload (default: 50)')
+        parser.add_argument('--iterations', type=int, default=200, help='Renders per renderer and payload (default: 200)')
+        parser.add_argument('--seed', type=int, default=42, help='Random seed (default: 42)')
+
+    def transaction_payload(self, rng, count):
+        # Same row shape as get_transaction_history
+        now = timezone.now()
+        symbols = ('BTC', 'ETH', 'SOL', 'ADA', 'USDT')
+        return {'transactions': [{
+            'id': str(ObjectId()),
+            'tx_hash': f'0x{rng.getrandbits(128):032x}',
+            'transaction_type': rng.choice(('send', 'receive', 'buy', 'sell')),
+            'crypto_symbol': rng.choice(symbols),
+            'amount': round(rng.uniform(0.001, 10), 8),
+            'to_address': f'0x{rng.getrandbits(160):040x}',
+            'from_address': f'0x{rng.getrandbits(160):040x}',
+            'status': 'completed',
+            'fee': round(rng.uniform(0, 0.01), 8),
+            'memo': '',
+            'created_at': now - datetime.timedelta(minutes=i),
+        } for i in range(count)]}
+
+    def market_payload(self, rng, count):
+        # Same row shape as get_market_data
+        now = timezone.now()
+        return {'market_data': [{
+            'pair': f'C{i}/USDT',
+            'base_symbol': f'C{i}',
+            'quote_symbol': 'USDT',
+            'current_price': rng.uniform(0.01, 60000),
+            'price_change_24h': rng.uniform(-10, 10),
+            'volume_24h': rng.uniform(1e3, 1e9),
+            'high_24h': rng.uniform(0.01, 60000),
+            'low_24h': rng.uniform(0.01, 60000),
+            'last_updated': now,
+        } for i in range(count)]}
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        iterations = options['iterations']
+        payloads = [
+            ('transaction history', self.transaction_payload(rng, options['transactions'])),
+            ('market data', self.market_payload(rng, options['pairs'])),
+        ]
+        renderers = [('drf json', JSONRenderer()), ('orjson', ORJSONRenderer())]
+        if msgpack is not None:
+            renderers.append(('msgpack', MsgPackRenderer()))
+        else:
+            self.stdout.write('msgpack not installed, skipping MsgPackRenderer')
+
+        for name, payload in payloads:
+            rows = len(next(iter(payload.values())))
+            self.stdout.write(f'{name} ({rows} rows, {iterations} renders):')
+            baseline = None
+            for label, renderer in renderers:
+                body = renderer.render(payload)
+                started = time.perf_counter()
+                for _ in range(iterations):
+                    renderer.render(payload)
+                per_render = (time.perf_counter() - started) / iterations * 1000
+                baseline = baseline or per_render
+                self.stdout.write(
+                    f'  {label:9} {per_render:7.3f} ms/render ({baseline / per_render:4.1f}x)  '
+                    f'{len(body):8,} bytes, {len(gzip.compress(body)):7,} gzipped'
+                )
@@ -0,0 +1,111 @@
+from django.core.management.base import BaseCommand, CommandError
+from bson import ObjectId
+from datetime import datetime, timedelta
+from core.models import (
+    User, Token, StreamTicket, Portfolio, TradingPair, PriceHistory, Candle, Order, Trade, Transaction,
+    MerchantWallet, CurveCart, FaceData, ExternalPriceHistory, LedgerEntry, BalanceSnapshot,
+)
+
+MODELS = [
+    User, Token, StreamTicket, Portfolio, TradingPair, PriceHistory, Candle, Order, Trade, Transaction,
+    MerchantWallet, CurveCart, FaceData, ExternalPriceHistory, LedgerEntry, BalanceSnapshot,
+]
+
+_id = ObjectId()
+_now = datetime.utcnow()
+
+# (name, model, filter, sort, allow_collscan) for every query shape the
+# views/utils/engine issue. Values are placeholders: only the shape matters
+# to the planner. Add new queries here so they can't silently become scans.
+QUERY_SHAPES = [
+    ('auth: token lookup', Token, {'token': 'x'}, None, False),
+    ('login: token by user', Token, {'user': _id}, None, False),
+    ('stream: redeem ticket', StreamTicket, {'ticket': 'x', 'expires_at': {'$gt': _now}}, None, False),
+    ('login: user by username/password', User, {'username': 'x', 'password': 'x'}, None, False),
+    ('login: user by email/password', User, {'email': 'x', 'password': 'x'}, None, False),
+    ('merchant: user by merchant_name', User, {'merchant_name': 'x', 'is_merchant': True}, None, False),
+    ('merchant: all merchant users', User, {'is_merchant': True}, None, False),
+    ('merchant: wallet by name', MerchantWallet, {'merchant_name': 'x'}, None, False),
+    ('merchant: wallet by user', MerchantWallet, {'user': _id}, None, False),
+    ('portfolio by user', Portfolio, {'user': _id}, None, False),
+    ('portfolios: top by value', Portfolio, {}, [('total_value_usd', -1)], False),
+    ('trading pair by name', TradingPair, {'pair': 'BTCUSDT'}, None, False),
+    # A handful of pairs, read whole into the price snapshot
+    ('price snapshot: active pairs', TradingPair, {'is_active': True}, None, True),
+    ('price history: latest ticks', PriceHistory, {'pair': _id}, [('timestamp', -1)], False),
+    ('candles: range', Candle, {'pair': _id, 'interval': '1m', 'start': {'$gte': _now - timedelta(days=1), '$lt': _now}}, [('start', -1)], False),
+    ('candles: current bucket of all pairs', Candle, {'interval': '1m', 'start': {'$in': [_now]}, 'pair': {'$in': [_id]}}, None, False),
+    ('orders: history', Order, {'user': _id}, [('created_at', -1)], False),
+    ('orders: by order_id', Order, {'order_id': 'x', 'user': _id}, None, False),
+    ('orders: open orders of a pair', Order, {'pair': _id, 'status': {'$in': ['pending', 'partial']}}, [('created_at', 1)], False),
+    ('orders: matching engine rebuild', Order, {'order_type': 'limit', 'status': {'$in': ['pending', 'partial']}}, [('created_at', 1)], False),
+    ('transactions: page', Transaction, {'user': _id}, [('created_at', -1), ('_id', -1)], False),
+    ('transactions: page by type', Transaction, {'user': _id, 'transaction_type': 'trade'}, [('created_at', -1), ('_id', -1)], False),
+    ('transactions: page by symbol', Transaction, {'user': _id, 'crypto_symbol': 'BTC'}, [('created_at', -1), ('_id', -1)], False),
+    ('transactions: ETag marker', Transaction, {'user': _id}, [('updated_at', -1)], False),
+    ('transactions: cancel by hash', Transaction, {'user': _id, 'tx_hash': 'x'}, None, False),
+    ('curve cart by id', CurveCart, {'cart_id': 'x'}, None, False),
+    ('face data by user', FaceData, {'user': _id}, None, False),
+    # Loaded once at startup into the in-memory face index
+    ('face index: load all', FaceData, {}, None, True),
+    ('external history by key', ExternalPriceHistory, {'key': 'coincap:BTCUSDT'}, None, False),
+    ('ledger: tail after snapshot', LedgerEntry, {'account': 'x', 'symbol': 'BTC', 'seq': {'$gt': 0}}, [('seq', 1)], False),
+    ('ledger: accounts with opening entries', LedgerEntry, {'kind': 'opening'}, None, False),
+    ('ledger: latest snapshots', BalanceSnapshot, {'account': 'x'}, [('account', 1), ('symbol', 1), ('seq', -1)], False),
+]
+
+
+def plan_stages(plan):
+    """Every stage name in an explain() plan tree (classic and SBE formats)."""
+    stages = []
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            stages.append(plan['stage'])
+        for value in plan.values():
+            if isinstance(value, (dict, list)):
+                stages.extend(plan_stages(value))
+    elif isinstance(plan, list):
+        for item in plan:
+            stages.extend(plan_stages(item))
+    return stages
+
+
+class Command(BaseCommand):
+    help = 'Ensure declared indexes exist and explain() every known query shape, failing on collection scans'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--skip-ensure', action='store_true', help='Do not create missing indexes first')
+        parser.add_argument('--verbose-plans', action='store_true', help='Print the winning plan stages of every query')
+
+    def handle(self, *args, **options):
+        if not options['skip_ensure']:
+            for model in MODELS:
+                model.ensure_indexes()
+                names = sorted(model._get_collection().index_information())
+                self.stdout.write(f'{model.__name__}: {", ".join(names)}')
+
+        scans = []
+        for name, model, query, sort, allow_collscan in QUERY_SHAPES:
+            cursor = model._get_collection().find(query).limit(1)
+            if sort:
+                cursor = cursor.sort(sort)
+            winning = cursor.explain().get('queryPlanner', {}).get('winningPlan', {})
+            stages = plan_stages(winning)
+
+            if 'COLLSCAN' in stages and not allow_collscan:
+                scans.append(name)
+                label = self.style.ERROR('COLLSCAN')
+            elif 'COLLSCAN' in stages:
+                label = self.style.WARNING('COLLSCAN (expected)')
+            elif 'SORT' in stages:
+                label = self.style.WARNING('in-memory SORT')
+            else:
+                label = self.style.SUCCESS('ok')
+            line = f'  {label}  {name}'
+            if options['verbose_plans']:
+                line += f'  [{" > ".join(stages)}]'
+            self.stdout.write(line)
+
+        if scans:
+            raise CommandError(f'{len(scans)} query shape(s) scan a whole collection: {", ".join(scans)}')
+        self.stdout.write(self.style.SUCCESS(f'{len(QUERY_SHAPES)} query shapes use indexes'))
@@ -1,5 +1,5 @@
 from django.core.management.base import BaseCommand
-from core.utils import initialize_trading_pairs, simulate_all_prices
+from core.utils import initialize_trading_pairs, simulate_all_prices, run_price_tick
 from core.models import TradingPair
 import time
 
@@ -14,9 +14,9 @@ class Command(BaseCommand):
         )
         parser.add_argument(
             '--interval',
-            type=int,
+            type=float,
             default=30,
-            help='Price update interval in seconds (default: 30)',
+            help='Price update interval in seconds, fractions allowed (default: 30)',
         )
 
     def handle(self, *args, **options):
@@ -65,7 +65,9 @@ class Command(BaseCommand):
             try:
                 while True:
                     time.sleep(options['interval'])
-                    updated_prices = simulate_all_prices()
+                    # The web process (PRICE_TICKER_ENABLED=false) picks the tick up
+                    # from Mongo and runs order matching and valuations itself
+                    updated_prices, failures = run_price_tick()
                     
                     self.stdout.write(f'🔄 Price update at {time.strftime("%H:%M:%S")}:')
                     for pair_name, data in updated_prices.items():
@@ -74,6 +76,8 @@ class Command(BaseCommand):
                             f'  {pair_name}: ${data["price"]:.8f} '
                             f'({change_symbol}{data["change_24h"]:.2f}%)'
                         )
+                    for pair_name, error in failures.items():
+                        self.stdout.write(self.style.ERROR(f'  {pair_name}: {error}'))
                     self.stdout.write('')
                     
             except KeyboardInterrupt:
@@ -0,0 +1,95 @@
+from django.core.management.base import BaseCommand, CommandError
+from core.models import Portfolio, MerchantWallet, LedgerEntry
+from core.balances import add_wallet
+from core.ledger import GENESIS, SYSTEM_ACCOUNTS, account_key, balances, post_journal
+from collections import defaultdict
+from datetime import datetime
+import math
+
+TOLERANCE = 1e-9
+
+
+class Command(BaseCommand):
+    help = ('Compare every wallet balance with the ledger (latest snapshot + tail), checkpointing long tails '
+            'on the way, and check that all accounts sum to zero per symbol; --repair resets drifted wallets '
+            'to the ledger')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--open-missing', action='store_true',
+            help='Book the difference as an opening balance for accounts that have none yet (wallets created before the ledger)'
+        )
+        parser.add_argument(
+            '--repair', action='store_true',
+            help='Reset wallet balances that differ from the ledger to the ledger balance (the ledger wins)'
+        )
+
+    def handle(self, *args, **options):
+        opened = set(LedgerEntry._get_collection().distinct('account', {'kind': 'opening'}))
+        # Every account that ever posted, including wallets deleted since and system accounts
+        posted = set(LedgerEntry._get_collection().distinct('account'))
+        totals = defaultdict(float)
+        mismatches = 0
+        accounts = 0
+
+        for model in (Portfolio, MerchantWallet):
+            for doc in model._get_collection().find({}, {'user': 1, 'wallets.symbol': 1, 'wallets.balance': 1}):
+                account = account_key(model, doc['user'] if model is Portfolio else doc['_id'])
+                posted.discard(account)
+                accounts += 1
+                wallets = {wallet['symbol']: wallet.get('balance', 0.0) for wallet in doc.get('wallets', [])}
+                recorded = balances(account)
+                differences = {
+                    symbol: wallets.get(symbol, 0.0) - recorded.get(symbol, 0.0)
+                    for symbol in set(wallets) | set(recorded)
+                    if not math.isclose(wallets.get(symbol, 0.0), recorded.get(symbol, 0.0), abs_tol=TOLERANCE)
+                }
+                if differences and options['open_missing'] and account not in opened:
+                    post_journal({(account, symbol): amount for symbol, amount in differences.items()}, 'opening', contra=GENESIS)
+                    self.stdout.write(f'  opened {account}: {differences}')
+                    recorded = wallets
+                    differences = {}
+                if differences and options['repair']:
+                    owner_id = doc['user'] if model is Portfolio else doc['_id']
+                    for symbol in self.repair(model, doc['_id'], owner_id, wallets, recorded, differences):
+                        self.stdout.write(f'  repaired {account} {symbol}: {wallets.get(symbol, 0.0)} -> {recorded.get(symbol, 0.0)}')
+                        del differences[symbol]
+                for symbol, difference in differences.items():
+                    mismatches += 1
+                    self.stdout.write(self.style.ERROR(
+                        f'  {account} {symbol}: wallet {wallets.get(symbol, 0.0)} ledger {recorded.get(symbol, 0.0)} ({difference:+})'
+                    ))
+                for symbol, amount in recorded.items():
+                    totals[symbol] += amount
+
+        for account in sorted(posted):
+            for symbol, amount in balances(account).items():
+                totals[symbol] += amount
+                if account not in SYSTEM_ACCOUNTS and not math.isclose(amount, 0.0, abs_tol=TOLERANCE):
+                    self.stdout.write(self.style.WARNING(f'  {account} {symbol}: {amount:+} left on a removed wallet'))
+        unbalanced = {symbol: total for symbol, total in totals.items() if not math.isclose(total, 0.0, abs_tol=1e-6)}
+        for symbol, total in unbalanced.items():
+            self.stdout.write(self.style.ERROR(f'  ledger does not sum to zero for {symbol}: {total:+}'))
+
+        if mismatches or unbalanced:
+            raise CommandError(f'{mismatches} wallet balance(s) differ from the ledger, {len(unbalanced)} symbol(s) unbalanced')
+        self.stdout.write(self.style.SUCCESS(f'{accounts} accounts match the ledger'))
+
+    def repair(self, model, doc_id, owner_id, wallets, recorded, differences):
+        """Set drifted wallets to their ledger balance; returns the symbols repaired.
+
+        Each update is guarded on the balance the audit read, so a wallet
+        changed by a concurrent request is left for the next run.
+        """
+        collection = model._get_collection()
+        repaired = []
+        for symbol in differences:
+            if symbol not in wallets:
+                add_wallet(model, owner_id, symbol)
+            result = collection.update_one(
+                {'_id': doc_id, 'wallets': {'$elemMatch': {'symbol': symbol, 'balance': wallets.get(symbol, 0.0)}}},
+                {'$set': {'wallets.$.balance': recorded.get(symbol, 0.0), 'updated_at': datetime.utcnow()}},
+            )
+            if result.modified_count:
+                repaired.append(symbol)
+        return repaired
@@ -0,0 +1,503 @@
+"""
+Price-time priority matching for limit orders.
+
+Every TradingPair gets an OrderBook with a bid and an ask side. Each side
+maps price -> PriceLevel (a FIFO queue of resting orders plus their summed
+quantity) and keeps the level prices in a sorted list. Matching bisects to
+the last level an incoming price crosses and walks the levels best first,
+stopping once the order is filled; adding or emptying a level is a bisect
+plus a list insert/delete, so no stale prices are left behind. Cancelled
+orders are flagged and skipped lazily instead of being searched for in
+their queue.
+
+Level quantities are kept up to date on every fill and cancel, so L2 depth
+(``MatchingEngine.depth``) is read straight off the levels.
+
+Incoming limit orders are matched against the opposite side when placed and
+any remainder rests in the book. On every price tick, resting orders crossed
+by the simulated market price are filled against the house at that price.
+
+Limit orders reserve their funds when placed (quote at the limit price for
+buys, base for sells), so settling a fill only ever credits: buyers receive
+the base asset plus any price improvement, sellers the quote proceeds.
+
+Matching is planned first (``OrderBook.match``/``plan_sweep`` leave the book
+untouched) and settled as one ``balances.atomic`` unit: order progress,
+Trades, Transactions and credits commit together, journaled against the
+order escrow ledger account. Only then are the fills applied to the book
+(``OrderBook.commit``), so a failed write leaves book and database agreeing.
+
+Self-trade prevention cancels the taker: matching stops at the first
+resting order of the same user, and what is left of the incoming order is
+cancelled (its funds released) instead of trading against itself.
+
+The books live in memory in the web process (gunicorn runs a single worker,
+like the price ticker) and are rebuilt from pending and partial orders in
+Mongo on first use.
+"""
+import bisect
+import heapq
+import logging
+import math
+import threading
+from collections import defaultdict, deque, namedtuple
+from datetime import datetime
+
+from pymongo import UpdateOne
+
+from .cache import TTLCache
+from .models import Order, Trade, Transaction, TradingPair
+from .balances import BalanceError, WalletOwnerNotFound, atomic
+from .ledger import ORDER_ESCROW
+from .utils import generate_trade_id, generate_transaction_hash
+
+logger = logging.getLogger(__name__)
+
+EPSILON = 1e-12  # quantities below this count as zero
+
+Fill = namedtuple('Fill', 'maker taker price quantity')  # taker is None for house fills
+
+
+def order_status(quantity, filled, cancelled=False):
+    if cancelled:
+        return 'cancelled'
+    if quantity - filled <= EPSILON:
+        return 'filled'
+    return 'partial' if filled > 0 else 'pending'
+
+
+class RestingOrder:
+    __slots__ = ('order_id', 'user_id', 'side', 'price', 'quantity', 'filled', 'cancelled')
+
+    def __init__(self, order_id, user_id, side, price, quantity, filled=0.0):
+        self.order_id = order_id
+        self.user_id = user_id
+        self.side = side
+        self.price = price
+        self.quantity = quantity
+        self.filled = filled
+        self.cancelled = False
+
+    @property
+    def remaining(self):
+        return self.quantity - self.filled
+
+    @property
+    def status(self):
+        return order_status(self.quantity, self.filled, self.cancelled)
+
+
+class PriceLevel:
+    __slots__ = ('price', 'orders', 'quantity')
+
+    def __init__(self, price):
+        self.price = price
+        self.orders = deque()
+        self.quantity = 0.0
+
+
+class BookSide:
+    """One side of a book: price -> PriceLevel, with the level prices kept sorted ascending."""
+
+    def __init__(self, is_bid):
+        self.is_bid = is_bid
+        self.levels = {}
+        self.prices = []
+
+    def crossing(self, limit):
+        """Levels that trade against an opposite order limited at ``limit``, best first.
+
+        Walks outwards from the best level and stops at the first one that
+        doesn't cross; the side must not change while the walk is running.
+        """
+        prices = self.prices
+        if self.is_bid:
+            indexes = range(len(prices) - 1, bisect.bisect_left(prices, limit) - 1, -1)
+        else:
+            indexes = range(bisect.bisect_right(prices, limit))
+        for index in indexes:
+            yield self.levels[prices[index]]
+
+    def add(self, entry):
+        level = self.levels.get(entry.price)
+        if level is None:
+            level = self.levels[entry.price] = PriceLevel(entry.price)
+            bisect.insort(self.prices, entry.price)
+        level.orders.append(entry)
+        level.quantity += entry.remaining
+
+    def remove(self, level):
+        del self.levels[level.price]
+        del self.prices[bisect.bisect_left(self.prices, level.price)]
+
+
+class OrderBook:
+    def __init__(self, pair=None):
+        self.pair = pair  # TradingPair document (unused by the matching logic itself)
+        self.bids = BookSide(is_bid=True)
+        self.asks = BookSide(is_bid=False)
+        self.orders = {}  # order_id -> resting RestingOrder
+        self.sequence = 0  # bumped on every change to the resting orders
+
+    def __len__(self):
+        return len(self.orders)
+
+    def side(self, side):
+        return self.bids if side == 'buy' else self.asks
+
+    def match(self, entry):
+        """Fills ``entry`` would get against the opposite side, in price-time priority.
+
+        Returns ``(fills, self_trade)``; ``self_trade`` is set when matching
+        stopped at a resting order of the same user, in which case the rest
+        of ``entry`` is to be cancelled. Leaves the book unchanged; apply the
+        result with ``commit``.
+        """
+        opposite = self.asks if entry.side == 'buy' else self.bids
+        fills = []
+        remaining = entry.remaining
+        for level in opposite.crossing(entry.price):
+            for maker in level.orders:
+                if remaining <= EPSILON:
+                    break
+                if maker.cancelled or maker.remaining <= EPSILON:
+                    continue
+                if maker.user_id == entry.user_id:
+                    return fills, True
+                traded = min(remaining, maker.remaining)
+                fills.append(Fill(maker, entry, level.price, traded))
+                remaining -= traded
+            if remaining <= EPSILON:
+                break
+        return fills, False
+
+    def commit(self, entry, fills, self_trade=False):
+        """Apply ``fills`` planned by ``match``/``plan_sweep`` and rest (or, on a self-trade, cancel) what is left of ``entry``."""
+        if self_trade:
+            entry.cancelled = True
+        for fill in fills:
+            self._fill(fill.maker, fill.quantity)
+            if fill.taker is not None:
+                fill.taker.filled += fill.quantity
+        if entry is not None and not entry.cancelled and entry.remaining > EPSILON:
+            self.side(entry.side).add(entry)
+            self.orders[entry.order_id] = entry
+        self.sequence += 1
+
+    def add(self, entry):
+        """Match ``entry`` and apply the result at once; returns the fills."""
+        fills, self_trade = self.match(entry)
+        self.commit(entry, fills, self_trade)
+        return fills
+
+    def cancel(self, order_id):
+        """Remove a resting order; returns it (flagged cancelled) or None if it isn't resting."""
+        entry = self.orders.pop(order_id, None)
+        if entry is None:
+            return None
+        entry.cancelled = True
+        side = self.side(entry.side)
+        level = side.levels[entry.price]
+        level.quantity -= entry.remaining
+        if level.quantity <= EPSILON:
+            side.remove(level)
+        self.sequence += 1
+        return entry
+
+    def depth(self, limit=20, tick=None):
+        """Top ``limit`` aggregated levels per side as ``(bids, asks)`` lists of ``(price, quantity)``.
+
+        With ``tick``, prices are grouped into tick-sized buckets (bids round
+        down, asks round up) before the top levels are taken.
+        """
+        return _side_depth(self.bids, limit, tick), _side_depth(self.asks, limit, tick)
+
+    def plan_sweep(self, market_price):
+        """Fills of every resting order crossed by ``market_price``, against the house at that price."""
+        fills = []
+        for side in (self.bids, self.asks):
+            for level in side.crossing(market_price):
+                for maker in level.orders:
+                    if not maker.cancelled and maker.remaining > EPSILON:
+                        fills.append(Fill(maker, None, market_price, maker.remaining))
+        return fills
+
+    def sweep(self, market_price):
+        """Plan and apply a sweep at once; returns the fills."""
+        fills = self.plan_sweep(market_price)
+        if fills:
+            self.commit(None, fills)
+        return fills
+
+    def _fill(self, maker, quantity):
+        side = self.side(maker.side)
+        level = side.levels[maker.price]
+        maker.filled += quantity
+        level.quantity -= quantity
+        if maker.remaining <= EPSILON:
+            del self.orders[maker.order_id]
+        orders = level.orders
+        while orders and (orders[0].cancelled or orders[0].remaining <= EPSILON):
+            orders.popleft()
+        if not orders or level.quantity <= EPSILON:
+            side.remove(level)
+
+
+def _side_depth(side, limit, tick):
+    levels = [(level.price, level.quantity) for level in side.levels.values() if level.quantity > EPSILON]
+    if tick:
+        grouped = defaultdict(float)
+        for price, quantity in levels:
+            ratio = price / tick
+            bucket = math.floor(ratio + 1e-9) if side.is_bid else math.ceil(ratio - 1e-9)
+            grouped[bucket] += quantity
+        levels = [(round(bucket * tick, 8), quantity) for bucket, quantity in grouped.items()]
+    pick = heapq.nlargest if side.is_bid else heapq.nsmallest
+    return pick(limit, levels)
+
+
+def reservation(side, price, quantity, trading_pair):
+    """Funds a limit order holds while it rests: ``{symbol: amount}``."""
+    if side == 'buy':
+        return {trading_pair.quote_symbol: quantity * price}
+    return {trading_pair.base_symbol: quantity}
+
+
+class MatchingEngine:
+    def __init__(self):
+        self.books = {}  # pair name -> OrderBook
+        self._book_locks = {}  # pair name -> Lock serialising matching and settlement
+        self._lock = threading.RLock()
+        self._loaded = False
+        # (pair, limit, tick) -> depth snapshot, valid while the book's sequence is unchanged
+        self._depth_cache = TTLCache(maxsize=1024, ttl=300)
+
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+        with self._lock:
+            if not self._loaded:
+                self.rebuild()
+                self._loaded = True
+
+    def _book(self, trading_pair):
+        book = self.books.get(trading_pair.pair)
+        if book is None:
+            with self._lock:
+                book = self.books.get(trading_pair.pair)
+                if book is None:
+                    book = self.books[trading_pair.pair] = OrderBook(trading_pair)
+                    self._book_locks.setdefault(trading_pair.pair, threading.Lock())
+        return book
+
+    def rebuild(self):
+        """Reload every open limit order from Mongo in time priority."""
+        pairs = {pair.id: pair for pair in TradingPair.objects()}
+        self.books = {}
+        orders = Order.objects(
+            order_type='limit', status__in=['pending', 'partial']
+        ).order_by('created_at').no_dereference()
+        count = 0
+        for order in orders:
+            trading_pair = pairs.get(order.pair.id)
+            if trading_pair is None or not order.price:
+                continue
+            book = self._book(trading_pair)
+            entry = RestingOrder(order.order_id, order.user.id, order.side, order.price, order.quantity, order.filled_quantity)
+            # Matching here resolves any crossed orders left over from before the engine existed
+            fills, self_trade = book.match(entry)
+
+            def restore(batch):
+                if not order.funds_reserved:
+                    # Placed before orders reserved their funds
+                    held = reservation(order.side, order.price, entry.remaining, trading_pair)
+                    batch.apply(order.user.id, {s: -a for s, a in held.items()})
+                    batch.update(
+                        Order, [UpdateOne({'_id': order.id}, {'$set': {'funds_reserved': True}})],
+                        [UpdateOne({'_id': order.id}, {'$set': {'funds_reserved': False}})]
+                    )
+                self._settle(batch, book, fills, entry, self_trade)
+
+            try:
+                atomic(restore, kind='order_hold', contra=ORDER_ESCROW)
+            except BalanceError as e:
+                if order.funds_reserved:
+                    logger.error('Failed to settle fills of a restored order', extra={'fields': {
+                        'order_id': order.order_id, 'error': e,
+                    }})
+                    continue
+                Order.objects(id=order.id).update_one(set__status='cancelled', set__updated_at=datetime.utcnow())
+                logger.info('Cancelled unfunded limit order', extra={'fields': {
+                    'order_id': order.order_id, 'reason': str(e),
+                }})
+                continue
+            book.commit(entry, fills, self_trade)
+            count += 1
+        logger.info('Order books rebuilt', extra={'fields': {'books': len(self.books), 'orders': count}})
+
+    def place(self, order, trading_pair):
+        """Reserve funds for, save and match a new limit order, all in one atomic unit.
+
+        Returns ``(success, message, entry)``; ``entry`` carries the filled
+        quantity and status after matching.
+        """
+        self._ensure_loaded()
+        held = reservation(order.side, order.price, order.quantity, trading_pair)
+        book = self._book(trading_pair)
+        entry = RestingOrder(order.order_id, order.user.id, order.side, order.price, order.quantity)
+        with self._book_locks[trading_pair.pair]:
+            fills, self_trade = book.match(entry)
+
+            def submit(batch):
+                batch.apply(order.user, {s: -a for s, a in held.items()})
+                order.funds_reserved = True
+                order.id = batch.insert(Order, [order])[0]
+                self._settle(batch, book, fills, entry, self_trade)
+
+            try:
+                atomic(submit, kind='limit_order', contra=ORDER_ESCROW)
+            except WalletOwnerNotFound:
+                return False, 'Portfolio not found', None
+            except BalanceError as e:
+                return False, str(e), None
+            book.commit(entry, fills, self_trade)
+        if self_trade:
+            return True, 'Limit order cancelled where it would have matched your own order', entry
+        return True, 'Limit order placed successfully', entry
+
+    def cancel(self, order, trading_pair):
+        """Cancel a resting order and release the funds it still holds; returns False if it isn't open."""
+        self._ensure_loaded()
+        book = self._book(trading_pair)
+        with self._book_locks[trading_pair.pair]:
+            entry = book.orders.get(order.order_id)
+            if entry is None:
+                return False
+
+            def release(batch):
+                batch.update(Order, [UpdateOne({'order_id': order.order_id}, {'$set': {
+                    'status': 'cancelled', 'filled_quantity': entry.filled, 'updated_at': datetime.utcnow(),
+                }})], [UpdateOne({'order_id': order.order_id}, {'$set': {'status': entry.status}})])
+                if order.funds_reserved:
+                    batch.apply(order.user, reservation(entry.side, entry.price, entry.remaining, trading_pair))
+
+            atomic(release, kind='order_release', contra=ORDER_ESCROW)
+            book.cancel(order.order_id)
+        return True
+
+    def depth(self, pair_name, limit=20, tick=None):
+        """L2 snapshot ``{'pair', 'sequence', 'bids', 'asks'}`` of a pair's book, cached per sequence."""
+        self._ensure_loaded()
+        book = self.books.get(pair_name)
+        if book is None:
+            return {'pair': pair_name, 'sequence': 0, 'bids': [], 'asks': []}
+        key = (pair_name, limit, tick)
+        cached = self._depth_cache.get(key)
+        if cached is not None and cached['sequence'] == book.sequence:
+            return cached
+        with self._book_locks[pair_name]:
+            sequence = book.sequence
+            bids, asks = book.depth(limit, tick)
+        snapshot = {'pair': pair_name, 'sequence': sequence, 'bids': bids, 'asks': asks}
+        self._depth_cache.set(key, snapshot)
+        return snapshot
+
+    def match_market(self, snapshot):
+        """Fill resting orders crossed by the latest prices in ``snapshot``; returns the number of fills."""
+        self._ensure_loaded()
+        count = 0
+        for pair_name, book in list(self.books.items()):
+            row = snapshot.get(pair_name)
+            if not row or not book.orders or row['current_price'] <= 0:
+                continue
+            with self._book_locks[pair_name]:
+                fills = book.plan_sweep(row['current_price'])
+                if not fills:
+                    continue
+                try:
+                    atomic(lambda batch: self._settle(batch, book, fills), kind='trade', contra=ORDER_ESCROW)
+                except BalanceError as e:
+                    logger.error('Failed to settle house fills', extra={'fields': {
+                        'pair': pair_name, 'fills': len(fills), 'error': e,
+                    }})
+                    continue
+                book.commit(None, fills)
+            count += len(fills)
+        return count
+
+    def _settle(self, batch, book, fills, taker=None, self_trade=False):
+        """Write planned fills within ``batch``: order progress, Trades, Transactions and credits.
+
+        With ``self_trade`` the rest of ``taker`` is cancelled and its funds released.
+        """
+        if not fills and not self_trade:
+            return
+        trading_pair = book.pair
+        base, quote = trading_pair.base_symbol, trading_pair.quote_symbol
+        now = datetime.utcnow()
+        filled = {}  # order_id -> (entry, filled quantity after these fills)
+        credits = defaultdict(float)  # (user_id, symbol) -> amount
+        trades = []
+        transactions = []
+
+        for fill in fills:
+            quantity, price = fill.quantity, fill.price
+            total = quantity * price
+            buy = sell = None
+            for entry in (fill.maker, fill.taker):
+                if entry is None:
+                    continue
+                filled[entry.order_id] = (entry, filled.get(entry.order_id, (entry, entry.filled))[1] + quantity)
+                if entry.side == 'buy':
+                    buy = entry
+                    credits[(entry.user_id, base)] += quantity
+                    # Reserved at the limit price; refund the price improvement
+                    credits[(entry.user_id, quote)] += (entry.price - price) * quantity
+                else:
+                    sell = entry
+                    credits[(entry.user_id, quote)] += total
+                transactions.append(Transaction(
+                    user=entry.user_id,
+                    transaction_type='trade',
+                    crypto_symbol=base,
+                    amount=quantity if entry.side == 'buy' else -quantity,
+                    tx_hash=generate_transaction_hash(),
+                    status='confirmed',
+                    memo=f"{entry.side.upper()} {quantity} {base} at {price} (order {entry.order_id})"
+                ))
+            # House fills record the resting order's owner on both sides, as market orders do
+            trades.append(Trade(
+                buyer=(buy or sell).user_id,
+                seller=(sell or buy).user_id,
+                pair=trading_pair.id,
+                quantity=quantity,
+                price=price,
+                total=total,
+                trade_id=generate_trade_id(),
+                buy_order_id=buy.order_id if buy else None,
+                sell_order_id=sell.order_id if sell else None
+            ))
+
+        if self_trade:
+            filled.setdefault(taker.order_id, (taker, taker.filled))
+            remaining = taker.quantity - filled[taker.order_id][1]
+            for symbol, amount in reservation(taker.side, taker.price, remaining, trading_pair).items():
+                credits[(taker.user_id, symbol)] += amount
+
+        batch.update(Order, [
+            UpdateOne({'order_id': order_id}, {'$set': {
+                'filled_quantity': quantity, 'updated_at': now,
+                'status': order_status(entry.quantity, quantity, cancelled=self_trade and entry is taker),
+            }})
+            for order_id, (entry, quantity) in filled.items()
+        ], [
+            UpdateOne({'order_id': order_id}, {'$set': {'filled_quantity': entry.filled, 'status': entry.status}})
+            for order_id, (entry, quantity) in filled.items()
+        ])
+        if trades:
+            batch.insert(Trade, trades)
+            batch.insert(Transaction, transactions)
+        batch.credit_many({key: amount for key, amount in credits.items() if amount > EPSILON})
+
+
+matching_engine = MatchingEngine()
@@ -0,0 +1,72 @@
+import logging
+import time
+
+from django.conf import settings
+
+from .dbstats import track_db_stats
+
+logger = logging.getLogger(__name__)
+request_logger = logging.getLogger('core.request')
+
+
+def get_query_budget(path):
+    """Mongo command budget for ``path`` (per-path override or the global default)."""
+    budgets = getattr(settings, 'DB_QUERY_BUDGETS', {})
+    return budgets.get(path, getattr(settings, 'DB_QUERY_BUDGET', 10))
+
+
+class DbStatsMiddleware:
+    """
+    Count Mongo commands, reply bytes and time spent per request.
+
+    Exposes them as X-Db-Queries / X-Db-Time-Ms response headers (plus
+    X-Db-Bytes when DB_STATS_BYTES is set), logs requests over their budget,
+    and flags repeated command shapes that look like N+1 loops.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.n_plus_one_threshold = getattr(settings, 'DB_N_PLUS_ONE_THRESHOLD', 5)
+        self.count_bytes = getattr(settings, 'DB_STATS_BYTES', False)
+
+    def __call__(self, request):
+        with track_db_stats(self.count_bytes) as stats:
+            response = self.get_response(request)
+
+        response['X-Db-Queries'] = str(stats.commands)
+        if self.count_bytes:
+            response['X-Db-Bytes'] = str(stats.bytes)
+        response['X-Db-Time-Ms'] = f'{stats.time_ms:.1f}'
+
+        budget = get_query_budget(request.path)
+        if stats.commands > budget:
+            logger.warning(
+                'Mongo query budget exceeded: %s %s ran %d commands (budget %d, %.1f ms)',
+                request.method, request.path, stats.commands, budget, stats.time_ms,
+            )
+        for shape, count in stats.repeated_shapes(self.n_plus_one_threshold):
+            logger.warning('Possible N+1 on %s %s: %r issued %d times', request.method, request.path, shape, count)
+
+        return response
+
+
+class RequestLogMiddleware:
+    """Sampled structured access log with view name, user id, latency and DB usage."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        started = time.perf_counter()
+        response = self.get_response(request)
+        latency_ms = (time.perf_counter() - started) * 1000
+
+        match = request.resolver_match
+        user = getattr(request, 'user', None)
+        request_logger.info('%s %s %d', request.method, request.path, response.status_code, extra={'fields': {
+            'view': match.view_name if match else None,
+            'user_id': getattr(user, 'id', None),
+            'latency_ms': f'{latency_ms:.1f}',
+            'db_queries': response.get('X-Db-Queries'),
+        }})
+        return response
@@ -1,7 +1,8 @@
 from mongoengine import Document, StringField, EmailField, FloatField, DateTimeField, ReferenceField, BinaryField, ListField, CASCADE, EmbeddedDocument, EmbeddedDocumentField, DictField, BooleanField, IntField
+from mongoengine import signals
 import json
 from datetime import datetime, timedelta
-import random
+from .simulation import price_engine
 
 class User(Document):
     username = StringField(max_length=100, unique=True, required=True)
@@ -12,6 +13,13 @@ class User(Document):
     merchant_name = StringField(max_length=100)
     kyc_verified = BooleanField(default=False)
     
+    meta = {
+        'indexes': [
+            # merchant lookups by name, and listing all merchants (prefix)
+            ('is_merchant', 'merchant_name')
+        ]
+    }
+    
     @property
     def is_authenticated(self):
         """
@@ -32,6 +40,22 @@ class Token(Document):
     user = ReferenceField(User, reverse_delete_rule=CASCADE)
     token = StringField(max_length=255, unique=True, required=True)
     created_at = DateTimeField(default=datetime.utcnow)
+    
+    meta = {
+        'indexes': ['user']
+    }
+
+class StreamTicket(Document):
+    """Short-lived, single-use credential for opening /api/stream/ (core.streaming)"""
+    ticket = StringField(max_length=64, unique=True, required=True)
+    user = ReferenceField(User, reverse_delete_rule=CASCADE, required=True)
+    expires_at = DateTimeField(required=True)  # refused after this, removed by the TTL index
+    
+    meta = {
+        'indexes': [
+            {'fields': ['expires_at'], 'expireAfterSeconds': 0}
+        ]
+    }
 
 class CryptoWallet(EmbeddedDocument):
     symbol = StringField(required=True)  # BTC, ETH, ARC, USDT, BNB
@@ -47,7 +71,18 @@ class Portfolio(Document):
     wallets = ListField(EmbeddedDocumentField(CryptoWallet))
     total_value_usd = FloatField(default=0.0)
     created_at = DateTimeField(default=datetime.utcnow)
-    updated_at = DateTimeField(default=datetime.utcnow)
+    updated_at = DateTimeField(default=datetime.utcnow)  # bumped on every save (ETag marker)
+    
+    meta = {
+        'indexes': [
+            # Top portfolios by the value core.valuation persists
+            '-total_value_usd'
+        ]
+    }
+    
+    def save(self, *args, **kwargs):
+        self.updated_at = datetime.utcnow()
+        return super().save(*args, **kwargs)
 
 # Enhanced Trading Pair with price simulation
 class TradingPair(Document):
@@ -64,60 +99,25 @@ class TradingPair(Document):
     last_updated = DateTimeField(default=datetime.utcnow)
     is_active = BooleanField(default=True)
     
-    def simulate_price(self):
-        """Simulate realistic price movement with controlled volatility"""
-        if not self.base_price:
-            # Set base prices for different cryptos
-            base_prices = {
-                'BTCUSDT': 67234.50,
-                'ETHUSDT': 3456.78,
-                'ARCUSDT': 0.45,  # Our native token
-                'SOLUSDT': 156.23,
-                'BNBUSDT': 542.67,
-                'ADAUSDT': 0.78,
-                'DOTUSDT': 12.34,
-                'LINKUSDT': 23.45
-            }
-            self.base_price = base_prices.get(self.pair, 1.0)
-        
-        # Calculate time-based variation (market hours simulation)
-        now = datetime.utcnow()
-        hour = now.hour
-        
-        # Lower volatility during certain hours (night hours)
-        time_factor = 0.5 if 22 <= hour or hour <= 6 else 1.0
-        
-        # Generate price change within volatility limits
-        max_change = self.volatility * time_factor
-        price_change_percent = random.uniform(-max_change, max_change)
-        
-        # Apply change to current price or base price
-        base = self.current_price if self.current_price > 0 else self.base_price
-        new_price = base * (1 + price_change_percent)
-        
-        # Ensure price doesn't deviate too much from base price (±20%)
-        min_price = self.base_price * 0.8
-        max_price = self.base_price * 1.2
-        new_price = max(min_price, min(max_price, new_price))
-        
-        # Calculate 24h changes
-        old_price = self.current_price if self.current_price > 0 else self.base_price
-        self.price_change_24h = ((new_price - old_price) / old_price) * 100
-        
-        # Update other fields
-        self.current_price = round(new_price, 8)
-        self.volume_24h = random.uniform(1000000, 50000000)  # Random volume
-        
-        # Set high/low based on current price with some variation
-        variation = new_price * 0.05  # 5% variation
-        self.high_24h = round(new_price + random.uniform(0, variation), 8)
-        self.low_24h = round(new_price - random.uniform(0, variation), 8)
-        
-        self.last_updated = datetime.utcnow()
-        self.save()
+    def simulate_price(self, commit=True):
+        """Simulate realistic price movement with controlled volatility.
+
+        With ``commit=False`` the new values are only set on the document so
+        callers can persist many pairs in one bulk write.
+        """
+        price_engine.advance([self])
+        if commit:
+            self.save()
         
         return self.current_price
 
+def _trading_pairs_changed(sender, document, **kwargs):
+    # The price engine ticks its own copy of the active pairs; reload it before the next tick
+    price_engine.invalidate()
+
+signals.post_save.connect(_trading_pairs_changed, sender=TradingPair)
+signals.post_delete.connect(_trading_pairs_changed, sender=TradingPair)
+
 class PriceHistory(Document):
     """Store historical price data for charts"""
     pair = ReferenceField(TradingPair, required=True)
@@ -132,6 +132,26 @@ class PriceHistory(Document):
         ]
     }
 
+class Candle(Document):
+    """Pre-aggregated OHLCV bar for one pair and interval, maintained from price ticks"""
+    pair = ReferenceField(TradingPair, required=True)
+    interval = StringField(choices=["1m", "5m", "1h", "1d"], required=True)
+    start = DateTimeField(required=True)  # bucket start (UTC)
+    open = FloatField(required=True)
+    high = FloatField(required=True)
+    low = FloatField(required=True)
+    close = FloatField(required=True)
+    volume = FloatField(default=0.0)  # rolling 24h volume as of the bucket's close
+    ticks = IntField(default=0)
+    expires_at = DateTimeField()  # per-interval retention, unset = keep forever
+    
+    meta = {
+        'indexes': [
+            {'fields': ['pair', 'interval', 'start'], 'unique': True},
+            {'fields': ['expires_at'], 'expireAfterSeconds': 0}
+        ]
+    }
+
 class Order(Document):
     user = ReferenceField(User, reverse_delete_rule=CASCADE)
     pair = ReferenceField(TradingPair, required=True)
@@ -143,8 +163,17 @@ class Order(Document):
     status = StringField(choices=["pending", "filled", "cancelled", "partial"], default="pending")
     order_id = StringField(unique=True, required=True)
     fee = FloatField(default=0.0)
+    funds_reserved = BooleanField(default=False)  # limit orders hold their funds until filled or cancelled
     created_at = DateTimeField(default=datetime.utcnow)
     updated_at = DateTimeField(default=datetime.utcnow)
+    
+    meta = {
+        'indexes': [
+            ('user', '-created_at'),  # order history
+            ('pair', 'status', 'created_at'),  # open orders of a pair in time priority
+            ('order_type', 'status', 'created_at')  # matching engine rebuild
+        ]
+    }
 
 class Trade(Document):
     buyer = ReferenceField(User, required=True)
@@ -155,6 +184,8 @@ class Trade(Document):
     total = FloatField(required=True)
     fee = FloatField(default=0.0)
     trade_id = StringField(unique=True, required=True)
+    buy_order_id = StringField()  # Order.order_id, unset for market orders and house fills
+    sell_order_id = StringField()
     created_at = DateTimeField(default=datetime.utcnow)
 
 class Transaction(Document):
@@ -170,7 +201,21 @@ class Transaction(Document):
     fee = FloatField(default=0.0)
     memo = StringField(max_length=500)
     created_at = DateTimeField(default=datetime.utcnow)
-    updated_at = DateTimeField(default=datetime.utcnow)
+    updated_at = DateTimeField(default=datetime.utcnow)  # bumped on every save (ETag marker)
+    
+    meta = {
+        'indexes': [
+            ('user', '-updated_at'),
+            # Keyset pagination (core.pagination): newest first, _id breaks ties
+            ('user', '-created_at', '-id'),
+            ('user', 'transaction_type', '-created_at', '-id'),
+            ('user', 'crypto_symbol', '-created_at', '-id'),
+        ]
+    }
+    
+    def save(self, *args, **kwargs):
+        self.updated_at = datetime.utcnow()
+        return super().save(*args, **kwargs)
 
 class MerchantWallet(Document):
     merchant_name = StringField(max_length=100, unique=True, required=True)
@@ -181,7 +226,60 @@ class MerchantWallet(Document):
     api_key = StringField(max_length=100)
     is_active = BooleanField(default=True)
     total_received = FloatField(default=0.0)
+    version = IntField(default=0)  # incremented on every save (ETag marker)
     created_at = DateTimeField(default=datetime.utcnow)
+    updated_at = DateTimeField(default=datetime.utcnow)
+    
+    meta = {
+        'indexes': ['user']
+    }
+    
+    def save(self, *args, **kwargs):
+        self.version += 1
+        self.updated_at = datetime.utcnow()
+        return super().save(*args, **kwargs)
+
+# Append-only double-entry ledger (core.ledger)
+class LedgerEntry(Document):
+    """One leg of a journal; inserted once, never updated or deleted"""
+    seq = IntField(required=True)  # global posting order (LedgerCounter)
+    journal = StringField(required=True)  # legs posted together sum to zero per symbol
+    kind = StringField(required=True)  # trade, transfer, payout, opening, reversal, ...
+    account = StringField(required=True)  # "portfolio:<user id>", "merchant:<id>" or "system:<name>"
+    symbol = StringField(required=True)
+    amount = FloatField(required=True)  # signed: credits positive, debits negative
+    memo = StringField(max_length=500)
+    created_at = DateTimeField(default=datetime.utcnow)
+
+    meta = {
+        'indexes': [
+            {'fields': ['seq'], 'unique': True},
+            # Balance tail: entries of a wallet after its latest snapshot
+            ('account', 'symbol', 'seq'),
+            ('kind', 'account'),
+            'journal',
+        ]
+    }
+
+class BalanceSnapshot(Document):
+    """Running balance of one ledger wallet up to and including entry ``seq``"""
+    account = StringField(required=True)
+    symbol = StringField(required=True)
+    seq = IntField(required=True)
+    balance = FloatField(required=True)
+    entries = IntField(required=True)  # entries folded in since the first one
+    created_at = DateTimeField(default=datetime.utcnow)
+
+    meta = {
+        'indexes': [
+            {'fields': ['account', 'symbol', '-seq'], 'unique': True},
+        ]
+    }
+
+class LedgerCounter(Document):
+    """Source of LedgerEntry.seq; blocks are reserved with one $inc per journal"""
+    id = StringField(primary_key=True)
+    seq = IntField(default=0)
 
 # Curve Cart Integration
 class CurveCart(Document):
@@ -201,3 +299,15 @@ class FaceData(Document):
     encoding = BinaryField(required=True)  # serialized numpy array
     created_at = DateTimeField(default=datetime.utcnow)
 
+class ExternalPriceHistory(Document):
+    """Price history fetched from an external provider, shared by all workers"""
+    key = StringField(required=True, unique=True)  # e.g. "coincap:BTCUSDT"
+    history = ListField(DictField())
+    fetched_at = DateTimeField(required=True)
+    expires_at = DateTimeField()  # removed once too stale to serve
+    
+    meta = {
+        'indexes': [
+            {'fields': ['expires_at'], 'expireAfterSeconds': 0}
+        ]
+    }
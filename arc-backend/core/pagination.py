@@ -0,0 +1,90 @@
+"""
+Keyset pagination for transaction history.
+
+Pages are ordered newest first on ``(created_at, _id)`` and continue after
+the last row of the previous page, which the client passes back as an
+opaque ``cursor``. The ``created_at <= t`` bound keeps each page a single
+range scan of the ``(user, [filter,] -created_at, -_id)`` indexes declared
+on ``Transaction``, however deep the client pages; the ``$or`` only breaks
+ties between rows sharing the boundary timestamp.
+"""
+import base64
+from datetime import datetime
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from django.conf import settings
+
+from .models import Transaction
+
+DEFAULT_PAGE_SIZE = getattr(settings, 'TRANSACTION_PAGE_SIZE', 100)
+MAX_PAGE_SIZE = getattr(settings, 'TRANSACTION_PAGE_MAX', 500)
+
+# query parameter -> (Transaction field, allowed values or None)
+FILTERS = {
+    'type': ('transaction_type', Transaction.transaction_type.choices),
+    'symbol': ('crypto_symbol', None),
+    'status': ('status', Transaction.status.choices),
+}
+
+
+class InvalidPage(ValueError):
+    pass
+
+
+def encode_cursor(created_at, doc_id):
+    raw = f'{created_at.isoformat()}|{doc_id}'.encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """``(created_at, ObjectId)`` from a cursor produced by ``encode_cursor``."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        created_at, doc_id = raw.split('|')
+        return datetime.fromisoformat(created_at), ObjectId(doc_id)
+    except (ValueError, InvalidId, UnicodeDecodeError):
+        raise InvalidPage('Invalid cursor')
+
+
+def page_params(params):
+    """Validate ``limit``/``cursor``/filter query parameters into ``transaction_page`` kwargs."""
+    try:
+        limit = int(params.get('limit', DEFAULT_PAGE_SIZE))
+    except (TypeError, ValueError):
+        raise InvalidPage('limit must be an integer')
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise InvalidPage(f'limit must be between 1 and {MAX_PAGE_SIZE}')
+
+    filters = {}
+    for param, (field, choices) in FILTERS.items():
+        value = params.get(param)
+        if not value:
+            continue
+        if param == 'symbol':
+            value = value.upper()
+        if choices and value not in choices:
+            raise InvalidPage(f'{param} must be one of: {", ".join(choices)}')
+        filters[field] = value
+
+    cursor = params.get('cursor')
+    return {'limit': limit, 'after': decode_cursor(cursor) if cursor else None, 'filters': filters}
+
+
+def transaction_page(user, limit=DEFAULT_PAGE_SIZE, after=None, filters=None):
+    """One page of ``user``'s transactions, newest first; returns ``(transactions, next_cursor)``."""
+    query = {'user': user.id, **(filters or {})}
+    if after is not None:
+        created_at, doc_id = after
+        query['created_at'] = {'$lte': created_at}
+        query['$or'] = [{'created_at': {'$lt': created_at}}, {'_id': {'$lt': doc_id}}]
+
+    # One extra row tells us whether another page exists without a count()
+    transactions = list(
+        Transaction.objects(__raw__=query).order_by('-created_at', '-id').limit(limit + 1)
+    )
+    if len(transactions) <= limit:
+        return transactions, None
+    transactions = transactions[:limit]
+    last = transactions[-1]
+    return transactions, encode_cursor(last.created_at, last.id)
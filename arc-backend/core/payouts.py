@@ -0,0 +1,151 @@
+"""
+Bulk merchant payouts: one request pays (or refunds) many users.
+
+Rows are validated in a single pass with one query each for recipients,
+their portfolios and the merchant's balances; rows that can't be paid are
+reported and skipped. Everything else commits as one unit
+(core.balances.atomic):
+
+    debit     one guarded update of the merchant's portfolio with the total per symbol
+    credits   one unordered bulk_write of positional $inc (credit_many)
+    records   one insert_many with a Transaction per side of every row
+
+so the cost is a handful of round-trips regardless of the number of rows,
+instead of two portfolio reads, two saves and two inserts per recipient.
+"""
+import math
+from collections import defaultdict
+
+from django.conf import settings
+
+from .balances import BalanceError, atomic
+from .models import Portfolio, Transaction, User
+from .utils import generate_transaction_hash
+
+MAX_ROWS = getattr(settings, 'PAYOUT_MAX_ROWS', 5000)
+
+
+class PayoutRejected(ValueError):
+    """The request as a whole can't be processed (as opposed to individual rows)."""
+
+
+def _parse_row(row):
+    """``(recipient, symbol, amount)`` or raise ValueError with the reason."""
+    if not isinstance(row, dict):
+        raise ValueError('Row must be an object')
+    recipient = str(row.get('recipient') or '').strip()
+    symbol = str(row.get('symbol') or '').strip().upper()
+    if not recipient or not symbol:
+        raise ValueError('recipient and symbol are required')
+    try:
+        amount = float(row.get('amount'))
+    except (TypeError, ValueError):
+        raise ValueError('amount must be a number')
+    if not math.isfinite(amount) or amount <= 0:
+        raise ValueError('amount must be positive')
+    return recipient, symbol, amount
+
+
+def run_payout(merchant, rows, memo=''):
+    """Pay ``rows`` of ``{recipient (username), symbol, amount}`` from ``merchant``'s portfolio.
+
+    Returns ``{'paid', 'failed', 'totals', 'results'}`` with one result per
+    row, in request order: ``{'index', 'status': 'paid'|'failed', 'tx_hash'|'error'}``.
+    """
+    if not isinstance(rows, list) or not rows:
+        raise PayoutRejected('payouts must be a non-empty list')
+    if len(rows) > MAX_ROWS:
+        raise PayoutRejected(f'At most {MAX_ROWS} payouts per request')
+
+    results = [None] * len(rows)
+    parsed = {}
+    for index, row in enumerate(rows):
+        try:
+            parsed[index] = _parse_row(row)
+        except ValueError as e:
+            results[index] = {'index': index, 'status': 'failed', 'error': str(e)}
+
+    users = {
+        user.username: user
+        for user in User.objects(username__in=list({recipient for recipient, _, _ in parsed.values()})).only('username')
+    }
+    with_portfolio = set(Portfolio._get_collection().distinct(
+        'user', {'user': {'$in': [user.id for user in users.values()]}}
+    ))
+    merchant_doc = Portfolio._get_collection().find_one(
+        {'user': merchant.id}, {'_id': 0, 'wallets.symbol': 1, 'wallets.balance': 1, 'wallets.public_key': 1}
+    )
+    if merchant_doc is None:
+        raise PayoutRejected('Merchant portfolio not found')
+    merchant_wallets = {wallet['symbol']: wallet for wallet in merchant_doc.get('wallets', [])}
+
+    payable = {}
+    for index, (recipient, symbol, amount) in parsed.items():
+        user = users.get(recipient)
+        if user is None:
+            error = 'Unknown recipient'
+        elif user.id == merchant.id:
+            error = 'Cannot pay yourself'
+        elif user.id not in with_portfolio:
+            error = 'Recipient has no portfolio'
+        else:
+            payable[index] = (user, symbol, amount)
+            continue
+        results[index] = {'index': index, 'status': 'failed', 'error': error}
+
+    # Group the debits; a symbol the merchant can't cover fails all of its rows
+    totals = defaultdict(float)
+    for user, symbol, amount in payable.values():
+        totals[symbol] += amount
+    for symbol, total in list(totals.items()):
+        if merchant_wallets.get(symbol, {}).get('balance', 0.0) < total:
+            for index in [i for i, (_, s, _) in payable.items() if s == symbol]:
+                results[index] = {'index': index, 'status': 'failed', 'error': f'Insufficient {symbol} balance for this payout'}
+                del payable[index]
+            del totals[symbol]
+
+    if payable:
+        credits = defaultdict(float)
+        for user, symbol, amount in payable.values():
+            credits[(user.id, symbol)] += amount
+        hashes = {index: (generate_transaction_hash(), generate_transaction_hash()) for index in payable}
+        memo = memo or f'Payout from {merchant.username}'
+
+        def pay(batch):
+            batch.apply(merchant, {symbol: -total for symbol, total in totals.items()})
+            addresses = batch.credit_many(credits)
+            records = []
+            for index, (user, symbol, amount) in payable.items():
+                from_address = merchant_wallets[symbol].get('public_key')
+                to_address = addresses.get((user.id, symbol))
+                sent_hash, received_hash = hashes[index]
+                records.append(Transaction(
+                    user=merchant, transaction_type='transfer', crypto_symbol=symbol, amount=-amount,
+                    to_address=to_address, from_address=from_address, to_user=user,
+                    status='confirmed', tx_hash=sent_hash, memo=memo
+                ))
+                records.append(Transaction(
+                    user=user, transaction_type='transfer', crypto_symbol=symbol, amount=amount,
+                    to_address=to_address, from_address=from_address,
+                    status='confirmed', tx_hash=received_hash, memo=memo
+                ))
+            batch.insert(Transaction, records)
+
+        try:
+            atomic(pay, kind='payout', memo=memo)
+        except BalanceError as e:
+            # Balances changed since validation (e.g. a concurrent payout): nothing was applied
+            for index in payable:
+                results[index] = {'index': index, 'status': 'failed', 'error': str(e)}
+            payable = {}
+            totals = {}
+        else:
+            for index in payable:
+                results[index] = {'index': index, 'status': 'paid', 'tx_hash': hashes[index][1]}
+
+    return {
+        'paid': len(payable),
+        'failed': len(rows) - len(payable),
+        'totals': dict(totals),
+        'results': results,
+    }
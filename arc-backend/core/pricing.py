@@ -0,0 +1,111 @@
+"""
+Price snapshots shared by every read path that needs current prices.
+
+A snapshot holds all active TradingPairs loaded with a single projected
+query and is served from memory until it is older than PRICE_SNAPSHOT_TTL
+(or until a new tick is published into it), so valuing a portfolio or
+listing market data no longer costs one query per pair.
+"""
+import threading
+import time
+
+from django.conf import settings
+
+from .models import TradingPair
+
+QUOTE_SYMBOL = 'USDT'  # portfolio values are quoted in USDT (pegged to USD)
+
+SNAPSHOT_FIELDS = [
+    'pair', 'base_symbol', 'quote_symbol', 'current_price', 'price_change_24h',
+    'volume_24h', 'high_24h', 'low_24h', 'last_updated',
+]
+
+
+class PriceSnapshot:
+    """Immutable view of all active pairs at one point in time."""
+
+    def __init__(self, pairs):
+        # Pair ids (for references such as Trade.pair) are kept out of the public rows
+        self.ids = {row['pair']: row.pop('_id', None) for row in pairs}
+        self.pairs = {row['pair']: row for row in pairs}
+        latest = max((row['last_updated'] for row in pairs if row.get('last_updated')), default=None)
+        # Derived from the data, so every worker reports the same version for the same tick
+        self.version = int(latest.timestamp() * 1000) if latest else 0
+        self.loaded_at = time.monotonic()
+
+    def __iter__(self):
+        return iter(self.pairs.values())
+
+    def get(self, pair_name):
+        return self.pairs.get(pair_name)
+
+    def usd_price(self, symbol):
+        """Current USD price of ``symbol`` (0.0 when there is no active USDT pair)."""
+        if symbol == QUOTE_SYMBOL:
+            return 1.0
+        row = self.pairs.get(f'{symbol}{QUOTE_SYMBOL}')
+        return row['current_price'] if row and row['current_price'] > 0 else 0.0
+
+
+class PriceSnapshotService:
+    def __init__(self, ttl=5.0):
+        self.ttl = ttl
+        self._snapshot = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        snapshot = self._snapshot
+        if snapshot is None or time.monotonic() - snapshot.loaded_at > self.ttl:
+            snapshot = self.refresh()
+        return snapshot
+
+    def refresh(self):
+        """Reload every active pair in one query."""
+        projection = {field: 1 for field in SNAPSHOT_FIELDS}
+        rows = list(TradingPair._get_collection().find({'is_active': True}, projection))
+        for row in rows:
+            for field in SNAPSHOT_FIELDS:
+                row.setdefault(field, 0.0)
+        return self.publish(rows)
+
+    def publish_pairs(self, pairs):
+        """Install a snapshot built from TradingPair documents that were just ticked."""
+        return self.publish([
+            dict({field: getattr(pair, field) for field in SNAPSHOT_FIELDS}, _id=pair.id) for pair in pairs
+        ])
+
+    def publish(self, rows):
+        """Install freshly computed pair rows (e.g. from the price ticker) without a query."""
+        snapshot = PriceSnapshot(rows)
+        with self._lock:
+            self._snapshot = snapshot
+        return snapshot
+
+
+price_snapshots = PriceSnapshotService(ttl=getattr(settings, 'PRICE_SNAPSHOT_TTL', 5.0))
+
+
+def value_wallets(wallets, snapshot):
+    """
+    Value ``wallets`` against ``snapshot`` in one pass.
+
+    Returns ``(total_value_usd, rows)`` where each row carries the wallet's
+    ``current_price`` and ``value_usd``.
+    """
+    total_value = 0.0
+    rows = []
+    for wallet in wallets:
+        current_price = snapshot.usd_price(wallet.symbol)
+        value_usd = wallet.balance * current_price
+        if wallet.balance > 0:
+            total_value += value_usd
+        rows.append({
+            'symbol': wallet.symbol,
+            'name': wallet.name,
+            'balance': wallet.balance,
+            'value_usd': value_usd,
+            'current_price': current_price,
+            'public_key': wallet.public_key,
+            'is_active': wallet.is_active,
+        })
+    return total_value, rows
@@ -0,0 +1,81 @@
+"""
+Response renderers selected by content negotiation.
+
+ORJSONRenderer is the default: orjson encodes datetimes, dicts/lists and
+NumPy arrays/scalars natively in C, and ``_default`` covers the remaining
+types our views hand back (ObjectId/DBRef, Decimal, lazy strings, sets).
+Clients sending ``Accept: application/msgpack`` get MessagePack instead.
+"""
+import base64
+import datetime
+import decimal
+
+import numpy as np
+import orjson
+from bson import DBRef, ObjectId
+from django.utils.functional import Promise
+from rest_framework.renderers import BaseRenderer
+
+try:
+    import msgpack
+except ImportError:  # MsgPackRenderer is only registered when msgpack is installed (see settings)
+    msgpack = None
+
+ORJSON_OPTIONS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+
+def _default(obj):
+    """Types orjson/msgpack don't handle natively, encoded the way DRF's JSONEncoder does."""
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    if isinstance(obj, DBRef):
+        return str(obj.id)
+    if isinstance(obj, decimal.Decimal):
+        return float(obj)
+    if isinstance(obj, Promise):
+        return str(obj)
+    if isinstance(obj, datetime.timedelta):
+        return str(obj.total_seconds())
+    if isinstance(obj, (set, frozenset, tuple)):
+        return list(obj)
+    if isinstance(obj, bytes):
+        return base64.b64encode(obj).decode()
+    if hasattr(obj, 'tolist'):  # NumPy types orjson rejects (e.g. float16) / msgpack doesn't know
+        return obj.tolist()
+    raise TypeError(f'Object of type {type(obj).__name__} is not serializable')
+
+
+def dumps(data):
+    """Encode ``data`` as JSON bytes (shared by the renderer and core.streaming)."""
+    return orjson.dumps(data, default=_default, option=ORJSON_OPTIONS)
+
+
+class ORJSONRenderer(BaseRenderer):
+    media_type = 'application/json'
+    format = 'json'
+    charset = None  # orjson always emits UTF-8
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return dumps(data)
+
+
+def _msgpack_default(obj):
+    if isinstance(obj, (datetime.datetime, datetime.date, datetime.time)):
+        return obj.isoformat()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    return _default(obj)
+
+
+class MsgPackRenderer(BaseRenderer):
+    media_type = 'application/msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return msgpack.packb(data, default=_msgpack_default, use_bin_type=True)
@@ -0,0 +1,201 @@
+"""
+Vectorized multi-pair price simulation.
+
+PriceEngine keeps the state of every simulated pair in parallel NumPy
+arrays and advances all of them in one step, so a tick over thousands of
+pairs costs a handful of array operations. TradingPair.simulate_price and
+utils.run_price_tick are thin persistence adapters around it:
+``sync`` loads pair state from documents, ``step`` advances prices and
+``apply`` writes the results back onto the documents.
+
+Models:
+    bounded_walk  uniform move of up to +/- volatility per tick (the original
+                  behaviour), clamped to a band around the base price
+    gbm           geometric Brownian motion with mean reversion of the
+                  log-price towards the base price (Ornstein-Uhlenbeck)
+
+``correlation`` adds a common market factor so pairs tend to move together.
+"""
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+from django.conf import settings
+
+# Base prices used when a pair has none stored yet
+DEFAULT_BASE_PRICES = {
+    'BTCUSDT': 67234.50,
+    'ETHUSDT': 3456.78,
+    'ARCUSDT': 0.45,  # Our native token
+    'SOLUSDT': 156.23,
+    'BNBUSDT': 542.67,
+    'ADAUSDT': 0.78,
+    'DOTUSDT': 12.34,
+    'LINKUSDT': 23.45
+}
+
+MODELS = ('bounded_walk', 'gbm')
+
+
+class PriceEngine:
+    def __init__(self, model='bounded_walk', correlation=0.0, mean_reversion=0.05, band=0.2, seed=None):
+        if model not in MODELS:
+            raise ValueError(f'Unknown price model {model!r}, expected one of {MODELS}')
+        self.model = model
+        self.correlation = correlation
+        self.mean_reversion = mean_reversion
+        self.band = band
+        self.rng = np.random.default_rng(seed)
+        self._lock = threading.Lock()
+
+        self.names = []
+        self.index = {}
+        self.price = np.empty(0)
+        self.base = np.empty(0)
+        self.volatility = np.empty(0)
+        self.change = np.empty(0)
+        self.volume = np.empty(0)
+        self.high = np.empty(0)
+        self.low = np.empty(0)
+
+        self.pairs = []  # TradingPair documents advanced by ``tick``
+        self._rows = np.empty(0, dtype=np.intp)
+        self._tracked_at = None  # monotonic time of the last ``track``; None forces a reload
+
+    def __len__(self):
+        return len(self.names)
+
+    def add_pairs(self, names, base_prices, volatilities, prices=None):
+        """Register new pairs; ``prices`` defaults to the base prices."""
+        base = np.asarray(base_prices, dtype=np.float64)
+        price = base.copy() if prices is None else np.asarray(prices, dtype=np.float64)
+        start = len(self.names)
+        for offset, name in enumerate(names):
+            self.index[name] = start + offset
+        self.names.extend(names)
+        self.price = np.concatenate([self.price, price])
+        self.base = np.concatenate([self.base, base])
+        self.volatility = np.concatenate([self.volatility, np.asarray(volatilities, dtype=np.float64)])
+        zeros = np.zeros(len(names))
+        self.change = np.concatenate([self.change, zeros])
+        self.volume = np.concatenate([self.volume, zeros])
+        self.high = np.concatenate([self.high, price])
+        self.low = np.concatenate([self.low, price])
+
+    def sync(self, pairs):
+        """Load current state from TradingPair documents (the database stays the source of truth)."""
+        new = [pair for pair in pairs if pair.pair not in self.index]
+        if new:
+            self.add_pairs(
+                [pair.pair for pair in new],
+                [pair.base_price or DEFAULT_BASE_PRICES.get(pair.pair, 1.0) for pair in new],
+                [pair.volatility for pair in new],
+            )
+        rows = np.fromiter((self.index[pair.pair] for pair in pairs), dtype=np.intp, count=len(pairs))
+        self.base[rows] = [pair.base_price or DEFAULT_BASE_PRICES.get(pair.pair, 1.0) for pair in pairs]
+        self.volatility[rows] = [pair.volatility for pair in pairs]
+        current = np.fromiter((pair.current_price for pair in pairs), dtype=np.float64, count=len(pairs))
+        self.price[rows] = np.where(current > 0, current, self.base[rows])
+        return rows
+
+    def track(self, pairs):
+        """Load ``pairs`` (TradingPair documents) as the set ``tick`` advances."""
+        pairs = list(pairs)
+        with self._lock:
+            self._rows = self.sync(pairs)
+            self.pairs = pairs
+            self._tracked_at = time.monotonic()
+
+    def invalidate(self):
+        """Reload the tracked pairs before the next tick."""
+        self._tracked_at = None
+
+    def needs_reload(self, max_age):
+        tracked_at = self._tracked_at
+        return tracked_at is None or time.monotonic() - tracked_at > max_age
+
+    def tick(self, now=None):
+        """Advance every tracked pair from the engine's state and write it back; returns the pairs."""
+        now = now or datetime.utcnow()
+        with self._lock:
+            pairs, rows = self.pairs, self._rows
+            self.step(rows, now)
+            self.apply(pairs, rows, now)
+            return pairs
+
+    def _shocks(self, count):
+        """Standard normal shocks sharing one market factor with weight ``correlation``."""
+        idiosyncratic = self.rng.standard_normal(count)
+        if not self.correlation:
+            return idiosyncratic
+        market = self.rng.standard_normal()
+        return np.sqrt(self.correlation) * market + np.sqrt(1 - self.correlation) * idiosyncratic
+
+    def step(self, rows=None, now=None):
+        """Advance the selected rows (default: every pair) by one tick."""
+        if rows is None:
+            rows = np.arange(len(self.names))
+        now = now or datetime.utcnow()
+        count = len(rows)
+        if count == 0:
+            return rows
+
+        # Lower volatility during night hours (market hours simulation)
+        time_factor = 0.5 if 22 <= now.hour or now.hour <= 6 else 1.0
+        sigma = self.volatility[rows] * time_factor
+        old = self.price[rows]
+        base = self.base[rows]
+
+        if self.model == 'gbm':
+            log_price = np.log(old)
+            drift = self.mean_reversion * (np.log(base) - log_price) - 0.5 * sigma ** 2
+            new = np.exp(log_price + drift + sigma * self._shocks(count))
+        elif self.correlation:
+            # Correlated bounded walk: normal shocks scaled to the uniform's spread
+            new = old * (1 + np.clip(self._shocks(count) * sigma / np.sqrt(3), -sigma, sigma))
+        else:
+            new = old * (1 + self.rng.uniform(-sigma, sigma))
+
+        if self.band is not None:
+            new = np.clip(new, base * (1 - self.band), base * (1 + self.band))
+
+        spread = new * 0.05  # 5% high/low variation
+        self.change[rows] = (new - old) / old * 100
+        self.price[rows] = np.round(new, 8)
+        self.volume[rows] = self.rng.uniform(1000000, 50000000, count)
+        self.high[rows] = np.round(new + self.rng.uniform(0, 1, count) * spread, 8)
+        self.low[rows] = np.round(new - self.rng.uniform(0, 1, count) * spread, 8)
+        return rows
+
+    def advance(self, pairs, now=None):
+        """Sync, step and write back ``pairs`` as one operation; returns the new prices."""
+        now = now or datetime.utcnow()
+        with self._lock:
+            rows = self.sync(pairs)
+            self.step(rows, now)
+            self.apply(pairs, rows, now)
+            return self.price[rows].copy()
+
+    def apply(self, pairs, rows, now=None):
+        """Copy simulated values for ``rows`` back onto the matching documents."""
+        now = now or datetime.utcnow()
+        for pair, row in zip(pairs, rows.tolist()):
+            pair.base_price = float(self.base[row])
+            pair.current_price = float(self.price[row])
+            pair.price_change_24h = float(self.change[row])
+            pair.volume_24h = float(self.volume[row])
+            pair.high_24h = float(self.high[row])
+            pair.low_24h = float(self.low[row])
+            pair.last_updated = now
+
+
+# Seconds between reloads of the tracked pairs from Mongo
+PAIRS_RELOAD = getattr(settings, 'PRICE_PAIRS_RELOAD', 300.0)
+
+price_engine = PriceEngine(
+    model=getattr(settings, 'PRICE_SIM_MODEL', 'bounded_walk'),
+    correlation=getattr(settings, 'PRICE_SIM_CORRELATION', 0.0),
+    mean_reversion=getattr(settings, 'PRICE_SIM_MEAN_REVERSION', 0.05),
+    seed=getattr(settings, 'PRICE_SIM_SEED', None),
+)
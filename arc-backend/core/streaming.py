@@ -0,0 +1,379 @@
+"""
+Server push for market data over ASGI (Server-Sent Events and WebSocket).
+
+The stream runs in its own ASGI process (``arc_backend.asgi``), next to the
+threaded WSGI process that serves the REST API, so long-lived connections
+never hold API threads and slow API views never stall the stream.
+``StreamRouter`` serves ``/api/stream/`` and answers 404 for anything else.
+
+Topics:
+    ticks     every price tick (all active pairs, same rows as /api/market-data/)
+    candles   current 1m candle of every pair after each tick
+    balances  the authenticated user's wallet balances whenever they change
+
+Ticks, candles and balances are written by other processes (the API's
+price ticker or the ``init_crypto_system --simulate`` sidecar, and every
+balance update), so ``StreamFeed`` follows them in MongoDB: every
+STREAM_POLL_INTERVAL it reloads the price snapshot (one query) and, when the
+tick advanced, publishes it with the current candles (one query); then it
+reads the portfolios of users with an open balances stream (one query) and
+publishes those whose balances changed. Nothing is read while no one is
+subscribed to a topic.
+
+``market_stream.publish`` encodes each message once and hands the same
+bytes to every subscriber. A subscriber keeps only the latest undelivered
+message per topic, so a slow client never builds a backlog: it simply skips
+to the newest tick when it catches up (drop-to-latest).
+
+Clients: ``new EventSource('/api/stream/?topics=ticks,candles')`` or a
+WebSocket to the same path. ``balances`` needs the user: an Authorization
+header, or (browsers can't set headers on EventSource/WebSocket) a
+``ticket=`` from POST /api/stream/ticket/. Tickets expire after
+STREAM_TICKET_TTL seconds and are consumed by the first stream that uses
+them, so the long-lived API token never appears in a URL.
+"""
+import asyncio
+import json
+import logging
+import secrets
+import threading
+from collections import defaultdict, namedtuple
+from datetime import datetime, timedelta
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from bson import ObjectId
+from django.conf import settings
+
+from .auth import parse_auth_header, resolve_token
+from .models import Portfolio, StreamTicket
+from .renderers import dumps
+
+logger = logging.getLogger(__name__)
+
+TOPICS = ('ticks', 'candles', 'balances')
+PRIVATE_TOPICS = ('balances',)
+HEARTBEAT_SECONDS = getattr(settings, 'STREAM_HEARTBEAT', 15.0)
+TICKET_SECONDS = getattr(settings, 'STREAM_TICKET_TTL', 30.0)
+BALANCES_PREFIX = 'balances:'
+
+Frame = namedtuple('Frame', 'event sse text')
+
+
+def encode_frame(event, data):
+    """Encode a message once for both transports."""
+    body = dumps({'topic': event, 'data': data})
+    return Frame(event, b'event: ' + event.encode() + b'\ndata: ' + body + b'\n\n', body.decode())
+
+
+class Subscriber:
+    """One connected client: latest undelivered frame per topic plus a wake-up event."""
+
+    def __init__(self, topics, loop):
+        self.topics = topics
+        self.loop = loop
+        self.dropped = 0
+        self.closed = False
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._wakeup = asyncio.Event()
+
+    def offer(self, topic, frame):
+        """Queue ``frame``, replacing an undelivered one for the same topic (any thread)."""
+        with self._lock:
+            if topic in self._pending:
+                self.dropped += 1
+            self._pending[topic] = frame
+        self.wake()
+
+    def wake(self):
+        try:
+            self.loop.call_soon_threadsafe(self._wakeup.set)
+        except RuntimeError:
+            self.closed = True  # event loop already closed
+
+    async def next_frames(self, timeout):
+        """Frames queued since the last call; empty after ``timeout`` seconds of silence."""
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            return []
+        self._wakeup.clear()
+        with self._lock:
+            frames, self._pending = list(self._pending.values()), {}
+        return frames
+
+
+class Broadcaster:
+    def __init__(self):
+        self._subscribers = defaultdict(set)  # topic -> {Subscriber}
+        self._lock = threading.Lock()
+        self.published = 0
+
+    def subscribe(self, topics, loop):
+        subscriber = Subscriber(topics, loop)
+        with self._lock:
+            for topic in topics:
+                self._subscribers[topic].add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            for topic in subscriber.topics:
+                subscribers = self._subscribers.get(topic)
+                if subscribers is not None:
+                    subscribers.discard(subscriber)
+                    if not subscribers:
+                        del self._subscribers[topic]
+
+    def has_subscribers(self, topic):
+        return bool(self._subscribers.get(topic))
+
+    def subscribed_users(self):
+        """Ids of users with an open balances stream."""
+        with self._lock:
+            topics = [topic for topic in self._subscribers if topic.startswith(BALANCES_PREFIX)]
+        return {ObjectId(topic[len(BALANCES_PREFIX):]) for topic in topics}
+
+    def publish(self, topic, data):
+        """Fan ``data`` out to every subscriber of ``topic``; returns the number reached."""
+        with self._lock:
+            subscribers = list(self._subscribers.get(topic, ()))
+        if not subscribers:
+            return 0
+        frame = encode_frame(topic.split(':', 1)[0], data)
+        for subscriber in subscribers:
+            subscriber.offer(topic, frame)
+        self.published += 1
+        return len(subscribers)
+
+
+market_stream = Broadcaster()
+
+
+def balances_topic(user_id):
+    return f'{BALANCES_PREFIX}{user_id}'
+
+
+class StreamFeed:
+    """Publishes ticks, candles and balance changes written by other processes (see the module docstring)."""
+
+    def __init__(self, broadcaster, interval=5.0):
+        self.broadcaster = broadcaster
+        self.interval = interval
+        self.version = None  # PriceSnapshot.version last published
+        self.sent = {}  # user id -> balances last published
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='stream-feed', daemon=True)
+            self._thread.start()
+        logger.info('Stream feed started', extra={'fields': {'interval_s': self.interval}})
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.poll()
+            except Exception:
+                logger.exception('Stream feed poll failed')
+
+    def poll(self):
+        from .candles import current_candles
+        from .pricing import price_snapshots
+
+        if self.broadcaster.has_subscribers('ticks') or self.broadcaster.has_subscribers('candles'):
+            snapshot = price_snapshots.refresh()
+            if snapshot.version != self.version:
+                self.version = snapshot.version
+                self.broadcaster.publish('ticks', list(snapshot))
+                if self.broadcaster.has_subscribers('candles'):
+                    self.broadcaster.publish('candles', current_candles(snapshot))
+        self.publish_balances()
+
+    def publish_balances(self):
+        subscribed = self.broadcaster.subscribed_users()
+        self.sent = {user_id: sent for user_id, sent in self.sent.items() if user_id in subscribed}
+        if not subscribed:
+            return
+        for doc in Portfolio._get_collection().find(
+            {'user': {'$in': list(subscribed)}}, {'_id': 0, 'user': 1, 'wallets.symbol': 1, 'wallets.balance': 1}
+        ):
+            balances = [
+                {'symbol': wallet['symbol'], 'balance': wallet.get('balance', 0.0)} for wallet in doc.get('wallets', [])
+            ]
+            if self.sent.get(doc['user']) != balances:
+                self.sent[doc['user']] = balances
+                self.broadcaster.publish(balances_topic(doc['user']), balances)
+
+
+stream_feed = StreamFeed(market_stream, interval=getattr(settings, 'STREAM_POLL_INTERVAL', 2.0))
+
+
+def start_stream_feed():
+    stream_feed.start()
+
+
+def issue_ticket(user):
+    """A new stream ticket for ``user``; returns ``(ticket, expires_in seconds)``."""
+    ticket = secrets.token_urlsafe(32)
+    StreamTicket(ticket=ticket, user=user, expires_at=datetime.utcnow() + timedelta(seconds=TICKET_SECONDS)).save()
+    return ticket, TICKET_SECONDS
+
+
+def redeem_ticket(ticket):
+    """User id a ticket was issued to, or None; a ticket is only accepted once."""
+    if not ticket:
+        return None
+    doc = StreamTicket._get_collection().find_one_and_delete(
+        {'ticket': ticket, 'expires_at': {'$gt': datetime.utcnow()}}, {'_id': 0, 'user': 1}
+    )
+    return doc['user'] if doc else None
+
+
+def _cors_headers(scope):
+    """Access-Control-Allow-Origin for the stream (it bypasses Django's CORS middleware)."""
+    origin = dict(scope.get('headers', [])).get(b'origin', b'').decode()
+    allowed = getattr(settings, 'CORS_ALLOW_ALL_ORIGINS', False) or origin in getattr(settings, 'CORS_ALLOWED_ORIGINS', [])
+    if not origin or not allowed:
+        return []
+    return [(b'access-control-allow-origin', origin.encode()), (b'access-control-allow-credentials', b'true'), (b'vary', b'Origin')]
+
+
+class StreamRouter:
+    """ASGI app serving ``path`` as a market stream; anything else goes to ``app`` (404 without one)."""
+
+    def __init__(self, app=None, path='/api/stream/', broadcaster=market_stream):
+        self.app = app
+        self.path = path.rstrip('/')
+        self.broadcaster = broadcaster
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] in ('http', 'websocket') and scope['path'].rstrip('/') == self.path:
+            if scope['type'] == 'http':
+                return await self.serve_sse(scope, receive, send)
+            return await self.serve_websocket(scope, receive, send)
+        if self.app is not None and scope['type'] != 'websocket':
+            return await self.app(scope, receive, send)
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                await send({'type': message['type'] + '.complete'})
+                if message['type'] == 'lifespan.shutdown':
+                    return
+        if scope['type'] == 'websocket':
+            await receive()
+            return await send({'type': 'websocket.close', 'code': 1000})
+        await send({'type': 'http.response.start', 'status': 404,
+                    'headers': [(b'content-type', b'application/json')] + _cors_headers(scope)})
+        await send({'type': 'http.response.body', 'body': b'{"error": "Not found"}'})
+
+    async def _subscription(self, scope):
+        """Resolve requested topics; returns ``(topics, error)``."""
+        query = parse_qs(scope.get('query_string', b'').decode())
+        requested = [t for t in ','.join(query.get('topics', ['ticks'])).split(',') if t]
+        unknown = [t for t in requested if t not in TOPICS]
+        if unknown or not requested:
+            return None, f'Unknown topics: {", ".join(unknown)}. Use: {", ".join(TOPICS)}.'
+
+        topics = [t for t in requested if t not in PRIVATE_TOPICS]
+        if any(t in PRIVATE_TOPICS for t in requested):
+            ticket = query.get('ticket', [None])[0]
+            if ticket:
+                user_id = await sync_to_async(redeem_ticket)(ticket)
+            else:
+                token = parse_auth_header(dict(scope.get('headers', [])).get(b'authorization', b'').decode())
+                user = await sync_to_async(resolve_token)(token)
+                user_id = user.id if user else None
+            if user_id is None:
+                return None, 'Authentication required for balances'
+            topics.append(balances_topic(user_id))
+        return topics, None
+
+    async def _initial_frames(self, topics):
+        """Current state so a client renders immediately instead of waiting for the next tick."""
+        if 'ticks' not in topics:
+            return []
+        from .pricing import price_snapshots
+        snapshot = await sync_to_async(price_snapshots.get)()
+        return [encode_frame('ticks', list(snapshot))]
+
+    async def _watch_disconnect(self, receive, subscriber, disconnect_type):
+        while True:
+            message = await receive()
+            if message['type'] == disconnect_type:
+                subscriber.closed = True
+                subscriber.wake()
+                return
+
+    async def _pump(self, scope, receive, subscriber, disconnect_type, send_frame, send_heartbeat):
+        watcher = asyncio.ensure_future(self._watch_disconnect(receive, subscriber, disconnect_type))
+        try:
+            while not subscriber.closed:
+                frames = await subscriber.next_frames(HEARTBEAT_SECONDS)
+                if subscriber.closed:
+                    break
+                if not frames:
+                    await send_heartbeat()
+                for frame in frames:
+                    await send_frame(frame)
+        except (OSError, RuntimeError) as e:
+            logger.debug('Stream client went away', extra={'fields': {'error': e}})
+        finally:
+            watcher.cancel()
+            self.broadcaster.unsubscribe(subscriber)
+            logger.debug('Stream closed', extra={'fields': {'topics': subscriber.topics, 'dropped': subscriber.dropped}})
+
+    async def serve_sse(self, scope, receive, send):
+        topics, error = await self._subscription(scope)
+        if error:
+            body = json.dumps({'error': error}).encode()
+            await send({'type': 'http.response.start', 'status': 401 if 'Authentication' in error else 400,
+                        'headers': [(b'content-type', b'application/json')] + _cors_headers(scope)})
+            return await send({'type': 'http.response.body', 'body': body})
+
+        subscriber = self.broadcaster.subscribe(topics, asyncio.get_running_loop())
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [
+            (b'content-type', b'text/event-stream'),
+            (b'cache-control', b'no-cache'),
+            (b'x-accel-buffering', b'no'),  # don't let nginx buffer the stream
+        ] + _cors_headers(scope)})
+        for frame in await self._initial_frames(topics):
+            await send({'type': 'http.response.body', 'body': frame.sse, 'more_body': True})
+
+        async def send_frame(frame):
+            await send({'type': 'http.response.body', 'body': frame.sse, 'more_body': True})
+
+        async def send_heartbeat():
+            await send({'type': 'http.response.body', 'body': b': ping\n\n', 'more_body': True})
+
+        await self._pump(scope, receive, subscriber, 'http.disconnect', send_frame, send_heartbeat)
+
+    async def serve_websocket(self, scope, receive, send):
+        message = await receive()
+        if message['type'] != 'websocket.connect':
+            return
+        topics, error = await self._subscription(scope)
+        if error:
+            return await send({'type': 'websocket.close', 'code': 4401 if 'Authentication' in error else 4400})
+
+        subscriber = self.broadcaster.subscribe(topics, asyncio.get_running_loop())
+        await send({'type': 'websocket.accept'})
+        for frame in await self._initial_frames(topics):
+            await send({'type': 'websocket.send', 'text': frame.text})
+
+        async def send_frame(frame):
+            await send({'type': 'websocket.send', 'text': frame.text})
+
+        async def send_heartbeat():
+            await send({'type': 'websocket.send', 'text': '{"topic":"ping"}'})
+
+        await self._pump(scope, receive, subscriber, 'websocket.disconnect', send_frame, send_heartbeat)
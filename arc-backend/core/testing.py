@@ -0,0 +1,67 @@
+"""
+Test helpers for keeping views inside their Mongo query budgets.
+
+Usage::
+
+    class PortfolioTests(QueryBudgetMixin, MongoTestCase):
+        def test_portfolio_budget(self):
+            response = self.client.get('/api/portfolio/', HTTP_AUTHORIZATION=f'Bearer {token}')
+            self.assertWithinQueryBudget(response)
+
+        def test_valuation_is_batched(self):
+            with self.assertMaxDbCommands(2):
+                calculate_portfolio_value(user)
+
+MongoTestCase runs against the throwaway database in MONGODB_TEST_URI
+(dropped afterwards) and is skipped when it isn't set, so tests never touch
+the configured MONGODB_URI.
+"""
+import os
+import unittest
+from contextlib import contextmanager
+
+import mongoengine
+from django.test import SimpleTestCase
+
+from .dbstats import command_listener, track_db_stats
+from .middleware import get_query_budget
+
+
+class MongoTestCase(SimpleTestCase):
+    """Switches the default connection to MONGODB_TEST_URI for the rest of the run."""
+
+    @classmethod
+    def setUpClass(cls):
+        uri = os.environ.get('MONGODB_TEST_URI')
+        if not uri:
+            raise unittest.SkipTest('MONGODB_TEST_URI is not set')
+        mongoengine.disconnect(alias='default')
+        mongoengine.connect(host=uri, alias='default', serverSelectionTimeoutMS=5000, event_listeners=[command_listener])
+        cls.addClassCleanup(cls._drop_database)
+        super().setUpClass()
+
+    @classmethod
+    def _drop_database(cls):
+        db = mongoengine.get_db()
+        db.client.drop_database(db.name)
+
+
+class QueryBudgetMixin:
+    """TestCase mixin that fails when a view or block exceeds its Mongo command budget."""
+
+    def assertWithinQueryBudget(self, response, budget=None):
+        path = response.wsgi_request.path
+        if budget is None:
+            budget = get_query_budget(path)
+        used = int(response['X-Db-Queries'])
+        self.assertLessEqual(
+            used, budget,
+            f'{response.wsgi_request.method} {path} ran {used} Mongo commands, budget is {budget}',
+        )
+
+    @contextmanager
+    def assertMaxDbCommands(self, limit):
+        with track_db_stats() as stats:
+            yield stats
+        shapes = ', '.join(f'{shape} x{count}' for shape, count in stats.shapes.most_common())
+        self.assertLessEqual(stats.commands, limit, f'{stats.commands} Mongo commands (limit {limit}): {shapes}')
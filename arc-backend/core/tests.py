@@ -1,3 +1,308 @@
-from django.test import TestCase
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
-# Create your tests here.
+from django.test import RequestFactory, SimpleTestCase
+from rest_framework.decorators import api_view, authentication_classes, permission_classes, renderer_classes
+from rest_framework.renderers import StaticHTMLRenderer
+from rest_framework.response import Response
+
+from .external_history import CircuitBreaker, CoinCapClient, HistoryFallback, MemoryHistoryStore, UpstreamError
+from .auth import resolve_token
+from .conditional import conditional_get
+from .matching import OrderBook, RestingOrder
+from .models import CryptoWallet, Portfolio, Token, TradingPair, User
+from .pricing import price_snapshots
+from .renderers import ORJSONRenderer
+from .testing import MongoTestCase, QueryBudgetMixin
+
+
+class StubCoinCapHandler(BaseHTTPRequestHandler):
+    """Serves /assets/<id>/history; behaviour is driven by attributes on the server."""
+
+    def do_GET(self):
+        self.server.calls += 1
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        if self.server.fail:
+            self.send_response(503)
+            self.end_headers()
+            return
+        rows = [
+            {'priceUsd': str(self.server.price + i), 'time': 1700000000000 + i * 3600000}
+            for i in range(3)
+        ]
+        rows.extend(self.server.extra_rows)
+        body = json.dumps({'data': rows}).encode()
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # the client gave up (read timeout test)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class HistoryFallbackTests(SimpleTestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubCoinCapHandler)
+        self.server.calls = 0
+        self.server.delay = 0
+        self.server.fail = False
+        self.server.price = 100.0
+        self.server.extra_rows = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        client = CoinCapClient(
+            f'http://127.0.0.1:{self.server.server_port}', connect_timeout=0.5, read_timeout=0.3,
+        )
+        self.breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+        self.fallback = HistoryFallback(
+            client, MemoryHistoryStore(), fresh_ttl=60, stale_ttl=600, breaker=self.breaker,
+        )
+
+    def test_fresh_result_is_cached(self):
+        first = self.fallback.get('BTCUSDT')
+        second = self.fallback.get('BTCUSDT')
+        self.assertEqual([row['price'] for row in first], [100.0, 101.0, 102.0])
+        self.assertEqual(second, first)
+        self.assertEqual(self.server.calls, 1)
+
+    def test_unknown_pair_skips_upstream(self):
+        self.assertIsNone(self.fallback.get('FOOUSDT'))
+        self.assertEqual(self.server.calls, 0)
+
+    def test_stale_entry_served_while_revalidating(self):
+        self.fallback.get('BTCUSDT')
+        history, fetched_at = self.fallback.local.get('coincap:BTCUSDT')
+        self.fallback.local.set('coincap:BTCUSDT', (history, fetched_at - 120))
+        self.fallback.store.set('coincap:BTCUSDT', history, fetched_at - 120, fetched_at + 480)
+        self.server.price = 200.0
+
+        stale = self.fallback.get('BTCUSDT')
+        self.assertEqual(stale[0]['price'], 100.0)
+        deadline = time.monotonic() + 2
+        while self.fallback.local.get('coincap:BTCUSDT')[0][0]['price'] != 200.0:
+            self.assertLess(time.monotonic(), deadline, 'background refresh did not complete')
+            time.sleep(0.01)
+        self.assertEqual(self.server.calls, 2)
+
+    def test_breaker_opens_after_repeated_failures(self):
+        self.server.fail = True
+        self.assertIsNone(self.fallback.get('BTCUSDT'))
+        self.assertIsNone(self.fallback.get('ETHUSDT'))
+        self.assertEqual(self.breaker.state, 'open')
+        self.assertIsNone(self.fallback.get('ADAUSDT'))
+        self.assertEqual(self.server.calls, 2)
+
+    def test_slow_upstream_is_bounded_by_read_timeout(self):
+        self.server.delay = 1.0
+        started = time.monotonic()
+        self.assertIsNone(self.fallback.get('BTCUSDT'))
+        self.assertLess(time.monotonic() - started, 0.9)
+        self.assertEqual(self.breaker.failures, 1)
+
+    def test_malformed_payload_counts_as_failure(self):
+        for bad in ({'priceUsd': None, 'time': 1700010800000}, {'priceUsd': '1.0', 'time': 'soon'}):
+            self.server.extra_rows = [bad]
+            with self.assertRaises(UpstreamError):
+                self.fallback.client.fetch_history('bitcoin')
+        self.assertIsNone(self.fallback.get('BTCUSDT'))
+        self.assertEqual(self.breaker.failures, 1)
+        self.assertIsNone(self.fallback.local.get('coincap:BTCUSDT'))
+
+
+class OrderBookTests(SimpleTestCase):
+    def setUp(self):
+        self.book = OrderBook()
+        self.ids = 0
+
+    def order(self, user, side, price, quantity):
+        self.ids += 1
+        return RestingOrder(f'o{self.ids}', user, side, price, quantity)
+
+    def test_partial_fill_rests_remainder(self):
+        maker = self.order('alice', 'sell', 101.0, 1.0)
+        self.book.add(maker)
+        taker = self.order('bob', 'buy', 102.0, 3.0)
+        fills = self.book.add(taker)
+
+        self.assertEqual([(f.maker, f.price, f.quantity) for f in fills], [(maker, 101.0, 1.0)])
+        self.assertEqual(maker.status, 'filled')
+        self.assertEqual((taker.status, taker.filled), ('partial', 1.0))
+        self.assertEqual(self.book.depth(), ([(102.0, 2.0)], []))
+        self.assertNotIn(maker.order_id, self.book.orders)
+
+    def test_price_then_time_priority(self):
+        first = self.order('alice', 'sell', 101.0, 1.0)
+        second = self.order('carol', 'sell', 101.0, 1.0)
+        better = self.order('dave', 'sell', 100.0, 1.0)
+        for entry in (first, second, better):
+            self.book.add(entry)
+        fills = self.book.add(self.order('bob', 'buy', 101.0, 2.5))
+
+        self.assertEqual([(f.maker, f.quantity) for f in fills], [(better, 1.0), (first, 1.0), (second, 0.5)])
+        self.assertEqual(second.status, 'partial')
+        self.assertEqual(self.book.depth(), ([], [(101.0, 0.5)]))
+
+    def test_crossing_walks_best_first_and_drops_emptied_levels(self):
+        for price in (99.0, 101.0, 100.0, 102.0):
+            self.book.add(self.order('alice', 'buy', price, 1.0))
+
+        self.assertEqual([level.price for level in self.book.bids.crossing(100.0)], [102.0, 101.0, 100.0])
+        self.book.add(self.order('bob', 'sell', 101.0, 2.0))
+        self.assertEqual(self.book.bids.prices, [99.0, 100.0])
+        self.assertEqual(list(self.book.bids.crossing(101.0)), [])
+
+    def test_match_leaves_book_unchanged_until_commit(self):
+        maker = self.order('alice', 'sell', 101.0, 1.0)
+        self.book.add(maker)
+        sequence = self.book.sequence
+        taker = self.order('bob', 'buy', 101.0, 1.0)
+
+        fills, self_trade = self.book.match(taker)
+        self.assertEqual(len(fills), 1)
+        self.assertFalse(self_trade)
+        self.assertEqual((maker.filled, taker.filled, self.book.sequence), (0.0, 0.0, sequence))
+        self.assertEqual(self.book.depth(), ([], [(101.0, 1.0)]))
+
+        self.book.commit(taker, fills)
+        self.assertEqual((maker.status, taker.status), ('filled', 'filled'))
+        self.assertEqual(self.book.depth(), ([], []))
+
+    def test_cancel_removes_quantity_and_skips_order(self):
+        first = self.order('alice', 'sell', 101.0, 1.0)
+        second = self.order('carol', 'sell', 101.0, 2.0)
+        self.book.add(first)
+        self.book.add(second)
+
+        self.assertIs(self.book.cancel(first.order_id), first)
+        self.assertEqual(first.status, 'cancelled')
+        self.assertIsNone(self.book.cancel(first.order_id))
+        self.assertEqual(self.book.depth(), ([], [(101.0, 2.0)]))
+
+        fills = self.book.add(self.order('bob', 'buy', 101.0, 1.0))
+        self.assertEqual([f.maker for f in fills], [second])
+
+    def test_cancel_last_order_removes_level(self):
+        entry = self.order('alice', 'buy', 99.0, 1.0)
+        self.book.add(entry)
+        self.book.cancel(entry.order_id)
+        self.assertEqual(self.book.depth(), ([], []))
+        self.assertEqual(len(self.book), 0)
+
+    def test_depth_orders_and_groups_levels(self):
+        for price, quantity in ((99.0, 1.0), (98.4, 2.0), (98.6, 0.5)):
+            self.book.add(self.order('alice', 'buy', price, quantity))
+        for price, quantity in ((101.0, 1.0), (101.2, 1.0), (103.0, 4.0)):
+            self.book.add(self.order('carol', 'sell', price, quantity))
+
+        bids, asks = self.book.depth(limit=2)
+        self.assertEqual(bids, [(99.0, 1.0), (98.6, 0.5)])
+        self.assertEqual(asks, [(101.0, 1.0), (101.2, 1.0)])
+
+        bids, asks = self.book.depth(tick=1.0)
+        self.assertEqual(bids, [(99.0, 1.0), (98.0, 2.5)])
+        self.assertEqual(asks, [(101.0, 1.0), (102.0, 1.0), (103.0, 4.0)])
+
+    def test_self_trade_cancels_taker(self):
+        other = self.order('carol', 'sell', 100.0, 1.0)
+        own = self.order('alice', 'sell', 101.0, 1.0)
+        self.book.add(other)
+        self.book.add(own)
+        taker = self.order('alice', 'buy', 101.0, 3.0)
+
+        fills, self_trade = self.book.match(taker)
+        self.assertTrue(self_trade)
+        self.assertEqual([f.maker for f in fills], [other])
+        self.book.commit(taker, fills, self_trade)
+
+        self.assertEqual((taker.status, taker.filled), ('cancelled', 1.0))
+        self.assertEqual(own.remaining, 1.0)
+        self.assertNotIn(taker.order_id, self.book.orders)
+        self.assertEqual(self.book.depth(), ([], [(101.0, 1.0)]))
+
+    def test_sweep_fills_crossed_orders_at_market_price(self):
+        crossed = self.order('alice', 'buy', 100.0, 1.0)
+        resting = self.order('bob', 'buy', 98.0, 1.0)
+        self.book.add(crossed)
+        self.book.add(resting)
+
+        fills = self.book.sweep(99.0)
+        self.assertEqual([(f.maker, f.taker, f.price, f.quantity) for f in fills], [(crossed, None, 99.0, 1.0)])
+        self.assertEqual(self.book.depth(), ([(98.0, 1.0)], []))
+
+
+@conditional_get(lambda request: 'v1', max_age=5)
+@api_view(['GET'])
+@authentication_classes([])
+@permission_classes([])
+@renderer_classes([ORJSONRenderer, StaticHTMLRenderer])
+def negotiated_view(request):
+    return Response({'price': 1} if request.accepted_renderer.format == 'json' else '<b>1</b>')
+
+
+class ConditionalGetTests(SimpleTestCase):
+    def get(self, accept, etag=None):
+        headers = {'HTTP_ACCEPT': accept}
+        if etag:
+            headers['HTTP_IF_NONE_MATCH'] = etag
+        return negotiated_view(RequestFactory().get('/api/market-data/', **headers))
+
+    def test_etag_depends_on_negotiated_media_type(self):
+        json_response = self.get('application/json')
+        self.assertEqual(json_response.status_code, 200)
+        self.assertIn('Accept', json_response['Vary'])
+
+        self.assertEqual(self.get('application/json', json_response['ETag']).status_code, 304)
+        html_response = self.get('text/html', json_response['ETag'])
+        self.assertEqual(html_response.status_code, 200)
+        self.assertEqual(html_response['Content-Type'], 'text/html; charset=utf-8')
+        self.assertNotEqual(html_response['ETag'], json_response['ETag'])
+        self.assertIn('Accept', self.get('text/html', html_response['ETag'])['Vary'])
+
+
+class QueryBudgetTests(QueryBudgetMixin, MongoTestCase):
+    """Steady-state requests (token and price snapshot cached) stay within DB_QUERY_BUDGETS."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        TradingPair(pair='BTCUSDT', base_symbol='BTC', quote_symbol='USDT', current_price=100.0).save()
+        user = User(username='budget', email='budget@example.com', password='-').save()
+        Portfolio(user=user, wallets=[
+            CryptoWallet(symbol='USDT', name='Tether', public_key='-', private_key='[]', balance=10000.0),
+            CryptoWallet(symbol='BTC', name='Bitcoin', public_key='-', private_key='[]', balance=1.0),
+        ]).save()
+        cls.token = Token(user=user, token='budget-token').save().token
+
+    def setUp(self):
+        price_snapshots.refresh()
+        resolve_token(self.token)
+        self.auth = {'HTTP_AUTHORIZATION': f'Bearer {self.token}'}
+
+    def test_portfolio_within_budget(self):
+        response = self.client.get('/api/portfolio/', **self.auth)
+        self.assertEqual(response.status_code, 200)
+        self.assertWithinQueryBudget(response)
+
+    def test_market_order_within_budget(self):
+        response = self.client.post('/api/place-order/', {
+            'pair': 'BTCUSDT', 'order_type': 'market', 'side': 'buy', 'quantity': 0.01,
+        }, **self.auth)
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertWithinQueryBudget(response)
+
+    def test_resting_limit_order_within_budget(self):
+        order = {'pair': 'BTCUSDT', 'order_type': 'limit', 'side': 'buy', 'quantity': 0.01, 'price': 50.0}
+        self.client.post('/api/place-order/', order, **self.auth)  # first use rebuilds the book
+        response = self.client.post('/api/place-order/', order, **self.auth)
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertWithinQueryBudget(response)
@@ -0,0 +1,97 @@
+"""
+Background price ticker.
+
+Advances simulated prices at a fixed cadence (PRICE_TICK_INTERVAL) instead
+of on every /api/market-data/ request, and publishes each tick into the
+in-memory price snapshot so read endpoints never write. Each tick also
+sweeps the limit order books (core.matching) at the new prices and
+revalues portfolios (core.valuation).
+
+Runs as a daemon thread inside the web process. With PRICE_TICKER_ENABLED
+it simulates the prices itself. When prices come from the sidecar
+(``python manage.py init_crypto_system --simulate``) instead, disable it:
+the ticker then follows the ticks the sidecar writes to Mongo, refreshing
+the snapshot every interval and matching and revaluing whenever its
+version moves. The order books and valuations live in the web process
+either way, so it stays a single worker.
+"""
+import logging
+import os
+import threading
+
+from django.conf import settings
+
+from .matching import matching_engine
+from .pricing import price_snapshots
+from .valuation import portfolio_valuations
+from .utils import simulate_all_prices
+
+logger = logging.getLogger(__name__)
+
+
+class PriceTicker:
+    def __init__(self, interval=5.0, follow=False):
+        self.interval = interval
+        self.follow = follow  # pick up ticks written by another process instead of simulating
+        self.ticks = 0
+        self._version = None
+        self._thread = None
+        self._pid = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._pid == os.getpid() and self._thread and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='price-ticker', daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+        logger.info('Price ticker started', extra={'fields': {'interval_s': self.interval, 'follow': self.follow}})
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.tick()
+            except Exception:
+                logger.exception('Price tick failed')
+
+    def tick(self):
+        """Advance every active pair once, fill resting limit orders crossed by the new prices and revalue portfolios.
+
+        When following, the tick is read from Mongo instead; returns None if
+        no new one has landed since the last call.
+        """
+        if self.follow:
+            snapshot = price_snapshots.refresh()
+            if snapshot.version == self._version:
+                return None
+            self._version = snapshot.version
+            updated_prices = {}
+        else:
+            updated_prices = simulate_all_prices()
+            snapshot = price_snapshots.get()
+        self.ticks += 1
+        try:
+            matching_engine.match_market(snapshot)
+        except Exception:
+            logger.exception('Limit order matching failed')
+        try:
+            portfolio_valuations.on_tick(snapshot)
+        except Exception:
+            logger.exception('Portfolio valuation failed')
+        return updated_prices
+
+
+price_ticker = PriceTicker(
+    interval=getattr(settings, 'PRICE_TICK_INTERVAL', 5.0),
+    follow=not getattr(settings, 'PRICE_TICKER_ENABLED', True),
+)
+
+
+def start_price_ticker():
+    price_ticker.start()
@@ -6,6 +6,9 @@ urlpatterns = [
     path('register/', views.register),
     path('login/', views.login),
     path('face-auth/', views.face_auth),
+    path('logout/', views.logout_view),
+    path('face/jobs/<str:job_id>/', views.face_job_status),
+    path('face/identify/', views.face_identify),
 
     # User Profile & Face Photo
     path('user/profile/', views.user_profile),
@@ -13,13 +16,17 @@ urlpatterns = [
 
     # Portfolio & Wallet Management
     path('portfolio/', views.get_portfolio),
+    path('portfolios/top/', views.get_top_portfolios),
     path('wallet/', views.get_wallet),  # Legacy support
 
     # Trading & Market Data
     path('market-data/', views.get_market_data),
     path('place-order/', views.place_order),
+    path('cancel-order/', views.cancel_order),
+    path('order-book/', views.get_order_book),
     path('order-history/', views.get_order_history),
     path('price-history/', views.price_history),
+    path('stream/ticket/', views.stream_ticket),
 
     # Curve Cart Integration
     path('curve/cart/create/', views.create_curve_cart),
@@ -28,10 +35,12 @@ urlpatterns = [
     # Merchant Payment System
     path('merchant/info/', views.get_merchant_info),
     path('merchant/payment/', views.process_merchant_payment),
+    path('merchant/payouts/', views.merchant_payouts),
 
     # Transaction History
     path('transactions/', views.get_transaction_history),
     path('transactions/cancel/', views.cancel_transaction),
+    path('ledger/balances/', views.get_ledger_balances),
 
     # System Management
     path('initialize/', views.initialize_system),
@@ -3,9 +3,20 @@ import string
 import base64
 import hashlib
 import uuid
+import time
 from datetime import datetime, timedelta
 from .models import TradingPair, PriceHistory, Transaction, Portfolio
+from .pricing import price_snapshots, value_wallets
+from .simulation import PAIRS_RELOAD, price_engine
+from .candles import record_ticks
+from .balances import BalanceError, WalletNotFound, WalletOwnerNotFound, atomic
+from .ledger import MARKET
 import json
+import logging
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+
+logger = logging.getLogger(__name__)
 
 def generate_wallet():
     """Generate a dummy wallet for development purposes"""
@@ -23,11 +34,11 @@ def generate_transaction_hash():
 
 def generate_order_id():
     """Generate unique order ID"""
-    return f"ORD_{int(datetime.utcnow().timestamp())}_{random.randint(1000, 9999)}"
+    return f"ORD_{int(datetime.utcnow().timestamp())}_{uuid.uuid4().hex[:12]}"
 
 def generate_trade_id():
-    """Generate unique trade ID"""
-    return f"TRD_{int(datetime.utcnow().timestamp())}_{random.randint(1000, 9999)}"
+    """Generate unique trade ID (many can be created in the same second by the matching engine)"""
+    return f"TRD_{int(datetime.utcnow().timestamp())}_{uuid.uuid4().hex[:12]}"
 
 def initialize_trading_pairs():
     """Initialize default trading pairs with base prices"""
@@ -97,161 +108,113 @@ def initialize_trading_pairs():
                 pair = TradingPair(**pair_data)
                 pair.current_price = pair_data['base_price']
                 pair.save()
-                print(f"Created trading pair: {pair_data['pair']}")
+                logger.info('Created trading pair', extra={'fields': {'pair': pair_data['pair']}})
             else:
                 # Update base price if not set
                 if not pair.base_price:
                     pair.base_price = pair_data['base_price']
                     pair.save()
         except Exception as e:
-            print(f"Error creating pair {pair_data['pair']}: {e}")
+            logger.error('Error creating trading pair', extra={'fields': {'pair': pair_data['pair'], 'error': e}})
 
-def simulate_all_prices():
-    """Simulate prices for all active trading pairs"""
-    pairs = TradingPair.objects(is_active=True)
-    updated_prices = {}
-    
-    for pair in pairs:
+# Fields written back to TradingPair on every price tick
+TICK_FIELDS = ['base_price', 'current_price', 'price_change_24h', 'volume_24h', 'high_24h', 'low_24h', 'last_updated']
+
+def commit_price_tick(pairs):
+    """Persist simulated prices for ``pairs`` in two bulk round-trips.
+
+    Pair updates go out as one unordered ``bulk_write`` and history rows as
+    one unordered ``insert_many``; committed ticks are then folded into their
+    OHLCV candles (see core.candles). Returns ``(committed_pairs, failures)``
+    where ``failures`` maps pair name -> error message.
+    """
+    failures = {}
+    if not pairs:
+        return [], failures
+
+    updates = [
+        UpdateOne({'_id': pair.id}, {'$set': {field: getattr(pair, field) for field in TICK_FIELDS}})
+        for pair in pairs
+    ]
+    try:
+        TradingPair._get_collection().bulk_write(updates, ordered=False)
+    except BulkWriteError as e:
+        for error in e.details.get('writeErrors', []):
+            failures[pairs[error['index']].pair] = error.get('errmsg', 'update failed')
+    except PyMongoError as e:
+        return [], {pair.pair: str(e) for pair in pairs}
+
+    recorded = [pair for pair in pairs if pair.pair not in failures]
+    history = [
+        {'pair': pair.id, 'price': pair.current_price, 'volume': pair.volume_24h, 'timestamp': pair.last_updated}
+        for pair in recorded
+    ]
+    if history:
         try:
-            new_price = pair.simulate_price()
-            updated_prices[pair.pair] = {
-                'price': new_price,
-                'change_24h': pair.price_change_24h,
-                'volume_24h': pair.volume_24h,
-                'high_24h': pair.high_24h,
-                'low_24h': pair.low_24h
-            }
-            
-            # Store price history
-            PriceHistory(
-                pair=pair,
-                price=new_price,
-                volume=pair.volume_24h
-            ).save()
-            
-        except Exception as e:
-            print(f"Error simulating price for {pair.pair}: {e}")
+            PriceHistory._get_collection().insert_many(history, ordered=False)
+        except BulkWriteError as e:
+            for error in e.details.get('writeErrors', []):
+                failures[recorded[error['index']].pair] = error.get('errmsg', 'history insert failed')
+        except PyMongoError as e:
+            failures.update({pair.pair: str(e) for pair in recorded})
+
+    committed = [pair for pair in pairs if pair.pair not in failures]
+    record_ticks(committed)
+    return committed, failures
+
+def run_price_tick():
+    """Simulate and persist one tick for all active pairs; returns ``(updated_prices, failures)``"""
+    # The engine holds pair state between ticks; Mongo is only read when the pairs changed
+    if price_engine.needs_reload(PAIRS_RELOAD):
+        price_engine.track(TradingPair.objects(is_active=True))
     
+    # Advance every pair in one vectorized step, then persist in bulk
+    pairs = price_engine.tick()
+    committed, failures = commit_price_tick(pairs)
+    
+    # Readers pick the tick up from memory; reload instead if anything failed to persist
+    if failures:
+        price_snapshots.refresh()
+    else:
+        price_snapshots.publish_pairs(pairs)
+    for pair_name, error in failures.items():
+        logger.error('Error simulating price', extra={'fields': {'pair': pair_name, 'error': error}})
+    
+    updated_prices = {
+        pair.pair: {
+            'price': pair.current_price,
+            'change_24h': pair.price_change_24h,
+            'volume_24h': pair.volume_24h,
+            'high_24h': pair.high_24h,
+            'low_24h': pair.low_24h
+        }
+        for pair in committed
+    }
+    return updated_prices, failures
+
+def simulate_all_prices():
+    """Simulate prices for all active trading pairs"""
+    updated_prices, _ = run_price_tick()
     return updated_prices
 
-def calculate_portfolio_value(user):
-    """Calculate total portfolio value in USD"""
+def calculate_portfolio_value(user, portfolio=None, snapshot=None):
+    """Calculate total portfolio value in USD against the current price snapshot.
+
+    Read-only: the stored ``Portfolio.total_value_usd`` is not rewritten.
+    """
     try:
-        portfolio = Portfolio.objects(user=user).first()
+        if portfolio is None:
+            portfolio = Portfolio.objects(user=user).only('wallets').first()
         if not portfolio:
             return 0.0
         
-        total_value = 0.0
-        
-        for wallet in portfolio.wallets:
-            if wallet.balance > 0:
-                if wallet.symbol == 'USDT':
-                    # USDT is pegged to USD
-                    total_value += wallet.balance
-                else:
-                    # Get current price for this crypto
-                    pair_name = f"{wallet.symbol}USDT"
-                    trading_pair = TradingPair.objects(pair=pair_name).first()
-                    if trading_pair and trading_pair.current_price > 0:
-                        total_value += wallet.balance * trading_pair.current_price
-        
-        # Update portfolio total value
-        portfolio.total_value_usd = total_value
-        portfolio.updated_at = datetime.utcnow()
-        portfolio.save()
-        
+        total_value, _ = value_wallets(portfolio.wallets, snapshot or price_snapshots.get())
         return total_value
         
     except Exception as e:
-        print(f"Error calculating portfolio value: {e}")
+        logger.exception('Error calculating portfolio value', extra={'fields': {'user_id': getattr(user, 'id', None)}})
         return 0.0
 
-def process_crypto_transfer(from_user, to_user, crypto_symbol, amount, memo=""):
-    """Process internal crypto transfer between users"""
-    try:
-        # Get sender's portfolio
-        sender_portfolio = Portfolio.objects(user=from_user).first()
-        if not sender_portfolio:
-            return False, "Sender portfolio not found"
-        
-        # Get receiver's portfolio
-        receiver_portfolio = Portfolio.objects(user=to_user).first()
-        if not receiver_portfolio:
-            return False, "Receiver portfolio not found"
-        
-        # Find sender's wallet
-        sender_wallet = None
-        for wallet in sender_portfolio.wallets:
-            if wallet.symbol == crypto_symbol:
-                sender_wallet = wallet
-                break
-        
-        if not sender_wallet or sender_wallet.balance < amount:
-            return False, "Insufficient balance"
-        
-        # Find or create receiver's wallet
-        receiver_wallet = None
-        for wallet in receiver_portfolio.wallets:
-            if wallet.symbol == crypto_symbol:
-                receiver_wallet = wallet
-                break
-        
-        if not receiver_wallet:
-            # Create new wallet for receiver
-            from .models import CryptoWallet
-            public_key, private_key = generate_wallet()
-            receiver_wallet = CryptoWallet(
-                symbol=crypto_symbol,
-                name=get_crypto_name(crypto_symbol),
-                public_key=public_key,
-                private_key=json.dumps(private_key),
-                balance=0.0
-            )
-            receiver_portfolio.wallets.append(receiver_wallet)
-        
-        # Process transfer
-        sender_wallet.balance -= amount
-        receiver_wallet.balance += amount
-        
-        # Save portfolios
-        sender_portfolio.save()
-        receiver_portfolio.save()
-        
-        # Create transaction records
-        tx_hash = generate_transaction_hash()
-        
-        # Sender transaction (outgoing)
-        Transaction(
-            user=from_user,
-            transaction_type="transfer",
-            crypto_symbol=crypto_symbol,
-            amount=-amount,  # Negative for outgoing
-            to_address=receiver_wallet.public_key,
-            from_address=sender_wallet.public_key,
-            to_user=to_user,
-            tx_hash=tx_hash,
-            status="confirmed",
-            memo=memo
-        ).save()
-        
-        # Receiver transaction (incoming)
-        Transaction(
-            user=to_user,
-            transaction_type="transfer",
-            crypto_symbol=crypto_symbol,
-            amount=amount,  # Positive for incoming
-            to_address=receiver_wallet.public_key,
-            from_address=sender_wallet.public_key,
-            tx_hash=tx_hash,
-            status="confirmed",
-            memo=memo
-        ).save()
-        
-        return True, "Transfer completed successfully"
-        
-    except Exception as e:
-        return False, f"Transfer failed: {str(e)}"
-
 def get_crypto_name(symbol):
     """Get full name of cryptocurrency"""
     names = {
@@ -267,218 +230,143 @@ def get_crypto_name(symbol):
     }
     return names.get(symbol, symbol)
 
-def execute_market_order(user, pair, side, quantity):
-    """Execute a market order immediately at current price"""
+def execute_market_order(user, pair, side, quantity, timings=None):
+    """Execute a market order immediately at the current snapshot price.
+
+    Pricing needs no query: the pair comes from the in-memory price
+    snapshot the ticker keeps current. Both balance legs are one guarded
+    update and the Trade and Transaction records commit with it (see
+    core.balances.atomic), so a failure leaves nothing half-applied.
+    Per-stage durations in ms (price, balances, records, commit) are stored
+    in ``timings`` when a dict is passed.
+    """
+    timings = {} if timings is None else timings
+    started = time.perf_counter()
     try:
-        trading_pair = TradingPair.objects(pair=pair).first()
-        if not trading_pair:
+        if side not in ("buy", "sell") or quantity <= 0:
+            return False, "Invalid side or quantity"
+        snapshot = price_snapshots.get()
+        row = snapshot.get(pair)
+        if not row:
             return False, "Trading pair not found"
+        current_price = row['current_price']
+        if current_price <= 0:
+            return False, "No price available for this pair"
         
-        # Simulate price for fresh data
-        current_price = trading_pair.simulate_price()
-        
-        portfolio = Portfolio.objects(user=user).first()
-        if not portfolio:
-            return False, "Portfolio not found"
-        
-        base_symbol = trading_pair.base_symbol
-        quote_symbol = trading_pair.quote_symbol
+        base_symbol = row['base_symbol']
+        quote_symbol = row['quote_symbol']
         total_cost = quantity * current_price
         
+        # Both legs in one guarded update: the balance can't be overdrawn by a concurrent order
         if side == "buy":
-            # Check if user has enough quote currency (e.g., USDT)
-            quote_wallet = None
-            for wallet in portfolio.wallets:
-                if wallet.symbol == quote_symbol:
-                    quote_wallet = wallet
-                    break
-            
-            if not quote_wallet or quote_wallet.balance < total_cost:
-                return False, "Insufficient balance"
-            
-            # Deduct quote currency
-            quote_wallet.balance -= total_cost
-            
-            # Add base currency
-            base_wallet = None
-            for wallet in portfolio.wallets:
-                if wallet.symbol == base_symbol:
-                    base_wallet = wallet
-                    break
-            
-            if not base_wallet:
-                # Create new wallet
-                from .models import CryptoWallet
-                public_key, private_key = generate_wallet()
-                base_wallet = CryptoWallet(
-                    symbol=base_symbol,
-                    name=get_crypto_name(base_symbol),
-                    public_key=public_key,
-                    private_key=json.dumps(private_key),
-                    balance=0.0
-                )
-                portfolio.wallets.append(base_wallet)
-            
-            base_wallet.balance += quantity
-            
-        else:  # sell
-            # Check if user has enough base currency
-            base_wallet = None
-            for wallet in portfolio.wallets:
-                if wallet.symbol == base_symbol:
-                    base_wallet = wallet
-                    break
-            
-            if not base_wallet or base_wallet.balance < quantity:
-                return False, "Insufficient balance"
-            
-            # Deduct base currency
-            base_wallet.balance -= quantity
-            
-            # Add quote currency
-            quote_wallet = None
-            for wallet in portfolio.wallets:
-                if wallet.symbol == quote_symbol:
-                    quote_wallet = wallet
-                    break
-            
-            if not quote_wallet:
-                # Create new wallet
-                from .models import CryptoWallet
-                public_key, private_key = generate_wallet()
-                quote_wallet = CryptoWallet(
-                    symbol=quote_symbol,
-                    name=get_crypto_name(quote_symbol),
-                    public_key=public_key,
-                    private_key=json.dumps(private_key),
-                    balance=0.0
-                )
-                portfolio.wallets.append(quote_wallet)
-            
-            quote_wallet.balance += total_cost
-        
-        portfolio.save()
+            deltas = {quote_symbol: -total_cost, base_symbol: quantity}
+        else:
+            deltas = {base_symbol: -quantity, quote_symbol: total_cost}
         
-        # Create trade record
         from .models import Trade
-        Trade(
-            buyer=user if side == "buy" else user,  # Simplified for market orders
-            seller=user if side == "sell" else user,
-            pair=trading_pair,
+        trade = Trade(
+            buyer=user,  # Simplified for market orders: the user is on both sides
+            seller=user,
+            pair=snapshot.ids.get(pair),
             quantity=quantity,
             price=current_price,
             total=total_cost,
             trade_id=generate_trade_id()
-        ).save()
-        
-        # Create transaction record
-        Transaction(
+        )
+        transaction = Transaction(
             user=user,
             transaction_type="trade",
             crypto_symbol=base_symbol,
             amount=quantity if side == "buy" else -quantity,
+            tx_hash=generate_transaction_hash(),
             status="confirmed",
             memo=f"{side.upper()} {quantity} {base_symbol} at {current_price}"
-        ).save()
+        )
+        timings['price'] = (time.perf_counter() - started) * 1000
+        
+        def fill(batch):
+            stage = time.perf_counter()
+            batch.apply(user, deltas)
+            timings['balances'] = (time.perf_counter() - stage) * 1000
+            stage = time.perf_counter()
+            batch.insert(Trade, [trade])
+            batch.insert(Transaction, [transaction])
+            timings['records'] = (time.perf_counter() - stage) * 1000
+        
+        stage = time.perf_counter()
+        try:
+            atomic(fill, kind='trade', contra=MARKET)
+        except WalletOwnerNotFound:
+            return False, "Portfolio not found"
+        except BalanceError as e:
+            return False, str(e)
+        timings['commit'] = (time.perf_counter() - stage) * 1000 - timings['balances'] - timings['records']
         
         return True, f"Order executed: {side} {quantity} {base_symbol} at {current_price}"
         
     except Exception as e:
         return False, f"Order execution failed: {str(e)}"
+    finally:
+        timings['total'] = (time.perf_counter() - started) * 1000
 
 def process_crypto_transfer(from_user, to_user, crypto_symbol, amount, memo=""):
-    """Process crypto transfer between users"""
+    """Process crypto transfer between users.
+
+    The debit, the credit and both transaction records commit together
+    (see core.balances.atomic).
+    """
+    # Determine transaction types based on context
+    # If it's a purchase (user paying merchant), use appropriate types
+    if "payment" in memo.lower() or "purchase" in memo.lower():
+        sender_type = "purchase"
+        recipient_type = "deposit"
+    else:
+        sender_type = "transfer"
+        recipient_type = "transfer"
+    
+    def move(batch):
+        try:
+            from_wallet = batch.debit(from_user, crypto_symbol, amount, create=False)
+        except WalletOwnerNotFound:
+            raise BalanceError("Sender portfolio not found")
+        except WalletNotFound:
+            raise BalanceError(f"Sender does not have {crypto_symbol} wallet")
+        try:
+            to_wallet = batch.credit(to_user, crypto_symbol, amount)
+        except WalletOwnerNotFound:
+            raise BalanceError("Recipient portfolio not found")
+        
+        # One record per side; tx_hash is unique, so each gets its own
+        batch.insert(Transaction, [
+            Transaction(
+                user=from_user,
+                transaction_type=sender_type,
+                crypto_symbol=crypto_symbol,
+                amount=-amount,
+                to_address=to_wallet['public_key'],
+                from_address=from_wallet['public_key'],
+                to_user=to_user,
+                status="confirmed",
+                tx_hash=generate_transaction_hash(),
+                memo=memo or f"Transfer to {to_user.username}"
+            ),
+            Transaction(
+                user=to_user,
+                transaction_type=recipient_type,
+                crypto_symbol=crypto_symbol,
+                amount=amount,
+                to_address=to_wallet['public_key'],
+                from_address=from_wallet['public_key'],
+                status="confirmed",
+                tx_hash=generate_transaction_hash(),
+                memo=memo or f"Transfer from {from_user.username}"
+            ),
+        ])
+    
     try:
-        # Get portfolios
-        from_portfolio = Portfolio.objects(user=from_user).first()
-        to_portfolio = Portfolio.objects(user=to_user).first()
-        
-        if not from_portfolio:
-            return False, "Sender portfolio not found"
-        if not to_portfolio:
-            return False, "Recipient portfolio not found"
-            
-        # Find sender's wallet
-        from_wallet = None
-        for wallet in from_portfolio.wallets:
-            if wallet.symbol == crypto_symbol:
-                from_wallet = wallet
-                break
-                
-        if not from_wallet:
-            return False, f"Sender does not have {crypto_symbol} wallet"
-            
-        if from_wallet.balance < amount:
-            return False, f"Insufficient {crypto_symbol} balance"
-            
-        # Find or create recipient's wallet
-        to_wallet = None
-        for wallet in to_portfolio.wallets:
-            if wallet.symbol == crypto_symbol:
-                to_wallet = wallet
-                break
-                
-        if not to_wallet:
-            # Create new wallet for recipient
-            from .models import CryptoWallet
-            public_key, private_key_list = generate_wallet()
-            to_wallet = CryptoWallet(
-                symbol=crypto_symbol,
-                name=get_crypto_name(crypto_symbol),
-                public_key=public_key,
-                private_key=json.dumps(private_key_list),
-                balance=0.0,
-                is_active=True
-            )
-            to_portfolio.wallets.append(to_wallet)
-            
-        # Process transfer
-        from_wallet.balance -= amount
-        to_wallet.balance += amount
-        
-        # Save portfolios
-        from_portfolio.save()
-        to_portfolio.save()
-        
-        # Create transaction records
-        tx_hash = generate_transaction_hash()
-        
-        # Determine transaction types based on context
-        # If it's a purchase (user paying merchant), use appropriate types
-        if "payment" in memo.lower() or "purchase" in memo.lower():
-            sender_type = "purchase"
-            recipient_type = "deposit"
-        else:
-            sender_type = "transfer"
-            recipient_type = "transfer"
-        
-        # Sender transaction
-        Transaction(
-            user=from_user,
-            transaction_type=sender_type,
-            crypto_symbol=crypto_symbol,
-            amount=-amount,
-            to_address=to_wallet.public_key,
-            from_address=from_wallet.public_key,
-            status="confirmed",
-            tx_hash=tx_hash,
-            memo=memo or f"Transfer to {to_user.username}"
-        ).save()
-        
-        # Recipient transaction
-        Transaction(
-            user=to_user,
-            transaction_type=recipient_type,
-            crypto_symbol=crypto_symbol,
-            amount=amount,
-            to_address=to_wallet.public_key,
-            from_address=from_wallet.public_key,
-            status="confirmed",
-            tx_hash=tx_hash,
-            memo=memo or f"Transfer from {from_user.username}"
-        ).save()
-        
-        return True, f"Transfer successful: {amount} {crypto_symbol}"
-        
+        atomic(move, kind=sender_type)
+    except BalanceError as e:
+        return False, str(e)
     except Exception as e:
         return False, f"Transfer failed: {str(e)}"
+    return True, f"Transfer successful: {amount} {crypto_symbol}"
@@ -0,0 +1,217 @@
+"""
+Incrementally maintained portfolio valuations.
+
+Instead of pricing every wallet of a portfolio when it is read, the engine
+keeps a holdings matrix (one row per portfolio, one column per symbol), the
+per-symbol totals and every portfolio's USD value. Balance changes reach it
+through the ledger (core.ledger): each tick it reads the entries posted
+since the last one and adds them to their rows. Only the symbols whose
+price moved are revalued, as one vectorized
+``values += holdings[:, moved] @ Δprice``, so a tick costs O(portfolios ×
+moved symbols) arithmetic and no queries beyond the ledger tail.
+
+Values that changed are written back to ``Portfolio.total_value_usd`` in one
+unordered bulk_write every VALUATION_PERSIST_SECONDS. Other processes read
+them from there, and the top portfolios come from the ``-total_value_usd``
+index without pricing anything. The whole state is rebuilt from the
+portfolios every VALUATION_REBUILD_SECONDS, which clears float drift and any
+entry missed or double-counted while the state was loading.
+
+The engine runs in the web process, driven by core.ticker: on its own ticks,
+or on the ticks of the ``init_crypto_system --simulate`` sidecar that it
+follows from Mongo.
+"""
+import logging
+import threading
+import time
+
+import numpy as np
+from bson import ObjectId
+from django.conf import settings
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError
+
+from .ledger import SETTLE_SECONDS
+from .models import LedgerEntry, Portfolio
+
+logger = logging.getLogger(__name__)
+
+PERSIST_EPSILON = 0.005  # USD; smaller changes aren't worth a write
+ACCOUNT_PREFIX = 'portfolio:'
+
+
+def top_portfolios(limit=10):
+    """``[(user_id, total_value_usd)]`` from the persisted values, highest first (index scan)."""
+    return [
+        (doc['user'], doc.get('total_value_usd', 0.0))
+        for doc in Portfolio._get_collection().find(
+            {}, {'_id': 0, 'user': 1, 'total_value_usd': 1}
+        ).sort('total_value_usd', -1).limit(limit)
+    ]
+
+
+class ValuationEngine:
+    def __init__(self, persist_interval=30.0, rebuild_interval=3600.0, top_size=100):
+        self.persist_interval = persist_interval
+        self.rebuild_interval = rebuild_interval
+        self.top_size = top_size
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.loaded = False
+        self.rows = {}  # user id -> row
+        self.users = []  # row -> user id
+        self.columns = {}  # symbol -> column
+        self.symbols = []  # column -> symbol
+        self.holdings = np.zeros((0, 0))
+        self.totals = np.zeros(0)  # per-symbol sum of holdings
+        self.prices = np.zeros(0)
+        self.values = np.zeros(0)
+        self.persisted = np.zeros(0)  # last value written to Portfolio.total_value_usd
+        self.cursor = 0  # highest ledger seq applied
+        self.gaps = {}  # ledger seq below the cursor not seen yet -> monotonic time first missed
+        self.top = []  # [(user_id, value)] as of the last tick
+        self._loaded_at = 0.0
+        self._persisted_at = 0.0
+
+    def _add_columns(self, symbols, snapshot):
+        symbols = [symbol for symbol in dict.fromkeys(symbols) if symbol not in self.columns]
+        if not symbols:
+            return
+        for symbol in symbols:
+            self.columns[symbol] = len(self.symbols)
+            self.symbols.append(symbol)
+        self.holdings = np.hstack([self.holdings, np.zeros((len(self.users), len(symbols)))])
+        self.totals = np.concatenate([self.totals, np.zeros(len(symbols))])
+        self.prices = np.concatenate([self.prices, [snapshot.usd_price(symbol) for symbol in symbols]])
+
+    def _add_rows(self, user_ids):
+        user_ids = [user_id for user_id in dict.fromkeys(user_ids) if user_id not in self.rows]
+        if not user_ids:
+            return
+        for user_id in user_ids:
+            self.rows[user_id] = len(self.users)
+            self.users.append(user_id)
+        self.holdings = np.vstack([self.holdings, np.zeros((len(user_ids), len(self.symbols)))])
+        self.values = np.concatenate([self.values, np.zeros(len(user_ids))])
+        self.persisted = np.concatenate([self.persisted, np.zeros(len(user_ids))])
+
+    def load(self, snapshot):
+        """Build the state from every portfolio's wallets (one scan)."""
+        self._reset()
+        latest = LedgerEntry._get_collection().find_one({}, {'_id': 0, 'seq': 1}, sort=[('seq', -1)])
+        self.cursor = latest['seq'] if latest else 0
+
+        docs = list(Portfolio._get_collection().find(
+            {}, {'_id': 0, 'user': 1, 'total_value_usd': 1, 'wallets.symbol': 1, 'wallets.balance': 1}
+        ))
+        self._add_columns([wallet['symbol'] for doc in docs for wallet in doc.get('wallets', [])], snapshot)
+        self._add_rows([doc['user'] for doc in docs])
+        for doc in docs:
+            row = self.rows[doc['user']]
+            self.persisted[row] = doc.get('total_value_usd', 0.0)
+            for wallet in doc.get('wallets', []):
+                self.holdings[row, self.columns[wallet['symbol']]] += wallet.get('balance', 0.0)
+        self.totals = self.holdings.sum(axis=0)
+        self.values = self.holdings @ self.prices
+        self.loaded = True
+        self._loaded_at = time.monotonic()
+        logger.info('Valuations loaded', extra={'fields': {
+            'portfolios': len(self.users), 'symbols': len(self.symbols), 'ledger_seq': self.cursor,
+        }})
+
+    def _apply_ledger(self, snapshot):
+        """Add the ledger entries posted since the last tick to their portfolios' holdings."""
+        query = {'seq': {'$gt': self.cursor}}
+        if self.gaps:
+            # Numbered before entries we already applied but not visible then (committed late)
+            query = {'$or': [query, {'seq': {'$in': list(self.gaps)}}]}
+        entries = list(LedgerEntry._get_collection().find(
+            query, {'_id': 0, 'seq': 1, 'account': 1, 'symbol': 1, 'amount': 1}
+        ).sort('seq', 1))
+
+        now = time.monotonic()
+        seen = {entry['seq'] for entry in entries}
+        for seq in seen & set(self.gaps):
+            del self.gaps[seq]
+        top = max(seen, default=self.cursor)
+        for seq in range(self.cursor + 1, top):
+            if seq not in seen:
+                self.gaps[seq] = now
+        self.cursor = max(self.cursor, top)
+        # Past the transaction time limit a missing number was aborted, not late
+        self.gaps = {seq: first for seq, first in self.gaps.items() if now - first < SETTLE_SECONDS}
+
+        portfolio_entries = [entry for entry in entries if entry['account'].startswith(ACCOUNT_PREFIX)]
+        if not portfolio_entries:
+            return 0
+        user_ids = [ObjectId(entry['account'][len(ACCOUNT_PREFIX):]) for entry in portfolio_entries]
+        self._add_columns([entry['symbol'] for entry in portfolio_entries], snapshot)
+        self._add_rows(user_ids)
+        rows = np.array([self.rows[user_id] for user_id in user_ids])
+        columns = np.array([self.columns[entry['symbol']] for entry in portfolio_entries])
+        amounts = np.array([entry['amount'] for entry in portfolio_entries])
+        np.add.at(self.holdings, (rows, columns), amounts)
+        np.add.at(self.totals, columns, amounts)
+        np.add.at(self.values, rows, amounts * self.prices[columns])
+        return len(portfolio_entries)
+
+    def on_tick(self, snapshot):
+        """Fold in balance changes and the new prices; persist values when due."""
+        with self._lock:
+            if not self.loaded or time.monotonic() - self._loaded_at > self.rebuild_interval:
+                self.load(snapshot)
+            else:
+                self._apply_ledger(snapshot)
+                prices = np.array([snapshot.usd_price(symbol) for symbol in self.symbols])
+                moved = prices != self.prices
+                if moved.any():
+                    self.values += self.holdings[:, moved] @ (prices - self.prices)[moved]
+                    self.prices = prices
+            if len(self.values):
+                count = min(self.top_size, len(self.values))
+                best = np.argpartition(-self.values, count - 1)[:count]
+                best = best[np.argsort(-self.values[best])]
+                self.top = [(self.users[row], float(self.values[row])) for row in best]
+            if time.monotonic() - self._persisted_at >= self.persist_interval:
+                self.persist()
+
+    def persist(self):
+        """Write changed values to ``Portfolio.total_value_usd`` in one unordered bulk_write.
+
+        ``updated_at`` (the ETag marker) is left alone: it tracks holdings,
+        and the portfolio ETag already covers prices.
+        """
+        self._persisted_at = time.monotonic()
+        dirty = np.flatnonzero(np.abs(self.values - self.persisted) >= PERSIST_EPSILON)
+        if not len(dirty):
+            return 0
+        try:
+            Portfolio._get_collection().bulk_write([
+                UpdateOne({'user': self.users[row]}, {'$set': {'total_value_usd': float(self.values[row])}})
+                for row in dirty
+            ], ordered=False)
+        except PyMongoError as e:
+            logger.error('Failed to persist valuations', extra={'fields': {'portfolios': len(dirty), 'error': e}})
+            return 0
+        self.persisted[dirty] = self.values[dirty]
+        logger.info('Valuations persisted', extra={'fields': {
+            'portfolios': len(dirty), 'exposure_usd': round(sum(self.exposure().values()), 2),
+        }})
+        return len(dirty)
+
+    def value(self, user_id):
+        """Current USD value of a user's portfolio, or None if this process isn't valuing it."""
+        row = self.rows.get(user_id)
+        return None if row is None else float(self.values[row])
+
+    def exposure(self):
+        """``{symbol: USD value held across all portfolios}`` from the per-symbol totals."""
+        return {symbol: float(self.totals[column] * self.prices[column]) for symbol, column in self.columns.items()}
+
+
+portfolio_valuations = ValuationEngine(
+    persist_interval=getattr(settings, 'VALUATION_PERSIST_SECONDS', 30.0),
+    rebuild_interval=getattr(settings, 'VALUATION_REBUILD_SECONDS', 3600.0),
+)
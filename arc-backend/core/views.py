@@ -3,26 +3,59 @@ from rest_framework.response import Response
 from rest_framework import status
 from rest_framework.authentication import BaseAuthentication
 from rest_framework.permissions import IsAuthenticated, AllowAny
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from .serializers import UserSerializer, PortfolioSerializer, TradingPairSerializer, OrderSerializer, TradeSerializer, TransactionSerializer
 from .models import User, Token, Portfolio, CryptoWallet, TradingPair, Order, Trade, Transaction, MerchantWallet, FaceData, PriceHistory, CurveCart
+from .auth import resolve_token, get_request_user, parse_auth_header, invalidate_token
+from .face_jobs import face_pool, FacePoolBusy, check_upload
+from .face_encoding import ImageRejected
+from .face_index import face_index
+from .pricing import price_snapshots, value_wallets
+from .candles import INTERVALS as CANDLE_INTERVALS, get_candles, bucket_start
+from .downsample import history_cache, downsample_rows, MAX_POINTS as DOWNSAMPLE_MAX_POINTS, MAX_SOURCE as DOWNSAMPLE_MAX_SOURCE, CLOSED_RANGE_TTL
+from .external_history import coincap_history
+from .matching import matching_engine
+from .streaming import issue_ticket
+from .balances import add_wallet, atomic, InsufficientBalance, WalletNotFound, WalletOwnerNotFound
+from .ledger import EXTERNAL, MARKET, account_key, balances as ledger_balances
+from .pagination import InvalidPage, page_params, transaction_page
+from .valuation import top_portfolios
+from .payouts import PayoutRejected, run_payout
+from .conditional import conditional_get, TICK_MAX_AGE, market_data_etag, price_history_etag, portfolio_etag, merchant_info_etag, transactions_etag
 from .utils import generate_wallet, generate_transaction_hash, generate_order_id, generate_trade_id, initialize_trading_pairs, simulate_all_prices, calculate_portfolio_value, process_crypto_transfer, execute_market_order, get_crypto_name
 import hashlib
 import secrets
 import json
-import face_recognition
 import numpy as np
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone as dt_timezone
 import random
 import uuid
+import logging
+
+logger = logging.getLogger(__name__)
+auth_logger = logging.getLogger('core.auth')
 
 # Constants
 SYMBOLS = ['BTC', 'ETH', 'ARC', 'SOL', 'USDT', 'BNB', 'ADA', 'DOT', 'LINK', 'LTC']
+FACE_MATCH_TOLERANCE = 0.6  # same default as face_recognition.compare_faces
+
+def save_face_encoding(user):
+    """Face pool callback that stores (or replaces) the user's encoding."""
+    def _save(encoding):
+        FaceData.objects(user=user).update_one(
+            set__encoding=encoding,
+            set_on_insert__created_at=datetime.utcnow(),
+            upsert=True
+        )
+        face_index.upsert(user.id, encoding)
+    return _save
 
 # Simple token authentication using database
 class SimpleTokenAuthentication(BaseAuthentication):
     def authenticate(self, request):
         auth_header = request.META.get('HTTP_AUTHORIZATION')
-        print(f"Auth header: {auth_header}")  # Debug
         
         if not auth_header:
             return None
@@ -35,20 +68,15 @@ class SimpleTokenAuthentication(BaseAuthentication):
         except ValueError:
             return None
         
-        print(f"Looking for token: {token}")  # Debug
-        
-        # Look up token in database
+        # Look up token (cached, falls back to the database)
         try:
-            token_obj = Token.objects(token=token).first()
-            if token_obj and token_obj.user:
-                print(f"Found user: {token_obj.user.username}")  # Debug
-                return (token_obj.user, token)  # Return (user, auth) tuple
-            else:
-                print("Token not found in database")  # Debug
+            user = resolve_token(token)
+            if user:
+                return (user, token)  # Return (user, auth) tuple
         except Exception as e:
-            print(f"Error finding token: {e}")
+            auth_logger.exception('Error resolving token', extra={'fields': {'error': e}})
         
-        print("No matching token found")  # Debug
+        auth_logger.info('No matching token found', extra={'fields': {'path': request.path}})
         return None
 
     def authenticate_header(self, request):
@@ -72,19 +100,20 @@ def register(request):
         user = User(username=username, email=email, password=hashed_password)
         user.save()
         
-        # Process face image if provided
+        # Queue face encoding if an image was provided; registration doesn't wait for it
+        face_job = None
         if 'image' in request.FILES:
             try:
-                image_file = request.FILES['image']
-                image = face_recognition.load_image_file(image_file)
-                face_encodings = face_recognition.face_encodings(image)
-                
-                if face_encodings:
-                    face_encoding = face_encodings[0]
-                    face_data = FaceData(user=user, encoding=face_encoding.tobytes())
-                    face_data.save()
+                upload_error = check_upload(request.FILES['image'])
+                if upload_error:
+                    face_job = {'status': 'invalid', 'error': upload_error}
+                else:
+                    job_id = face_pool.submit(request.FILES['image'].read(), on_success=save_face_encoding(user))
+                    face_job = face_pool.status(job_id)
+            except FacePoolBusy:
+                face_job = {'status': 'rejected', 'error': 'Face service busy, please register your face again later'}
             except Exception as e:
-                print(f"Face processing error: {e}")
+                logger.warning('Face processing error', extra={'fields': {'user_id': user.id, 'error': e}})
                 
         portfolio = Portfolio(user=user)
         
@@ -111,6 +140,7 @@ def register(request):
         return Response({
             'message': 'Registration successful',
             'token': token_value,
+            'face_job': face_job,
             'user': {
                 'id': str(user.id),
                 'username': user.username,
@@ -198,6 +228,7 @@ def user_face_photo(request):
     return Response({'photo_b64': photo_b64})
 
 # Portfolio and wallet management
+@conditional_get(portfolio_etag, private=True)
 @api_view(['GET'])
 def get_portfolio(request):
     try:
@@ -206,45 +237,16 @@ def get_portfolio(request):
         if not auth_header:
             return Response({'error': 'Authentication required'}, status=status.HTTP_401_UNAUTHORIZED)
         
-        token_value = auth_header.replace('Bearer ', '')
-        token = Token.objects(token=token_value).first()
-        if not token:
+        user = get_request_user(request)
+        if not user:
             return Response({'error': 'Invalid token'}, status=status.HTTP_401_UNAUTHORIZED)
-        
-        user = token.user
-        portfolio = Portfolio.objects(user=user).first()
+        portfolio = Portfolio.objects(user=user).exclude('wallets.private_key').first()
         
         if not portfolio:
             return Response({'error': 'Portfolio not found'}, status=status.HTTP_404_NOT_FOUND)
         
-        # Calculate current portfolio value
-        total_value = calculate_portfolio_value(user)
-        
-        # Format wallet data with current values
-        wallets_data = []
-        for wallet in portfolio.wallets:
-            wallet_value_usd = 0.0
-            current_price = 0.0
-            
-            if wallet.symbol == 'USDT':
-                wallet_value_usd = wallet.balance
-                current_price = 1.0
-            else:
-                pair_name = f"{wallet.symbol}USDT"
-                trading_pair = TradingPair.objects(pair=pair_name).first()
-                if trading_pair:
-                    current_price = trading_pair.current_price
-                    wallet_value_usd = wallet.balance * current_price
-            
-            wallets_data.append({
-                'symbol': wallet.symbol,
-                'name': wallet.name,
-                'balance': wallet.balance,
-                'value_usd': wallet_value_usd,
-                'current_price': current_price,
-                'public_key': wallet.public_key,
-                'is_active': wallet.is_active
-            })
+        # Value every wallet in one pass against the shared price snapshot
+        total_value, wallets_data = value_wallets(portfolio.wallets, price_snapshots.get())
         
         return Response({
             'portfolio': {
@@ -257,28 +259,85 @@ def get_portfolio(request):
     except Exception as e:
         return Response({'error': f'Failed to get portfolio: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+@api_view(['GET'])
+@authentication_classes([SimpleTokenAuthentication])
+@permission_classes([IsAuthenticated])
+def get_top_portfolios(request):
+    """Highest valued portfolios, as last persisted by the valuation engine (core.valuation).
+
+    Anonymous: other users are not identified, only the caller's own entry is flagged.
+    """
+    try:
+        limit = min(max(int(request.GET.get('limit', 10)), 1), 100)
+    except ValueError:
+        return Response({'error': 'limit must be an integer'}, status=status.HTTP_400_BAD_REQUEST)
+    return Response({'portfolios': [
+        {'rank': rank, 'total_value_usd': value, 'is_you': user_id == request.user.id}
+        for rank, (user_id, value) in enumerate(top_portfolios(limit), start=1)
+    ]})
+
+@api_view(['POST'])
+@authentication_classes([SimpleTokenAuthentication])
+@permission_classes([IsAuthenticated])
+def stream_ticket(request):
+    """Single-use ticket for opening /api/stream/ with private topics (core.streaming)."""
+    ticket, expires_in = issue_ticket(request.user)
+    return Response({'ticket': ticket, 'expires_in': expires_in}, status=status.HTTP_201_CREATED)
+
 # Trading and market data
+@conditional_get(price_history_etag, max_age=TICK_MAX_AGE)
 @api_view(['GET'])
 @permission_classes([AllowAny])
 def price_history(request):
     """
     Returns price history for a given trading pair (e.g., BTCUSDT) for charting.
-    Query param: pair=BTCUSDT
-    Output: [{timestamp, price, volume}, ...]
+    Query params: pair=BTCUSDT, optional interval=1m|5m|1h|1d, from, to
+    (ISO 8601 or unix seconds), limit (max 1000) and max_points.
+    Output: [{timestamp, price, volume}, ...]; with interval/from/to the rows
+    are OHLCV candles and also carry open, high, low and close (price = close).
+    With max_points a longer window is fetched and downsampled (LTTB) to at
+    most that many points.
     """
     pair_name = request.GET.get('pair', None)
-    print(f"[price_history] Requested pair: {pair_name}")
     if not pair_name:
-        print("[price_history] Missing pair parameter.")
         return Response({'error': 'Missing pair parameter.'}, status=400)
+    max_points = None
+    if 'max_points' in request.GET:
+        try:
+            max_points = int(request.GET['max_points'])
+        except ValueError:
+            max_points = 0
+        if max_points < 3:
+            return Response({'error': 'Invalid max_points parameter (minimum 3).'}, status=400)
+        max_points = min(max_points, DOWNSAMPLE_MAX_POINTS)
     trading_pair = TradingPair.objects(pair=pair_name).first()
-    print(f"[price_history] TradingPair found: {trading_pair}")
     if not trading_pair:
-        print(f"[price_history] Trading pair not found: {pair_name}")
         return Response({'error': 'Trading pair not found.'}, status=404)
+    if any(param in request.GET for param in ('interval', 'from', 'to')):
+        return candle_history(request, trading_pair, max_points)
+    if max_points:
+        cache_key = (pair_name, 'ticks', max_points)
+        history = history_cache.get(cache_key)
+        if history is None:
+            # Latest ticks (up to PRICE_HISTORY_MAX_SOURCE) reduced to max_points
+            rows = list(PriceHistory._get_collection().find(
+                {'pair': trading_pair.id}, {'_id': 0, 'price': 1, 'volume': 1, 'timestamp': 1}
+            ).sort('timestamp', -1).limit(DOWNSAMPLE_MAX_SOURCE))
+            rows.reverse()
+            history = [
+                {
+                    'timestamp': row['timestamp'].strftime('%Y-%m-%d %H:%M'),
+                    'price': row['price'],
+                    'volume': row.get('volume')
+                }
+                for row in downsample_rows(rows, max_points, 'timestamp', 'price')
+            ]
+            if history:
+                history_cache.set(cache_key, history)
+        if history:
+            return Response({'history': history}, status=200)
     # Try to get last 100 price points from PriceHistory
-    history_qs = PriceHistory.objects(pair=trading_pair).order_by('-timestamp')[:100]
-    print(f"[price_history] PriceHistory count: {len(history_qs)}")
+    history_qs = [] if max_points else PriceHistory.objects(pair=trading_pair).order_by('-timestamp')[:100]
     if history_qs:
         history = [
             {
@@ -288,43 +347,13 @@ def price_history(request):
             }
             for ph in reversed(history_qs)
         ]
-        print(f"[price_history] Returning DB history, count: {len(history)}")
+        logger.debug('price_history served from DB', extra={'fields': {'pair': pair_name, 'count': len(history)}})
+        return Response({'history': history}, status=200)
+    # If no DB history, try CoinCap (cached, circuit-broken, shared across workers)
+    history = coincap_history.get(pair_name)
+    if history:
+        logger.debug('price_history served from CoinCap', extra={'fields': {'pair': pair_name, 'count': len(history)}})
         return Response({'history': history}, status=200)
-    # If no DB history, try CoinCap API v3 with API key
-    import requests
-    coincap_map = {
-        'BTCUSDT': 'bitcoin',
-        'ETHUSDT': 'ethereum',
-        'LTCUSDT': 'litecoin',
-        'BCHUSDT': 'bitcoin-cash',
-        'DOGEUSDT': 'dogecoin',
-        'BNBUSDT': 'binance-coin',
-        'ADAUSDT': 'cardano',
-        'DOTUSDT': 'polkadot',
-        'LINKUSDT': 'chainlink',
-        'ARCUSDT': 'arc'  # If listed on CoinCap
-    }
-    asset = coincap_map.get(pair_name)
-    api_key = '62651e25b2334fea9dd4093de72720aadcb872020741570f813722c3346df9c0'
-    if asset:
-        try:
-            url = f'https://rest.coincap.io/v3/assets/{asset}/history?interval=h1&apiKey={api_key}'
-            resp = requests.get(url, timeout=10)
-            data = resp.json()
-            prices = data.get('data', [])
-            # prices: [{priceUsd, time, ...}, ...]
-            history = [
-                {
-                    'timestamp': datetime.utcfromtimestamp(int(row['time']/1000)).strftime('%Y-%m-%d %H:%M'),
-                    'price': float(row['priceUsd']),
-                    'volume': None
-                }
-                for row in prices[-100:] if 'priceUsd' in row and 'time' in row
-            ]
-            print(f"[price_history] Returning CoinCap v3 history, count: {len(history)}")
-            return Response({'history': history}, status=200)
-        except Exception as e:
-            print(f"[price_history] CoinCap v3 error: {e}")
     # Fallback: generate runtime history from market data
     now = datetime.utcnow()
     points = []
@@ -339,29 +368,86 @@ def price_history(request):
             'volume': round(volume, 2)
         })
         base_price = price
-    print(f"[price_history] Returning simulated history, count: {len(points)}")
+    logger.info('price_history served simulated data', extra={'fields': {'pair': pair_name, 'count': len(points)}})
     return Response({'history': points}, status=200)
+def parse_time_param(value):
+    """Parse an ISO 8601 or unix-seconds query value into a naive UTC datetime (None if invalid)."""
+    try:
+        return datetime.utcfromtimestamp(float(value))
+    except (TypeError, ValueError, OverflowError, OSError):
+        pass
+    try:
+        parsed = parse_datetime(value or '')
+    except ValueError:
+        return None
+    if parsed and timezone.is_aware(parsed):
+        parsed = timezone.make_naive(parsed, dt_timezone.utc)
+    return parsed
+
+def candle_history(request, trading_pair, max_points=None):
+    """Serve price_history from the pre-aggregated candles (see core.candles)."""
+    interval = request.GET.get('interval', '1m')
+    if interval not in CANDLE_INTERVALS:
+        return Response({'error': f'Invalid interval. Use one of: {", ".join(CANDLE_INTERVALS)}.'}, status=400)
+    start = end = None
+    if 'from' in request.GET:
+        start = parse_time_param(request.GET['from'])
+        if start is None:
+            return Response({'error': 'Invalid from parameter.'}, status=400)
+    if 'to' in request.GET:
+        end = parse_time_param(request.GET['to'])
+        if end is None:
+            return Response({'error': 'Invalid to parameter.'}, status=400)
+    # Downsampled requests may read a longer window than is returned
+    max_limit = DOWNSAMPLE_MAX_SOURCE if max_points else 1000
+    try:
+        limit = min(max(int(request.GET.get('limit', max_limit if max_points else 500)), 1), max_limit)
+    except ValueError:
+        return Response({'error': 'Invalid limit parameter.'}, status=400)
+
+    cache_key = (trading_pair.pair, interval, start, end, limit, max_points)
+    history = history_cache.get(cache_key) if max_points else None
+    if history is None:
+        rows = get_candles(trading_pair, interval, start, end, limit)
+        if max_points:
+            rows = downsample_rows(rows, max_points, 'start', 'close')
+        history = [
+            {
+                'timestamp': row['start'].strftime('%Y-%m-%d %H:%M'),
+                'open': row['open'],
+                'high': row['high'],
+                'low': row['low'],
+                'close': row['close'],
+                'price': row['close'],
+                'volume': row.get('volume', 0.0)
+            }
+            for row in rows
+        ]
+        if max_points:
+            # Ranges that ended before the current bucket no longer change
+            closed = end is not None and end <= bucket_start(datetime.utcnow(), interval)
+            history_cache.set(cache_key, history, ttl=CLOSED_RANGE_TTL if closed else None)
+    return Response({'history': history, 'interval': interval}, status=200)
+
+@conditional_get(market_data_etag, max_age=TICK_MAX_AGE)
 @api_view(['GET'])
 def get_market_data(request):
     try:
-        # Simulate fresh prices
-        updated_prices = simulate_all_prices()
-        
-        # Get all trading pairs
-        pairs = TradingPair.objects(is_active=True)
+        # Pure read: prices are advanced by the background ticker (core.ticker)
+        snapshot = price_snapshots.get()
         market_data = []
         
-        for pair in pairs:
+        for pair in snapshot:
             market_data.append({
-                'pair': pair.pair,
-                'base_symbol': pair.base_symbol,
-                'quote_symbol': pair.quote_symbol,
-                'current_price': pair.current_price,
-                'price_change_24h': pair.price_change_24h,
-                'volume_24h': pair.volume_24h,
-                'high_24h': pair.high_24h,
-                'low_24h': pair.low_24h,
-                'last_updated': pair.last_updated
+                'pair': pair['pair'],
+                'base_symbol': pair['base_symbol'],
+                'quote_symbol': pair['quote_symbol'],
+                'current_price': pair['current_price'],
+                'price_change_24h': pair['price_change_24h'],
+                'volume_24h': pair['volume_24h'],
+                'high_24h': pair['high_24h'],
+                'low_24h': pair['low_24h'],
+                'last_updated': pair['last_updated']
             })
         
         return Response({'market_data': market_data}, status=status.HTTP_200_OK)
@@ -377,13 +463,10 @@ def place_order(request):
         if not auth_header:
             return Response({'error': 'Authentication required'}, status=status.HTTP_401_UNAUTHORIZED)
         
-        token_value = auth_header.replace('Bearer ', '')
-        token = Token.objects(token=token_value).first()
-        if not token:
+        user = get_request_user(request)
+        if not user:
             return Response({'error': 'Invalid token'}, status=status.HTTP_401_UNAUTHORIZED)
         
-        user = token.user
-        
         # Extract order data
         pair_name = request.data.get('pair')
         order_type = request.data.get('order_type', 'market')
@@ -396,14 +479,19 @@ def place_order(request):
         
         if order_type == 'market':
             # Execute market order immediately
-            success, message = execute_market_order(user, pair_name, side, quantity)
+            timings = {}
+            success, message = execute_market_order(user, pair_name, side, quantity, timings=timings)
             if success:
-                return Response({'message': message}, status=status.HTTP_200_OK)
+                response = Response({'message': message}, status=status.HTTP_200_OK)
             else:
-                return Response({'error': message}, status=status.HTTP_400_BAD_REQUEST)
+                response = Response({'error': message}, status=status.HTTP_400_BAD_REQUEST)
+            response['Server-Timing'] = ', '.join(f'{stage};dur={ms:.2f}' for stage, ms in timings.items())
+            return response
         
         else:
-            # Create limit order (for future implementation)
+            # Limit order: reserve funds, then match against the book (core.matching)
+            if side not in ('buy', 'sell') or quantity <= 0 or not price or price <= 0:
+                return Response({'error': 'Limit orders need a side, a positive quantity and a positive price'}, status=status.HTTP_400_BAD_REQUEST)
             trading_pair = TradingPair.objects(pair=pair_name).first()
             if not trading_pair:
                 return Response({'error': 'Trading pair not found'}, status=status.HTTP_404_NOT_FOUND)
@@ -417,16 +505,39 @@ def place_order(request):
                 price=price,
                 order_id=generate_order_id()
             )
-            order.save()
+            success, message, entry = matching_engine.place(order, trading_pair)
+            if not success:
+                return Response({'error': message}, status=status.HTTP_400_BAD_REQUEST)
             
             return Response({
-                'message': 'Limit order placed successfully',
-                'order_id': order.order_id
+                'message': message,
+                'order_id': order.order_id,
+                'status': entry.status,
+                'filled_quantity': entry.filled
             }, status=status.HTTP_201_CREATED)
         
     except Exception as e:
         return Response({'error': f'Failed to place order: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+@api_view(['POST'])
+def cancel_order(request):
+    user = get_request_user(request)
+    if not user:
+        return Response({'error': 'Invalid token'}, status=status.HTTP_401_UNAUTHORIZED)
+    
+    order_id = request.data.get('order_id')
+    if not order_id:
+        return Response({'error': 'Missing order_id'}, status=status.HTTP_400_BAD_REQUEST)
+    order = Order.objects(order_id=order_id, user=user).first()
+    if not order:
+        return Response({'error': 'Order not found'}, status=status.HTTP_404_NOT_FOUND)
+    if order.order_type != 'limit' or order.status not in ('pending', 'partial'):
+        return Response({'error': f'Order is {order.status} and cannot be cancelled'}, status=status.HTTP_400_BAD_REQUEST)
+    
+    if not matching_engine.cancel(order, order.pair):
+        return Response({'error': 'Order is no longer open'}, status=status.HTTP_409_CONFLICT)
+    return Response({'message': 'Order cancelled', 'order_id': order_id}, status=status.HTTP_200_OK)
+
 @api_view(['GET'])
 def get_order_history(request):
     try:
@@ -435,21 +546,22 @@ def get_order_history(request):
         if not auth_header:
             return Response({'error': 'Authentication required'}, status=status.HTTP_401_UNAUTHORIZED)
         
-        token_value = auth_header.replace('Bearer ', '')
-        token = Token.objects(token=token_value).first()
-        if not token:
+        user = get_request_user(request)
+        if not user:
             return Response({'error': 'Invalid token'}, status=status.HTTP_401_UNAUTHORIZED)
         
-        user = token.user
-        
         # Get orders for this user
-        orders = Order.objects(user=user).order_by('-created_at')[:50]  # Last 50 orders
+        orders = list(Order.objects(user=user).order_by('-created_at').no_dereference()[:50])  # Last 50 orders
+        
+        # Resolve pair names in one query instead of dereferencing per order
+        pair_ids = {order.pair.id for order in orders}
+        pair_names = {p.id: p.pair for p in TradingPair.objects(id__in=pair_ids).only('pair')} if pair_ids else {}
         
         orders_data = []
         for order in orders:
             orders_data.append({
                 'order_id': order.order_id,
-                'pair': order.pair.pair,
+                'pair': pair_names.get(order.pair.id),
                 'order_type': order.order_type,
                 'side': order.side,
                 'quantity': order.quantity,
@@ -474,13 +586,10 @@ def create_curve_cart(request):
         if not auth_header:
             return Response({'error': 'Authentication required'}, status=status.HTTP_401_UNAUTHORIZED)
         
-        token_value = auth_header.replace('Bearer ', '')
-        token = Token.objects(token=token_value).first()
-        if not token:
+        user = get_request_user(request)
+        if not user:
             return Response({'error': 'Invalid token'}, status=status.HTTP_401_UNAUTHORIZED)
         
-        user = token.user
-        
         # Extract cart data
         items = request.data.get('items', [])
         total_amount = float(request.data.get('total_amount', 0))
@@ -588,8 +697,9 @@ def process_curve_payment(request):
             cart.save()
             
             # Update merchant total received
-            cart.merchant.total_received += cart.total_amount
-            cart.merchant.save()
+            MerchantWallet.objects(id=cart.merchant.id).update_one(
+                inc__total_received=cart.total_amount, inc__version=1, set__updated_at=datetime.utcnow()
+            )
             
             return Response({
                 'message': 'Payment processed successfully',
@@ -602,7 +712,16 @@ def process_curve_payment(request):
     except Exception as e:
         return Response({'error': f'Payment processing failed: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+@api_view(['GET'])
+@authentication_classes([SimpleTokenAuthentication])
+@permission_classes([IsAuthenticated])
+def get_ledger_balances(request):
+    """Balances of the user's portfolio as recorded by the ledger (latest snapshot + tail)."""
+    account = account_key(Portfolio, request.user.id)
+    return Response({'account': account, 'balances': ledger_balances(account)})
+
 # Transaction history
+@conditional_get(transactions_etag, private=True)
 @api_view(['GET', 'POST'])
 def get_transaction_history(request):
     if request.method == 'GET':
@@ -617,15 +736,15 @@ def handle_get_transactions(request):
         if not auth_header:
             return Response({'error': 'Authentication required'}, status=status.HTTP_401_UNAUTHORIZED)
         
-        token_value = auth_header.replace('Bearer ', '')
-        token = Token.objects(token=token_value).first()
-        if not token:
+        user = get_request_user(request)
+        if not user:
             return Response({'error': 'Invalid token'}, status=status.HTTP_401_UNAUTHORIZED)
         
-        user = token.user
-        
-        # Get transactions for this user
-        transactions = Transaction.objects(user=user).order_by('-created_at')[:100]  # Last 100 transactions
+        # One page of transactions (?limit=, ?cursor=, ?type=, ?symbol=, ?status=)
+        try:
+            transactions, next_cursor = transaction_page(user, **page_params(request.query_params))
+        except InvalidPage as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
         
         transactions_data = []
         for tx in transactions:
@@ -642,7 +761,7 @@ def handle_get_transactions(request):
                 'created_at': tx.created_at
             })
         
-        return Response({'transactions': transactions_data}, status=status.HTTP_200_OK)
+        return Response({'transactions': transactions_data, 'next_cursor': next_cursor}, status=status.HTTP_200_OK)
         
     except Exception as e:
         return Response({'error': f'Failed to get transaction history: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -654,13 +773,10 @@ def handle_create_transaction(request):
         if not auth_header:
             return Response({'error': 'Authentication required'}, status=status.HTTP_401_UNAUTHORIZED)
         
-        token_value = auth_header.replace('Bearer ', '')
-        token = Token.objects(token=token_value).first()
-        if not token:
+        user = get_request_user(request)
+        if not user:
             return Response({'error': 'Invalid token'}, status=status.HTTP_401_UNAUTHORIZED)
         
-        user = token.user
-        
         # Get transaction data from request
         to_address = request.data.get('to_address')
         amount = float(request.data.get('amount', 0))
@@ -671,46 +787,32 @@ def handle_create_transaction(request):
         if not to_address or amount <= 0:
             return Response({'error': 'Invalid transaction data'}, status=status.HTTP_400_BAD_REQUEST)
         
-        # Get user's portfolio to check balance
-        portfolio = Portfolio.objects(user=user).first()
-        if not portfolio:
-            return Response({'error': 'Portfolio not found'}, status=status.HTTP_404_NOT_FOUND)
-        
-        # Find the wallet for the specified crypto
-        wallet = None
-        for w in portfolio.wallets:
-            if w.symbol == crypto_symbol:
-                wallet = w
-                break
-        
-        if not wallet:
-            return Response({'error': f'{crypto_symbol} wallet not found'}, status=status.HTTP_404_NOT_FOUND)
-        
-        # Check if user has sufficient balance
-        if wallet.balance < amount:
-            return Response({'error': 'Insufficient balance'}, status=status.HTTP_400_BAD_REQUEST)
-        
-        # Create transaction
-        import uuid
-        tx_hash = str(uuid.uuid4())
-        
+        # Debit and record in one unit; the guard rejects an overdraft atomically
         transaction = Transaction(
             user=user,
-            tx_hash=tx_hash,
+            tx_hash=str(uuid.uuid4()),
             transaction_type=transaction_type,
             crypto_symbol=crypto_symbol,
-            amount=amount,
+            amount=-amount,
             to_address=to_address,
-            from_address=wallet.public_key,
             status='confirmed',
             fee=0.001,  # Small fee
             memo=memo
         )
-        transaction.save()
         
-        # Update wallet balance
-        wallet.balance -= amount
-        portfolio.save()
+        def send(batch):
+            wallet = batch.debit(user, crypto_symbol, amount, create=False)
+            transaction.from_address = wallet['public_key']
+            batch.insert(Transaction, [transaction])
+        
+        try:
+            atomic(send, kind='transfer', contra=EXTERNAL)
+        except WalletOwnerNotFound:
+            return Response({'error': 'Portfolio not found'}, status=status.HTTP_404_NOT_FOUND)
+        except WalletNotFound:
+            return Response({'error': f'{crypto_symbol} wallet not found'}, status=status.HTTP_404_NOT_FOUND)
+        except InsufficientBalance:
+            return Response({'error': 'Insufficient balance'}, status=status.HTTP_400_BAD_REQUEST)
         
         # Return transaction details
         return Response({
@@ -751,19 +853,26 @@ def cancel_transaction(request):
         if transaction.status != 'pending':
             return Response({'error': 'Only pending transactions can be cancelled'}, status=status.HTTP_400_BAD_REQUEST)
         
-        # Update transaction status to failed
+        # Flip the status only if still pending, so concurrent cancels refund once
+        cancelled = Transaction.objects(id=transaction.id, status='pending').update_one(
+            set__status='failed',
+            set__memo=(transaction.memo or '') + ' [CANCELLED BY USER]',
+            set__updated_at=datetime.utcnow()
+        )
+        if not cancelled:
+            return Response({'error': 'Only pending transactions can be cancelled'}, status=status.HTTP_400_BAD_REQUEST)
         transaction.status = 'failed'
-        transaction.memo = (transaction.memo or '') + ' [CANCELLED BY USER]'
-        transaction.save()
         
         # Refund the amount to user's wallet if it was already deducted
-        portfolio = Portfolio.objects(user=user).first()
-        if portfolio:
-            for wallet in portfolio.wallets:
-                if wallet.symbol == transaction.crypto_symbol:
-                    wallet.balance += transaction.amount
-                    portfolio.save()
-                    break
+        # (older records stored debits as positive amounts)
+        if transaction.amount:
+            try:
+                atomic(
+                    lambda batch: batch.credit(user, transaction.crypto_symbol, abs(transaction.amount), create=False),
+                    kind='refund', contra=EXTERNAL
+                )
+            except (WalletOwnerNotFound, WalletNotFound):
+                pass
         
         return Response({
             'message': 'Transaction cancelled successfully',
@@ -839,10 +948,10 @@ def initialize_merchant_wallets():
             )
             merchant_wallet.save()
             
-            print(f"Created merchant wallet for {merchant_user.username}")
+            logger.info('Created merchant wallet', extra={'fields': {'username': merchant_user.username}})
             
     except Exception as e:
-        print(f"Error initializing merchant wallets: {e}")
+        logger.exception('Error initializing merchant wallets')
         raise e
 
 # Legacy endpoints for backward compatibility
@@ -872,50 +981,6 @@ def get_wallet(request):
         
     except Exception as e:
         return Response({'error': f'Failed to get wallet: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-        return Response({'error': 'Email already exists.'}, status=400)
-
-    # Create user
-    user = User(username=username, email=email, password=password, created_at=datetime.utcnow())
-    user.save()
-
-    # Create portfolio with initial ARC wallet
-    public_key, private_key_list = generate_wallet()
-    arc_wallet = CryptoWallet(
-        symbol='ARC',
-        name='Arc Token',
-        public_key=public_key,
-        private_key=json.dumps(private_key_list),
-        balance=1000.0,
-        network='Solana Devnet'
-    )
-    portfolio = Portfolio(user=user, wallets=[arc_wallet])
-    portfolio.save()
-
-    # Register face data if image provided
-    if image_file:
-        image = face_recognition.load_image_file(image_file)
-        encodings = face_recognition.face_encodings(image)
-        if not encodings:
-            print("No face found in image.")
-            return Response({'error': 'No face found in image.'}, status=400)
-        encoding_array = encodings[0]
-        face_data = FaceData(user=user, encoding=encoding_array.tobytes())
-        face_data.save()
-
-    # Generate a simple token and save to database
-    token = secrets.token_hex(32)
-    token_obj = Token(user=user, token=token)
-    token_obj.save()
-
-    return Response({
-        'user': {'id': str(user.id), 'username': username, 'email': email},
-        'wallet': {
-            'public_key': public_key,
-            'balance': arc_wallet.balance,
-            'network': arc_wallet.network
-        },
-        'token': token
-    })
 
 @api_view(['POST'])
 @authentication_classes([SimpleTokenAuthentication])
@@ -925,36 +990,22 @@ def create_wallet(request):
     symbol = request.data.get('symbol', 'BTC')
     name = request.data.get('name', 'Bitcoin')
     
-    portfolio = Portfolio.objects(user=user).first()
-    if not portfolio:
-        portfolio = Portfolio(user=user, wallets=[])
-        portfolio.save()
-    
-    # Check if wallet for this symbol already exists
-    for wallet in portfolio.wallets:
-        if wallet.symbol == symbol:
-            return Response({'error': f'{symbol} wallet already exists.'}, status=400)
-    
-    public_key, private_key_list = generate_wallet()
-    new_wallet = CryptoWallet(
-        symbol=symbol,
-        name=name,
-        public_key=public_key,
-        private_key=json.dumps(private_key_list),
-        balance=0.0,
-        network='mainnet'
-    )
+    if not Portfolio.objects(user=user).only('id').first():
+        Portfolio(user=user, wallets=[]).save()
     
-    portfolio.wallets.append(new_wallet)
-    portfolio.save()
+    # Guarded $push: concurrent updates to the portfolio are kept, and a
+    # concurrent request for the same symbol can't add a second wallet
+    new_wallet = add_wallet(Portfolio, user.id, symbol, name=name, network='mainnet')
+    if new_wallet is None:
+        return Response({'error': f'{symbol} wallet already exists.'}, status=400)
     
     return Response({
         'wallet': {
             'symbol': symbol,
             'name': name,
-            'public_key': public_key,
-            'balance': new_wallet.balance,
-            'network': new_wallet.network
+            'public_key': new_wallet['public_key'],
+            'balance': new_wallet['balance'],
+            'network': new_wallet['network']
         }
     })
 
@@ -992,18 +1043,29 @@ def register_face(request):
     if not image_file:
         return Response({"error": "No image provided."}, status=400)
 
-    image = face_recognition.load_image_file(image_file)
-    encodings = face_recognition.face_encodings(image)
+    upload_error = check_upload(image_file)
+    if upload_error:
+        return Response({"error": upload_error}, status=413)
 
-    if not encodings:
-        return Response({"error": "No face found in image."}, status=400)
+    user = User.objects(id=user_id).first()
+    if not user:
+        return Response({"error": "User not found."}, status=404)
 
-    encoding_array = encodings[0]
-    user = User.objects.get(id=user_id)
-    FaceData.objects.update_or_create(user=user, defaults={
-        "encoding": encoding_array.tobytes()
-    })
-    return Response({"message": "Face registered."})
+    try:
+        job_id = face_pool.submit(image_file.read(), on_success=save_face_encoding(user))
+    except FacePoolBusy:
+        return Response({"error": "Face service busy, try again shortly."}, status=503)
+    return Response({"message": "Face registration queued.", "face_job": face_pool.status(job_id)}, status=202)
+
+
+@api_view(['GET'])
+@permission_classes([AllowAny])
+def face_job_status(request, job_id):
+    """Status of a queued face encoding job, plus face pool queue metrics."""
+    job = face_pool.status(job_id)
+    if not job:
+        return Response({'error': 'Face job not found.', 'pool': face_pool.stats()}, status=404)
+    return Response({'face_job': job, 'pool': face_pool.stats()})
 
 
 
@@ -1019,13 +1081,12 @@ def register_face(request):
 @api_view(['POST'])
 @permission_classes([AllowAny])
 def logout_view(request):
-    # This view is tied to Django ORM TokenAuthentication.
-    # For a stateless token, you'd invalidate it here.
-    # For this demo, we'll just remove it from the in-memory store.
-    # In a real app, you'd use a JWT or similar.
-    token_key = request.headers.get('Authorization', '').replace('Token ', '')
-    if token_key in USER_TOKENS:
-        del USER_TOKENS[token_key]
+    # Delete the token and drop it from the auth cache so it stops
+    # resolving immediately rather than after the cache TTL.
+    token_key = parse_auth_header(request.headers.get('Authorization'))
+    if token_key:
+        Token.objects(token=token_key).delete()
+        invalidate_token(token_key)
     return Response({'message': 'Logged out successfully.'})
 
 @api_view(['GET'])
@@ -1089,44 +1150,40 @@ def crypto_list(request):
 @permission_classes([IsAuthenticated])
 def initiate_payment(request):
     user = request.user
-    portfolio = Portfolio.objects(user=user).first()
-    if not portfolio or not portfolio.wallets:
-        return Response({'error': 'No wallet found.'}, status=404)
-        
     to_address = request.data.get('to_address')
     amount = float(request.data.get('amount', 0))
     symbol = request.data.get('symbol', 'ARC')  # Default to ARC
     
-    # Find the specific wallet by symbol
-    wallet = None
-    for w in portfolio.wallets:
-        if w.symbol == symbol:
-            wallet = w
-            break
-    
-    if not wallet:
-        return Response({'error': f'No {symbol} wallet found.'}, status=404)
-        
     # Dummy face auth check (should be improved)
     face_ok = request.data.get('face_ok', False)
     if not face_ok:
         return Response({'error': 'Face authentication failed.'}, status=403)
-    if wallet.balance < amount:
-        return Response({'error': 'Insufficient balance.'}, status=400)
-        
-    wallet.balance -= amount
-    portfolio.save()
+    if amount <= 0:
+        return Response({'error': 'Invalid amount.'}, status=400)
     
-    # Create transaction record
+    # Debit and transaction record commit together
     txn = Transaction(
         user=user,
         transaction_type='transfer',
         crypto_symbol=symbol,
-        amount=amount,
+        amount=-amount,
         to_address=to_address,
+        tx_hash=generate_transaction_hash(),
         status='confirmed'
     )
-    txn.save()
+    
+    def pay(batch):
+        batch.debit(user, symbol, amount, create=False)
+        txn.id = batch.insert(Transaction, [txn])[0]
+    
+    try:
+        atomic(pay, kind='transfer', contra=EXTERNAL)
+    except WalletOwnerNotFound:
+        return Response({'error': 'No wallet found.'}, status=404)
+    except WalletNotFound:
+        return Response({'error': f'No {symbol} wallet found.'}, status=404)
+    except InsufficientBalance:
+        return Response({'error': 'Insufficient balance.'}, status=400)
     
     return Response({'message': 'Payment successful', 'transaction_id': str(txn.id)})
 
@@ -1143,6 +1200,7 @@ def payment_status(request):
     except User.DoesNotExist:
         return Response({'error': 'User not found.'}, status=404)
 
+@conditional_get(transactions_etag, private=True)
 @api_view(['GET'])
 @authentication_classes([SimpleTokenAuthentication])
 @permission_classes([IsAuthenticated])
@@ -1152,7 +1210,10 @@ def transaction_history(request):
     if not portfolio:
         return Response({'error': 'No portfolio found.'}, status=404)
         
-    txns = Transaction.objects(user=user).order_by('-created_at')
+    try:
+        txns, next_cursor = transaction_page(user, **page_params(request.query_params))
+    except InvalidPage as e:
+        return Response({'error': str(e)}, status=400)
     txn_list = [
         {
             'id': str(txn.id),
@@ -1165,7 +1226,7 @@ def transaction_history(request):
         }
         for txn in txns
     ]
-    return Response({'transactions': txn_list})
+    return Response({'transactions': txn_list, 'next_cursor': next_cursor})
 
 @api_view(['POST'])
 @authentication_classes([SimpleTokenAuthentication])
@@ -1178,107 +1239,127 @@ def face_auth(request):
     face_data = FaceData.objects(user=user).first()
     if not face_data:
         return Response({'error': 'No face data registered.'}, status=404)
-    image = face_recognition.load_image_file(image_file)
-    encodings = face_recognition.face_encodings(image)
-    if not encodings:
+    upload_error = check_upload(image_file)
+    if upload_error:
+        return Response({'error': upload_error}, status=413)
+    try:
+        job_id = face_pool.submit(image_file.read())
+        encoding = face_pool.wait(job_id, timeout=getattr(settings, 'FACE_AUTH_TIMEOUT', 15))
+    except ImageRejected as e:
+        return Response({'error': str(e)}, status=400)
+    except FacePoolBusy:
+        return Response({'error': 'Face service busy, try again shortly.'}, status=503)
+    except TimeoutError:
+        return Response({'error': 'Face verification timed out.'}, status=503)
+    if encoding is None:
         return Response({'error': 'No face found in image.'}, status=400)
-    encoding_array = encodings[0]
+    encoding_array = np.frombuffer(encoding, dtype=np.float64)
     stored_encoding = np.frombuffer(face_data.encoding, dtype=np.float64)
-    match = face_recognition.compare_faces([stored_encoding], encoding_array)[0]
+    match = bool(np.linalg.norm(stored_encoding - encoding_array) <= FACE_MATCH_TOLERANCE)
     return Response({'face_ok': match})
 
+@api_view(['POST'])
+@authentication_classes([SimpleTokenAuthentication])
+@permission_classes([IsAuthenticated])
+def face_identify(request):
+    """Whether the nearest enrolled face to an image is the requesting user's.
+
+    Only match/no-match is returned: other users' ids, names and distances
+    never leave the index.
+    """
+    image_file = request.FILES.get('image')
+    if not image_file:
+        return Response({'error': 'No image provided.'}, status=400)
+    upload_error = check_upload(image_file)
+    if upload_error:
+        return Response({'error': upload_error}, status=413)
+    try:
+        job_id = face_pool.submit(image_file.read())
+        encoding = face_pool.wait(job_id, timeout=getattr(settings, 'FACE_AUTH_TIMEOUT', 15))
+    except ImageRejected as e:
+        return Response({'error': str(e)}, status=400)
+    except FacePoolBusy:
+        return Response({'error': 'Face service busy, try again shortly.'}, status=503)
+    except TimeoutError:
+        return Response({'error': 'Face identification timed out.'}, status=503)
+    if encoding is None:
+        return Response({'error': 'No face found in image.'}, status=400)
+
+    nearest = face_index.identify(np.frombuffer(encoding, dtype=np.float64), limit=1)
+    match = bool(nearest) and nearest[0][0] == str(request.user.id) and nearest[0][1] <= FACE_MATCH_TOLERANCE
+    return Response({'match': match})
+
 @api_view(['POST'])
 @authentication_classes([SimpleTokenAuthentication])
 @permission_classes([IsAuthenticated])
 def buy_crypto(request):
     user = request.user
-    portfolio = Portfolio.objects(user=user).first()
-    if not portfolio:
-        return Response({'error': 'No portfolio found.'}, status=404)
-        
     amount = float(request.data.get('amount', 0))
     symbol = request.data.get('symbol', 'ARC')
     
     if amount <= 0:
         return Response({'error': 'Invalid amount.'}, status=400)
     
-    # Find the specific wallet by symbol
-    wallet = None
-    for w in portfolio.wallets:
-        if w.symbol == symbol:
-            wallet = w
-            break
+    # Balance change and transaction record commit together
+    def buy(batch):
+        batch.credit(user, symbol, amount, create=False)
+        batch.insert(Transaction, [Transaction(
+            user=user,
+            transaction_type='deposit',
+            crypto_symbol=symbol,
+            amount=amount,
+            tx_hash=generate_transaction_hash(),
+            status='confirmed'
+        )])
     
-    if not wallet:
+    try:
+        batch = atomic(buy, kind='deposit', contra=MARKET)
+    except WalletOwnerNotFound:
+        return Response({'error': 'No portfolio found.'}, status=404)
+    except WalletNotFound:
         return Response({'error': f'No {symbol} wallet found.'}, status=404)
-        
-    wallet.balance += amount
-    portfolio.save()
     
-    # Create transaction record
-    txn = Transaction(
-        user=user,
-        transaction_type='deposit',
-        crypto_symbol=symbol,
-        amount=amount,
-        status='confirmed'
-    )
-    txn.save()
-    
-    return Response({'message': 'Crypto bought successfully.', 'balance': wallet.balance})
+    return Response({'message': 'Crypto bought successfully.', 'balance': batch.wallets[user.id][symbol]['balance']})
 
 @api_view(['POST'])
 @authentication_classes([SimpleTokenAuthentication])
 @permission_classes([IsAuthenticated])
 def sell_crypto(request):
     user = request.user
-    portfolio = Portfolio.objects(user=user).first()
-    if not portfolio:
-        return Response({'error': 'No portfolio found.'}, status=404)
-        
     amount = float(request.data.get('amount', 0))
     symbol = request.data.get('symbol', 'ARC')
     
     if amount <= 0:
         return Response({'error': 'Invalid amount.'}, status=400)
     
-    # Find the specific wallet by symbol
-    wallet = None
-    for w in portfolio.wallets:
-        if w.symbol == symbol:
-            wallet = w
-            break
+    # Balance change and transaction record commit together
+    def sell(batch):
+        batch.debit(user, symbol, amount, create=False)
+        batch.insert(Transaction, [Transaction(
+            user=user,
+            transaction_type='withdraw',
+            crypto_symbol=symbol,
+            amount=-amount,
+            tx_hash=generate_transaction_hash(),
+            status='confirmed'
+        )])
     
-    if not wallet:
+    try:
+        batch = atomic(sell, kind='withdraw', contra=MARKET)
+    except WalletOwnerNotFound:
+        return Response({'error': 'No portfolio found.'}, status=404)
+    except WalletNotFound:
         return Response({'error': f'No {symbol} wallet found.'}, status=404)
-        
-    if wallet.balance < amount:
+    except InsufficientBalance:
         return Response({'error': 'Insufficient balance.'}, status=400)
-        
-    wallet.balance -= amount
-    portfolio.save()
     
-    # Create transaction record
-    txn = Transaction(
-        user=user,
-        transaction_type='withdraw',
-        crypto_symbol=symbol,
-        amount=amount,
-        status='confirmed'
-    )
-    txn.save()
-    
-    return Response({'message': 'Crypto sold successfully.', 'balance': wallet.balance})
+    return Response({'message': 'Crypto sold successfully.', 'balance': batch.wallets[user.id][symbol]['balance']})
 
 @api_view(['POST'])
 @authentication_classes([SimpleTokenAuthentication])
 @permission_classes([IsAuthenticated])
 def transfer_to_merchant(request):
     user = request.user
-    portfolio = Portfolio.objects(user=user).first()
-    if not portfolio:
-        return Response({'error': 'No portfolio found.'}, status=404)
-        
     merchant_name = request.data.get('merchant_name')
     amount = float(request.data.get('amount', 0))
     symbol = request.data.get('symbol', 'ARC')
@@ -1289,61 +1370,54 @@ def transfer_to_merchant(request):
     if not face_ok:
         return Response({'error': 'Face authentication failed.'}, status=403)
     
-    # Find user's wallet
-    user_wallet = None
-    for w in portfolio.wallets:
-        if w.symbol == symbol:
-            user_wallet = w
-            break
-    
-    if not user_wallet:
-        return Response({'error': f'No {symbol} wallet found.'}, status=404)
-        
-    if user_wallet.balance < amount:
-        return Response({'error': 'Insufficient balance.'}, status=400)
-    
-    merchant_wallet = MerchantWallet.objects(merchant_name=merchant_name).first()
+    merchant_wallet = MerchantWallet.objects(merchant_name=merchant_name).only('id').first()
     if not merchant_wallet:
         return Response({'error': 'Merchant wallet not found.'}, status=404)
     
-    # Find or create merchant's crypto wallet
-    merchant_crypto_wallet = None
-    for w in merchant_wallet.wallets:
-        if w.symbol == symbol:
-            merchant_crypto_wallet = w
-            break
-    
-    if not merchant_crypto_wallet:
-        # Create new crypto wallet for merchant
-        public_key, private_key_list = generate_wallet()
-        merchant_crypto_wallet = CryptoWallet(
-            symbol=symbol,
-            name=f'{symbol} Wallet',
-            public_key=public_key,
-            private_key=json.dumps(private_key_list),
-            balance=0.0,
-            network='mainnet'
-        )
-        merchant_wallet.wallets.append(merchant_crypto_wallet)
-    
-    # Transfer
-    user_wallet.balance -= amount
-    merchant_crypto_wallet.balance += amount
-    portfolio.save()
-    merchant_wallet.save()
-    
+    # Debit, merchant credit (wallet created on first payment) and record commit together
     txn = Transaction(
         user=user,
         transaction_type='transfer',
         crypto_symbol=symbol,
-        amount=amount,
-        to_address=merchant_crypto_wallet.public_key,
+        amount=-amount,
+        tx_hash=generate_transaction_hash(),
         status='confirmed'
     )
-    txn.save()
+    
+    def pay(batch):
+        batch.debit(user, symbol, amount, create=False)
+        merchant_crypto_wallet = batch.credit(merchant_wallet.id, symbol, amount, model=MerchantWallet)
+        txn.to_address = merchant_crypto_wallet['public_key']
+        txn.id = batch.insert(Transaction, [txn])[0]
+    
+    try:
+        atomic(pay, kind='transfer')
+    except WalletOwnerNotFound:
+        return Response({'error': 'No portfolio found.'}, status=404)
+    except WalletNotFound:
+        return Response({'error': f'No {symbol} wallet found.'}, status=404)
+    except InsufficientBalance:
+        return Response({'error': 'Insufficient balance.'}, status=400)
     
     return Response({'message': 'Payment successful', 'transaction_id': str(txn.id)})
 
+@api_view(['POST'])
+@authentication_classes([SimpleTokenAuthentication])
+@permission_classes([IsAuthenticated])
+def merchant_payouts(request):
+    """Pay many users from the merchant's portfolio: ``{"payouts": [{recipient, symbol, amount}], "memo"}``.
+
+    Rows that fail validation or can't be covered are reported per row; the rest commit together.
+    """
+    user = request.user
+    if not user.is_merchant:
+        return Response({'error': 'Only merchants can send payouts.'}, status=status.HTTP_403_FORBIDDEN)
+    try:
+        result = run_payout(user, request.data.get('payouts'), memo=str(request.data.get('memo') or '')[:500])
+    except PayoutRejected as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    return Response(result, status=status.HTTP_200_OK)
+
 @api_view(['POST'])
 @permission_classes([AllowAny])
 def create_merchant_wallet(request):
@@ -1412,13 +1486,13 @@ def ensure_curve_merchant_exists():
             is_active=True
         )
         merchant_wallet.save()
-        print("Created curve-merchant wallet")
+        logger.info('Created curve-merchant wallet')
 
 # Comment out the auto-call for now to avoid module load issues
 # try:
 #     ensure_curve_merchant_exists()
 # except Exception as e:
-#     print(f"Error creating curve-merchant: {e}")
+#     logger.exception('Error creating curve-merchant')
 
 @api_view(['GET'])
 @permission_classes([AllowAny])
@@ -1445,28 +1519,30 @@ def get_merchant_wallet(request, merchant_name):
 @api_view(["GET"])
 @permission_classes([AllowAny])
 def get_order_book(request):
-    symbol = request.query_params.get("symbol", "ARC")
-    pair_name = f"{symbol}USDT"
-    
-    # Get trading pair
-    trading_pair = TradingPair.objects(pair=pair_name).first()
-    if not trading_pair:
-        return Response({"orders": []})
+    """
+    L2 depth for a pair: price levels with summed quantity, best first.
+    Query params: pair=BTCUSDT (or symbol=BTC), depth (levels per side,
+    default 20, max 100) and tick (optional price grouping, e.g. 10).
+    The sequence number changes whenever the book does.
+    """
+    pair_name = request.query_params.get("pair") or f"{request.query_params.get('symbol', 'ARC')}USDT"
+    try:
+        depth = min(max(int(request.query_params.get("depth", 20)), 1), 100)
+        tick = float(request.query_params.get("tick", 0)) or None
+    except ValueError:
+        return Response({"error": "Invalid depth or tick parameter."}, status=status.HTTP_400_BAD_REQUEST)
+    if tick is not None and tick < 0:
+        return Response({"error": "Invalid depth or tick parameter."}, status=status.HTTP_400_BAD_REQUEST)
+    if price_snapshots.get().get(pair_name) is None:
+        return Response({"error": "Trading pair not found."}, status=status.HTTP_404_NOT_FOUND)
     
-    orders = Order.objects(pair=trading_pair, status="pending").order_by("-created_at")
-    order_list = [
-        {
-            "id": str(o.id),
-            "type": o.order_type,
-            "side": o.side,
-            "symbol": symbol,
-            "price": o.price,
-            "quantity": o.quantity,
-            "timestamp": o.created_at,
-        }
-        for o in orders
-    ]
-    return Response({"orders": order_list})
+    snapshot = matching_engine.depth(pair_name, depth, tick)
+    return Response({
+        "pair": pair_name,
+        "sequence": snapshot["sequence"],
+        "bids": [{"price": price, "quantity": quantity, "total": price * quantity} for price, quantity in snapshot["bids"]],
+        "asks": [{"price": price, "quantity": quantity, "total": price * quantity} for price, quantity in snapshot["asks"]],
+    })
 
 @api_view(["GET"])
 @permission_classes([AllowAny])
@@ -1501,6 +1577,7 @@ def debug_auth(request):
     })
 
 # Merchant Payment Endpoints
+@conditional_get(merchant_info_etag, max_age=60)
 @api_view(['GET'])
 @permission_classes([AllowAny])
 def get_merchant_info(request):
@@ -1545,13 +1622,10 @@ def process_merchant_payment(request):
         if not auth_header:
             return Response({'error': 'Authentication required'}, status=status.HTTP_401_UNAUTHORIZED)
         
-        token_value = auth_header.replace('Bearer ', '')
-        token = Token.objects(token=token_value).first()
-        if not token:
+        user = get_request_user(request)
+        if not user:
             return Response({'error': 'Invalid token'}, status=status.HTTP_401_UNAUTHORIZED)
         
-        user = token.user
-        
         # Get payment data
         merchant_name = request.data.get('merchant_name', 'curve-merchant')
         amount = float(request.data.get('amount', 0))
@@ -1599,8 +1673,9 @@ def process_merchant_payment(request):
             if trading_pair:
                 usd_value = amount * trading_pair.current_price
             
-            merchant_wallet.total_received += usd_value
-            merchant_wallet.save()
+            MerchantWallet.objects(id=merchant_wallet.id).update_one(
+                inc__total_received=usd_value, inc__version=1, set__updated_at=datetime.utcnow()
+            )
             
             # Generate transaction hash
             tx_hash = generate_transaction_hash()
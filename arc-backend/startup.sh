@@ -7,6 +7,14 @@ echo "Starting arc-backend deployment..."
 # Wait for any dependencies to be ready
 sleep 5
 
+# The market stream (/api/stream/, SSE + WebSocket) is a separate service from
+# the same image: SERVICE_ROLE=stream serves the ASGI stream app instead of
+# the REST API. One worker; it follows ticks and balances in MongoDB.
+if [ "$SERVICE_ROLE" = "stream" ]; then
+    echo "Starting market stream server..."
+    exec gunicorn --bind 0.0.0.0:$PORT --workers 1 --timeout 0 -k uvicorn.workers.UvicornWorker arc_backend.asgi:application
+fi
+
 # Run database migrations (if using traditional DB)
 echo "Running database migrations..."
 python manage.py migrate --noinput
@@ -29,5 +37,7 @@ except Exception as e:
 "
 
 # Start the application
+# Threaded WSGI for the REST API. Keep a single worker: the price ticker and
+# the matching engine's order books live in-process.
 echo "Starting Gunicorn server..."
 exec gunicorn --bind 0.0.0.0:$PORT --workers 1 --threads 8 --timeout 0 arc_backend.wsgi:application
@@ -11,6 +11,8 @@ const Dashboard = () => {
   const [error, setError] = useState(null)
 
   const API_BASE = import.meta.env.VITE_API_BASE_URL || 'http://127.0.0.1:8000/api'
+  // /api/stream/ is served by the separate stream service when it has its own URL
+  const STREAM_BASE = import.meta.env.VITE_STREAM_BASE_URL || API_BASE
 
   useEffect(() => {
     const fetchData = async () => {
@@ -156,28 +158,85 @@ const Dashboard = () => {
 
     fetchData()
     
-    // Set up periodic refresh for market data
-    const interval = setInterval(() => {
-      fetchMarketData()
-    }, 30000) // Update every 30 seconds
+    // Live market data (and balances when logged in) pushed by the backend stream; poll only while it is unavailable
+    let interval = null
+    let stream = null
+    let reopen = null
+    let closed = false
+    const startPolling = () => {
+      if (!interval) {
+        interval = setInterval(() => {
+          fetchMarketData()
+        }, 30000) // Update every 30 seconds
+      }
+    }
+    const openStream = async () => {
+      let url = `${STREAM_BASE}/stream/?topics=ticks`
+      const token = localStorage.getItem('token')
+      if (token) {
+        try {
+          // EventSource can't send headers: trade the API token for a short-lived, single-use ticket
+          const ticketResponse = await axios.post(`${API_BASE}/stream/ticket/`, null, { headers: { Authorization: `Bearer ${token}` } })
+          url = `${STREAM_BASE}/stream/?topics=ticks,balances&ticket=${encodeURIComponent(ticketResponse.data.ticket)}`
+        } catch (ticketError) {
+          console.error('Dashboard: Error fetching stream ticket:', ticketError)
+        }
+      }
+      if (closed) return
+      stream = new EventSource(url)
+      stream.addEventListener('ticks', (event) => {
+        const message = JSON.parse(event.data)
+        setMarketData(formatMarketData(message.data || []))
+      })
+      stream.addEventListener('balances', (event) => {
+        const balances = Object.fromEntries((JSON.parse(event.data).data || []).map(row => [row.symbol, row.balance]))
+        setWallets(prev => prev.map(wallet => wallet.symbol in balances ? { ...wallet, balance: balances[wallet.symbol] } : wallet))
+      })
+      stream.onopen = () => {
+        if (interval) {
+          clearInterval(interval)
+          interval = null
+        }
+      }
+      stream.onerror = () => {
+        startPolling()
+        if (url.includes('ticket=')) {
+          // The ticket was used up by this connection, so reconnect with a fresh one
+          stream.close()
+          if (!closed) reopen = setTimeout(openStream, 5000)
+        } // otherwise EventSource keeps reconnecting on its own
+      }
+    }
+    if (typeof EventSource !== 'undefined') {
+      openStream()
+    } else {
+      startPolling()
+    }
 
-    return () => clearInterval(interval)
+    return () => {
+      closed = true
+      if (stream) stream.close()
+      if (reopen) clearTimeout(reopen)
+      if (interval) clearInterval(interval)
+    }
   }, [])
 
+  const formatMarketData = (marketPairs) => marketPairs.map(pair => ({
+    symbol: pair.base_symbol,
+    name: getCryptoName(pair.base_symbol),
+    price: pair.current_price,
+    change: pair.price_change_24h,
+    volume: formatVolume(pair.volume_24h),
+    marketCap: calculateMarketCap(pair.base_symbol, pair.current_price)
+  }))
+
   const fetchMarketData = async () => {
     try {
       console.log('Dashboard: Updating market data...')
       const response = await axios.get(`${API_BASE}/market-data/`)
       const marketPairs = response.data.market_data || []
       
-      const formattedMarketData = marketPairs.map(pair => ({
-        symbol: pair.base_symbol,
-        name: getCryptoName(pair.base_symbol),
-        price: pair.current_price,
-        change: pair.price_change_24h,
-        volume: formatVolume(pair.volume_24h),
-        marketCap: calculateMarketCap(pair.base_symbol, pair.current_price)
-      }))
+      const formattedMarketData = formatMarketData(marketPairs)
 
       setMarketData(formattedMarketData)
       console.log('Dashboard: Market data updated successfully')
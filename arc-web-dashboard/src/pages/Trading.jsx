@@ -15,6 +15,8 @@ const Trading = () => {
   const [loadingChart, setLoadingChart] = useState(false)
   const [btcPrice, setBtcPrice] = useState(null)
   const API_BASE = import.meta.env.VITE_API_BASE_URL || 'http://127.0.0.1:8000/api';
+  // /api/stream/ is served by the separate stream service when it has its own URL
+  const STREAM_BASE = import.meta.env.VITE_STREAM_BASE_URL || API_BASE;
   
   const [tradingPairs, setTradingPairs] = useState([
     { pair: 'BTCUSDT', price: 43250.50, change: '+2.45%', volume: '1.2M' },
@@ -75,14 +77,46 @@ const Trading = () => {
     };
     fetchPriceHistory();
 
-    // Set up periodic refresh for BTC price
+    // Append live ticks from the backend stream; fall back to polling BTC while it is unavailable
     let interval = null;
-    if (selectedPair === 'BTCUSDT') {
-      interval = setInterval(() => {
-        fetchPriceHistory();
-      }, 30000);
+    const startPolling = () => {
+      if (!interval && selectedPair === 'BTCUSDT') {
+        interval = setInterval(() => {
+          fetchPriceHistory();
+        }, 30000);
+      }
+    };
+    const stream = typeof EventSource !== 'undefined' ? new EventSource(`${STREAM_BASE}/stream/?topics=ticks`) : null;
+    if (stream) {
+      stream.addEventListener('ticks', (event) => {
+        const message = JSON.parse(event.data);
+        const tick = (message.data || []).find(row => row.pair === selectedPair);
+        if (!tick) return;
+        const point = {
+          timestamp: String(tick.last_updated).replace('T', ' ').slice(0, 16),
+          price: tick.current_price,
+          volume: tick.volume_24h
+        };
+        setPriceHistory(prev => [...prev.slice(-99), point]);
+        if (selectedPair === 'BTCUSDT') {
+          setBtcPrice(tick.current_price);
+          setTradingPairs(prevPairs => prevPairs.map(pair =>
+            pair.pair === 'BTCUSDT' ? { ...pair, price: tick.current_price } : pair
+          ));
+        }
+      });
+      stream.onopen = () => {
+        if (interval) {
+          clearInterval(interval);
+          interval = null;
+        }
+      };
+      stream.onerror = startPolling; // EventSource keeps reconnecting on its own
+    } else {
+      startPolling();
     }
     return () => {
+      if (stream) stream.close();
       if (interval) clearInterval(interval);
     };
   }, [selectedPair]);